@@ -0,0 +1,566 @@
+import sys
+import json
+import time
+import gc
+import tracemalloc
+import base64
+import random
+import argparse
+import resource
+import threading
+import multiprocessing
+import urllib.request
+from contextlib import ExitStack
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import migration_utils
+
+
+BENCHMARK_HASH_PARAMS = {
+    "algorithm": "SCRYPT",
+    "signer_key": base64.b64encode(b"benchmark-signer-key").decode(),
+    "salt_separator": "Bw==",
+    "rounds": 8,
+    "mem_cost": 14,
+}
+
+
+### Begin Fake Descope
+
+
+class FakeDescopeHandler(BaseHTTPRequestHandler):
+    """
+    Answers the Descope management API requests made by the migration, with optional injected failures
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PATCH(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        if self.path == "/_stats":
+            with server.lock:
+                return self.respond(200, {"requests": dict(server.requests)})
+
+        with server.lock:
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+
+        config = server.config
+        if config["latency_ms"]:
+            time.sleep(config["latency_ms"] / 1000)
+        roll = random.random()
+        if roll < config["timeout_fraction"]:
+            # Hold the request past the client's timeout, then drop the connection
+            time.sleep(config["stall_seconds"])
+            self.close_connection = True
+            return
+        if roll < config["timeout_fraction"] + config["rate_limit_fraction"]:
+            return self.respond(
+                429,
+                {"errorCode": "E130429", "errorMessage": "Rate limit exceeded"},
+                {"Retry-After": str(config["retry_after"])},
+            )
+
+        if self.path == "/v1/mgmt/user/create/batch":
+            return self.respond(200, self.create_users(body.get("users") or []))
+        if self.path == "/v1/mgmt/user/patch/batch":
+            users = body.get("users") or []
+            return self.respond(
+                200,
+                {
+                    "patchedUsers": [{"loginIds": [u.get("loginId")]} for u in users],
+                    "failedUsers": [],
+                },
+            )
+        if self.path == "/v1/mgmt/user/customattributes":
+            with server.lock:
+                attributes = list(server.attributes.values())
+            return self.respond(200, {"data": attributes})
+        if self.path == "/v1/mgmt/user/customattribute/create":
+            with server.lock:
+                for attribute in body.get("attributes") or []:
+                    server.attributes[attribute["name"]] = attribute
+            return self.respond(200, {})
+        return self.respond(200, {})
+
+    def create_users(self, users):
+        created, failed = [], []
+        with self.server.lock:
+            for user in users:
+                login_id = user.get("loginId")
+                if login_id in self.server.login_ids:
+                    failed.append(
+                        {"failure": "User already exists", "user": {"loginIds": [login_id]}}
+                    )
+                    continue
+                self.server.login_ids.add(login_id)
+                created.append({"loginIds": [login_id]})
+        return {"createdUsers": created, "failedUsers": failed}
+
+    def respond(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_fake_descope(config, ready):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDescopeHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.attributes = {}
+    server.login_ids = set()
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeDescope:
+    """
+    A local stand-in for the Descope management API, running in its own process so it doesn't
+    compete with the migration for the GIL.
+    """
+
+    def __init__(
+        self,
+        latency_ms=0,
+        rate_limit_fraction=0.0,
+        retry_after=1,
+        timeout_fraction=0.0,
+        stall_seconds=3.0,
+    ):
+        self.config = {
+            "latency_ms": latency_ms,
+            "rate_limit_fraction": rate_limit_fraction,
+            "retry_after": retry_after,
+            "timeout_fraction": timeout_fraction,
+            "stall_seconds": stall_seconds,
+        }
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=serve_fake_descope, args=(self.config, ready), daemon=True
+        )
+        self.process.start()
+        self.url = f"http://127.0.0.1:{ready.get(timeout=10)}"
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+    def request_counts(self):
+        with urllib.request.urlopen(f"{self.url}/_stats") as response:
+            return json.loads(response.read())["requests"]
+
+
+### End Fake Descope
+
+### Begin Synthetic Users
+
+
+def generate_attributes(rng, depth, fanout, list_size=0):
+    """
+    Generate a custom attribute document nested depth levels deep, with fanout values per level,
+    and a list of list_size values per level
+    """
+    attributes = {}
+    if list_size:
+        attributes["tags"] = [f"tag-{rng.randint(0, 1_000_000)}" for _ in range(list_size)]
+    for index in range(fanout):
+        key = f"field{index}"
+        if depth > 1 and index == 0:
+            attributes[key] = generate_attributes(rng, depth - 1, fanout, list_size)
+        elif index % 3 == 0:
+            attributes[key] = rng.randint(0, 10_000)
+        elif index % 3 == 1:
+            attributes[key] = rng.random() < 0.5
+        else:
+            attributes[key] = f"value-{rng.randint(0, 1_000_000)}"
+    return attributes
+
+
+def generate_users(
+    count,
+    password_fraction=0.6,
+    anonymous_fraction=0.1,
+    disabled_fraction=0.02,
+    seed=0,
+):
+    """
+    Generate synthetic users, as listed from the Firebase Admin SDK.
+
+    Users are password users, anonymous users (no email or phone) or passwordless users, in the
+    given proportions.
+    """
+    rng = random.Random(seed)
+    for index in range(count):
+        user_data = {
+            "localId": f"benchmark-user-{index:09d}",
+            "disabled": rng.random() < disabled_fraction,
+            "createdAt": str(1_700_000_000_000 + index),
+        }
+        kind = rng.random()
+        if kind >= anonymous_fraction:
+            user_data["email"] = f"user{index}@benchmark.test"
+            user_data["emailVerified"] = True
+            user_data["displayName"] = f"Benchmark User {index}"
+            if kind < anonymous_fraction + password_fraction:
+                user_data["passwordHash"] = base64.b64encode(rng.randbytes(64)).decode()
+                user_data["salt"] = base64.b64encode(rng.randbytes(12)).decode()
+        yield migration_utils.MigrationUser.from_firebase_data(user_data)
+
+
+### End Synthetic Users
+
+### Begin Benchmark
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(args):
+    """
+    Migrate synthetic users into a fake Descope and measure the migration.
+
+    The migration's context, rate limiter, retry engine, metrics, anonymous password pool and HTTP
+    session are replaced for the run only, and restored afterwards.
+
+    Returns:
+    - dict: The benchmark report
+    """
+    attribute_rng = random.Random(args.seed)
+    attributes = generate_attributes(attribute_rng, args.attribute_depth, args.attribute_fanout)
+
+    # The latency of a user runs from the moment it is listed to its result
+    latencies = []
+    latencies_lock = threading.Lock()
+    listed_at = {}
+    write_user_chunk = migration_utils.write_user_chunk
+
+    def timed_users(users):
+        for user in users:
+            with latencies_lock:
+                listed_at[user.uid] = time.perf_counter()
+            yield user
+
+    def timed_write_user_chunk(chunk, *chunk_args, **chunk_kwargs):
+        results = write_user_chunk(chunk, *chunk_args, **chunk_kwargs)
+        finished_at = time.perf_counter()
+        with latencies_lock:
+            for result in results:
+                started = listed_at.pop(result.user_id, None)
+                if started is not None:
+                    latencies.append(finished_at - started)
+        return results
+
+    with FakeDescope(
+        latency_ms=args.latency_ms,
+        rate_limit_fraction=args.rate_limit_fraction,
+        retry_after=args.retry_after,
+        timeout_fraction=args.timeout_fraction,
+        stall_seconds=args.client_timeout + 0.5,
+    ) as fake_descope, ExitStack() as stack:
+        stack.enter_context(
+            patch.object(
+                migration_utils,
+                "context",
+                migration_utils.MigrationContext(
+                    descope_project_id="P2benchmark",
+                    descope_management_key="benchmark",
+                    descope_base_url=fake_descope.url,
+                    descope_timeout_seconds=args.client_timeout,
+                ),
+            )
+        )
+        if args.attribute_fanout:
+            # Every user gets the same synthetic attribute document instead of a Firestore read
+            stack.enter_context(patch.object(migration_utils, "attribute_source", "firestore"))
+            stack.enter_context(
+                patch.object(
+                    migration_utils,
+                    "prefetch_custom_attributes",
+                    lambda user_ids: {user_id: attributes for user_id in user_ids if user_id},
+                )
+            )
+        for name, value in (
+            ("rate_limiter", migration_utils.RateLimiter(rate=args.rate_limit)),
+            ("retry_engine", migration_utils.RetryEngine()),
+            ("metrics", migration_utils.MigrationMetrics()),
+        ):
+            stack.enter_context(patch.object(migration_utils, name, value))
+        anon_passwords = migration_utils.AnonPasswordPool(
+            rounds=args.anon_password_rounds, workers=args.anon_password_workers
+        )
+        stack.callback(anon_passwords.close)
+        stack.enter_context(patch.object(migration_utils, "anon_passwords", anon_passwords))
+        # configure_http_session replaces the patched session, which is restored on exit
+        stack.enter_context(patch.object(migration_utils, "http_session", None))
+        session = migration_utils.configure_http_session(pool_size=max(10, args.workers))
+        stack.callback(session.close)
+        stack.enter_context(
+            patch.object(migration_utils, "write_user_chunk", timed_write_user_chunk)
+        )
+
+        requests_before = fake_descope.request_counts()
+        users = generate_users(
+            args.users,
+            password_fraction=args.password_fraction,
+            anonymous_fraction=args.anonymous_fraction,
+            seed=args.seed,
+        )
+        migration_utils.metrics.start(expected_users=args.users)
+        started = time.perf_counter()
+        failed_users, migrated_users, _, _ = migration_utils.process_users(
+            timed_users(users),
+            BENCHMARK_HASH_PARAMS,
+            False,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            transform_workers=args.transform_workers,
+            hash_workers=args.hash_workers,
+        )
+        elapsed = time.perf_counter() - started
+        snapshot = migration_utils.metrics.snapshot()
+
+        requests_after = fake_descope.request_counts()
+        requests_by_endpoint = {
+            path: count - requests_before.get(path, 0)
+            for path, count in requests_after.items()
+            if path != "/_stats" and count - requests_before.get(path, 0)
+        }
+
+    total_requests = sum(requests_by_endpoint.values())
+    return {
+        "users": args.users,
+        "migratedUsers": migrated_users,
+        "failedUsers": failed_users.total,
+        "seconds": round(elapsed, 3),
+        "usersPerSecond": round(args.users / elapsed, 1) if elapsed else 0.0,
+        "latencyP50Ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "latencyP99Ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "requestsPerUser": round(total_requests / args.users, 4) if args.users else 0.0,
+        "requestsByEndpoint": requests_by_endpoint,
+        "retries": sum(snapshot["retries"].values()),
+        "rateLimited": sum(snapshot["rateLimited"].values()),
+        "stageSeconds": {
+            name: stage["totalSeconds"] for name, stage in snapshot["stages"].items()
+        },
+        "peakRssMb": round(peak_rss_mb(), 1),
+    }
+
+
+def flatten_with_flatten_dict(document):
+    flattened = migration_utils.flatten_dict(document)
+    return flattened, migration_utils.infer_custom_attribute_types(flattened)
+
+
+def run_flatten_benchmark(args):
+    """
+    Compare flatten_attributes with flatten_dict and infer_custom_attribute_types, the two passes it
+    replaces, on synthetic attribute documents.
+
+    Returns:
+    - dict: The microseconds per document and the peak memory allocated, of each implementation
+    """
+    rng = random.Random(args.seed)
+    documents = [
+        generate_attributes(rng, args.attribute_depth, args.attribute_fanout, args.attribute_list_size)
+        for _ in range(args.documents)
+    ]
+    report = {
+        "documents": args.documents,
+        "attributesPerDocument": len(migration_utils.flatten_attributes(documents[0])[0]),
+    }
+    for name, flatten in (
+        ("flatten_dict", flatten_with_flatten_dict),
+        ("flatten_attributes", migration_utils.flatten_attributes),
+    ):
+        gc.collect()
+        started = time.perf_counter()
+        for document in documents:
+            flatten(document)
+        elapsed = time.perf_counter() - started
+        # Measured apart from the timing, tracing allocations slows Python down
+        tracemalloc.start()
+        for document in documents[:1000]:
+            flatten(document)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report[name] = {
+            "microsecondsPerDocument": round(elapsed / len(documents) * 1_000_000, 2),
+            "peakAllocatedKb": round(peak / 1024, 1),
+        }
+    return report
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the migration without Firebase or Descope."
+    )
+    parser.add_argument("--users", type=int, default=10_000, help="Number of synthetic users")
+    parser.add_argument("--batch-size", type=int, default=migration_utils.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=migration_utils.DEFAULT_WORKERS)
+    parser.add_argument(
+        "--rate-limit", type=float, default=None, help="Max Descope requests per second"
+    )
+    parser.add_argument(
+        "--password-fraction", type=float, default=0.6, help="Fraction of users with a password"
+    )
+    parser.add_argument(
+        "--anonymous-fraction", type=float, default=0.1, help="Fraction of anonymous users"
+    )
+    parser.add_argument(
+        "--anon-password-rounds",
+        type=int,
+        default=migration_utils.DEFAULT_ANON_PASSWORD_ROUNDS,
+        help="bcrypt cost factor of anonymous user passwords",
+    )
+    parser.add_argument(
+        "--anon-password-workers",
+        type=int,
+        default=None,
+        help="Processes hashing anonymous user passwords, 0 to hash inline",
+    )
+    parser.add_argument(
+        "--transform-workers",
+        type=int,
+        default=0,
+        help="Processes flattening custom attributes, 0 to flatten them in a thread",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=None,
+        help="Threads hashing passwords (default: --workers)",
+    )
+    parser.add_argument(
+        "--attribute-depth", type=int, default=2, help="Nesting depth of custom attributes"
+    )
+    parser.add_argument(
+        "--attribute-fanout",
+        type=int,
+        default=6,
+        help="Custom attribute values per nesting level, 0 to skip custom attributes",
+    )
+    parser.add_argument(
+        "--attribute-list-size",
+        type=int,
+        default=0,
+        help="Values of the list added to every nesting level of custom attributes",
+    )
+    parser.add_argument(
+        "--flatten",
+        action="store_true",
+        help="Only benchmark the flattening of custom attribute documents",
+    )
+    parser.add_argument(
+        "--documents", type=int, default=10_000, help="Number of documents flattened by --flatten"
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=5, help="Latency of every fake Descope response"
+    )
+    parser.add_argument(
+        "--rate-limit-fraction",
+        type=float,
+        default=0.0,
+        help="Fraction of fake Descope requests answered with a 429",
+    )
+    parser.add_argument(
+        "--retry-after", type=int, default=1, help="Retry-After of the injected 429s, in seconds"
+    )
+    parser.add_argument(
+        "--timeout-fraction",
+        type=float,
+        default=0.0,
+        help="Fraction of fake Descope requests that time out",
+    )
+    parser.add_argument(
+        "--client-timeout",
+        type=float,
+        default=2.0,
+        help="Timeout of SDK requests, injected timeouts stall a little longer than this",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    return parser
+
+
+def main():
+    """
+    Benchmark the migration offline, against a fake Descope management API and synthetic Firebase users.
+    """
+    args = build_parser().parse_args()
+    if args.flatten:
+        report = run_flatten_benchmark(args)
+        print("=================== Flatten Benchmark ==========================")
+        print(
+            f"{report['documents']} documents of {report['attributesPerDocument']} attributes"
+        )
+        for name in ("flatten_dict", "flatten_attributes"):
+            print(
+                f"  {name} {report[name]['microsecondsPerDocument']}us per document, "
+                f"peak allocated {report[name]['peakAllocatedKb']}KB"
+            )
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(report, file, indent=2)
+        return
+
+    report = run_benchmark(args)
+
+    print("=================== Migration Benchmark ========================")
+    print(f"Migrated {report['migratedUsers']}/{report['users']} users in {report['seconds']}s")
+    print(f"Throughput {report['usersPerSecond']} users/sec")
+    print(f"Per user latency from listing to result, p50 {report['latencyP50Ms']}ms, p99 {report['latencyP99Ms']}ms")
+    print(f"Requests per user {report['requestsPerUser']}")
+    for path, count in sorted(report["requestsByEndpoint"].items()):
+        print(f"  {path} {count}")
+    print(f"Retries {report['retries']} ({report['rateLimited']} rate limited)")
+    print("Seconds spent per stage, summed over workers")
+    for name, seconds in sorted(report["stageSeconds"].items(), key=lambda item: -item[1]):
+        print(f"  {name} {seconds:.3f}")
+    print(f"Peak RSS {report['peakRssMb']}MB")
+    if report["failedUsers"]:
+        print(f"Failed to migrate {report['failedUsers']} users")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
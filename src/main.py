@@ -1,9 +1,46 @@
 import os
 import sys
+import json
 from migration_utils import (
-    fetch_firebase_users,
+    DEFAULT_ANON_PASSWORD_ROUNDS,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_METRICS_INTERVAL,
+    DEFAULT_PLANNED_REQUEST_SECONDS,
+    DEFAULT_MAX_BUFFERED_PAGES,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_WORKERS,
+    CountedUsers,
+    DescopeUserIndex,
+    DryRunPlan,
+    FingerprintIndex,
+    FirebaseSnapshot,
+    MetricsReporter,
+    ResultSink,
+    MigrationJournal,
+    anon_passwords,
+    attribute_limits,
+    attribute_schema,
+    build_merge_plan,
+    configure_http_session,
+    configure_logging,
+    context,
+    discover_custom_attribute_schema,
+    iter_custom_attribute_documents,
+    iter_export_file_pages,
+    iter_descope_users,
+    iter_firebase_user_pages,
+    iter_firebase_user_pages_by_uid,
+    iter_firebase_users,
+    metrics,
+    parse_hash_params,
+    parse_since,
+    user_updated_since,
     process_users,
+    read_user_ids,
+    rate_limiter,
     set_custom_attribute_source,
+    verify_migration,
 )
 import argparse
 
@@ -19,8 +56,229 @@ def main():
         description="This is a program to assist you in the migration of your users, roles, permissions, and organizations to Descope."
     )
     parser.add_argument("--dry-run", action="store_true", help="Enable dry run mode")
+    parser.add_argument(
+        "--plan-file",
+        default=os.path.join("logs", "migration_plan.json"),
+        help="Where to write the migration plan of a dry run",
+    )
+    parser.add_argument(
+        "--planned-request-seconds",
+        type=float,
+        default=DEFAULT_PLANNED_REQUEST_SECONDS,
+        help="Expected duration of a Descope request, used by a dry run to project the migration time when there is no --rate-limit",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=DEFAULT_PAGE_SIZE,
+        help="Number of Firebase users to list per page (max 1000)",
+    )
+    parser.add_argument(
+        "--max-buffered-pages",
+        type=int,
+        default=DEFAULT_MAX_BUFFERED_PAGES,
+        help="Max number of fetched Firebase pages held in memory ahead of the migration",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of users to create in Descope per batch request",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of batches to migrate concurrently",
+    )
+    parser.add_argument(
+        "--transform-workers",
+        type=int,
+        default=0,
+        help="Number of processes flattening custom attributes (default: 0, flatten them in a thread)",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=None,
+        help="Number of batches whose passwords are hashed concurrently (default: --workers)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help="Max number of batches waiting in front of each migration stage (default: --workers)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="Max Descope requests per second shared by all workers (default: no limit until rate limited)",
+    )
+    parser.add_argument(
+        "--discover-schema",
+        action="store_true",
+        help="Scan all custom attributes and create the full attribute schema before migrating users",
+    )
+    parser.add_argument(
+        "--schema-report",
+        default=os.path.join("logs", "custom_attribute_schema.json"),
+        help="Where to write the custom attribute schema report of --discover-schema",
+    )
+    parser.add_argument(
+        "--journal",
+        default=os.path.join("logs", "migration_journal.sqlite"),
+        help="Where to keep the checkpoint journal of the migration's progress",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted migration from the last committed page of the journal",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=os.path.join("logs", "migrated_users.sqlite"),
+        help="Where to keep the fingerprints of migrated users, used by --delta",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only migrate users that are new or changed since they were last migrated",
+    )
+    parser.add_argument(
+        "--since",
+        help="Only consider users created, signed in or refreshed after this time (epoch ms or ISO 8601)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=None,
+        help=f"Max number of open connections to the Descope API (default: the larger of {DEFAULT_POOL_SIZE} and --workers)",
+    )
+    parser.add_argument(
+        "--no-keep-alive",
+        action="store_true",
+        help="Open a new connection to the Descope API for every request",
+    )
+    parser.add_argument(
+        "--import-file",
+        help="Migrate the users of a `firebase auth:export` JSON or CSV file instead of listing them from Firebase",
+    )
+    parser.add_argument(
+        "--import-workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing the --import-file (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--anon-password-rounds",
+        type=int,
+        default=DEFAULT_ANON_PASSWORD_ROUNDS,
+        help="bcrypt cost factor of the random passwords given to anonymous users",
+    )
+    parser.add_argument(
+        "--anon-password-workers",
+        type=int,
+        default=None,
+        help="Number of processes hashing anonymous user passwords ahead of time (default: number of CPUs, 0 to hash inline)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=os.path.join("logs", "migration_metrics.json"),
+        help="Where to periodically write the migration metrics as JSON",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=DEFAULT_METRICS_INTERVAL,
+        help="Seconds between progress lines and metrics file updates",
+    )
+    parser.add_argument(
+        "--prometheus-port",
+        type=int,
+        default=None,
+        help="Serve the migration metrics for Prometheus at http://127.0.0.1:<port>/metrics",
+    )
+    parser.add_argument(
+        "--attribute-max-depth",
+        type=int,
+        default=None,
+        help="Custom attribute maps nested deeper than this are migrated as a single JSON string attribute",
+    )
+    parser.add_argument(
+        "--attribute-max-keys",
+        type=int,
+        default=None,
+        help="Max number of custom attributes migrated per user, the attributes past it are dropped",
+    )
+    parser.add_argument(
+        "--attribute-max-value-bytes",
+        type=int,
+        default=None,
+        help="Custom attribute string values longer than this many bytes are truncated",
+    )
+    parser.add_argument(
+        "--snapshot-out",
+        default=None,
+        help="Save the Firebase users and custom attributes to this file first, then migrate from it",
+    )
+    parser.add_argument(
+        "--snapshot-in",
+        default=None,
+        help="Migrate from a file saved by --snapshot-out instead of reading Firebase",
+    )
+    parser.add_argument(
+        "--merge-duplicates",
+        action="store_true",
+        help="List all users once up front and merge the users sharing an email or phone, instead of failing on the collisions",
+    )
+    parser.add_argument(
+        "--merge-plan",
+        default=os.path.join("logs", "merge_plan.json"),
+        help="Where to write the groups of users merged by --merge-duplicates",
+    )
+    parser.add_argument(
+        "--results-file",
+        default=os.path.join("logs", "migration_results.jsonl"),
+        help="Where to write the outcome of every user, as JSON lines or as CSV if the path ends with .csv",
+    )
+    parser.add_argument(
+        "--uids-file",
+        default=None,
+        help="Only migrate the users whose UIDs are listed in this file, one per line, e.g. the missing users found by --verify",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Instead of migrating, compare the Descope users with the Firebase users and report the missing, extra and mismatched users",
+    )
+    parser.add_argument(
+        "--verify-report",
+        default=os.path.join("logs", "verify_report.json"),
+        help="Where to write the report of --verify",
+    )
+    parser.add_argument(
+        "--missing-users-file",
+        default=os.path.join("logs", "missing_users.txt"),
+        help="Where --verify writes the UIDs of the Firebase users missing in Descope, to pass to --uids-file",
+    )
+    parser.add_argument(
+        "--expected-users",
+        type=int,
+        default=None,
+        help="Number of users to migrate, e.g. from a dry run, used to estimate the time left",
+    )
 
     args = parser.parse_args()
+    if args.snapshot_in and args.snapshot_out:
+        parser.error("--snapshot-in and --snapshot-out can't be used together")
+
+    configure_logging()
+    if args.verify:
+        verify(args)
+        return
+    if not args.dry_run:
+        context.connect(firebase=not args.snapshot_in)
 
     hash_params_file_path = "creds/password-hash.txt"
 
@@ -34,89 +292,331 @@ def main():
     # If the file exists, proceed to parse the hash parameters
     hash_params = parse_hash_params(hash_params_file_path)
 
-    # Ask the user if they want to import custom attributes
-    import_custom_attributes = (
-        input("Do you want to import custom user attributes? (y/n): ").strip().lower()
-    )
+    snapshot = None
     attribute_source = None
+    if args.snapshot_in:
+        # The snapshot already holds the custom attributes, if they were captured
+        snapshot = FirebaseSnapshot(args.snapshot_in)
+        if snapshot.attribute_source:
+            attribute_source = "snapshot"
+        set_custom_attribute_source(attribute_source, snapshot)
+        print(
+            f"Migrating {snapshot.get_meta('users')} users from the snapshot {args.snapshot_in}, captured at {snapshot.get_meta('captured_at')}"
+        )
+    else:
+        # Ask the user if they want to import custom attributes
+        import_custom_attributes = (
+            input("Do you want to import custom user attributes? (y/n): ").strip().lower()
+        )
 
-    if import_custom_attributes == "y":
-        while attribute_source not in ["firestore", "realtime"]:
-            attribute_source = (
-                input("Enter the source of custom attributes (firestore or realtime): ")
-                .strip()
-                .lower()
-            )
-        set_custom_attribute_source(attribute_source)
+        if import_custom_attributes == "y":
+            while attribute_source not in ["firestore", "realtime"]:
+                attribute_source = (
+                    input("Enter the source of custom attributes (firestore or realtime): ")
+                    .strip()
+                    .lower()
+                )
+            set_custom_attribute_source(attribute_source)
 
     if args.dry_run:
         dry_run = True
 
-    # Fetch and Create Users
-    firebase_users = fetch_firebase_users()
+    rate_limiter.configure(rate=args.rate_limit)
+    attribute_limits.configure(
+        max_depth=args.attribute_max_depth,
+        max_keys=args.attribute_max_keys,
+        max_value_bytes=args.attribute_max_value_bytes,
+    )
+    anon_passwords.configure(
+        rounds=args.anon_password_rounds, workers=args.anon_password_workers
+    )
+    configure_http_session(
+        pool_size=args.pool_size or max(DEFAULT_POOL_SIZE, args.workers),
+        keep_alive=not args.no_keep_alive,
+    )
+
+    if args.snapshot_out:
+        print(f"Saving the Firebase users to the snapshot {args.snapshot_out}...")
+        snapshot = FirebaseSnapshot(args.snapshot_out)
+        if args.import_file:
+            snapshot_pages = iter_export_file_pages(args.import_file, workers=args.import_workers)
+        else:
+            snapshot_pages = iter_firebase_user_pages(
+                page_size=args.page_size, max_buffered_pages=args.max_buffered_pages
+            )
+        snapshot_users = snapshot.capture(snapshot_pages, attribute_source)
+        print(f"Saved {snapshot_users} users to the snapshot {args.snapshot_out}")
+        # Migrate from the snapshot, so this run reads the same input as a later --snapshot-in
+        if attribute_source:
+            attribute_source = "snapshot"
+        set_custom_attribute_source(attribute_source, snapshot)
+
+    if args.discover_schema and attribute_source:
+        print("Discovering the custom attribute schema of all users...")
+        schema_report = discover_custom_attribute_schema(
+            iter_custom_attribute_documents(page_size=args.page_size)
+        )
+        with open(args.schema_report, "w") as file:
+            json.dump(schema_report.to_dict(), file, indent=2)
+        print(
+            f"Found {len(schema_report.attribute_types)} custom attributes in {schema_report.documents} documents. Report written to {args.schema_report}"
+        )
+        if not dry_run:
+            attribute_schema.freeze(
+                {
+                    "freshlyMigrated": "Boolean",
+                    "UUID": "String",
+                    **schema_report.attribute_types,
+                }
+            )
+
+    journal = None
+    fingerprints = None
+    page_token = None
+    if not dry_run:
+        fingerprints = FingerprintIndex(args.state_file)
+        journal = MigrationJournal(args.journal)
+        if args.resume:
+            page_token = journal.resume_page_token()
+            journal.restore_anon_counter()
+            print(f"Resuming migration from the journal {args.journal}")
+        else:
+            journal.reset()
+
+    user_filter = None
+    if args.since:
+        since_ms = parse_since(args.since)
+        user_filter = lambda user: user_updated_since(user, since_ms)
+
+    user_ids = None
+    if args.uids_file:
+        user_ids = read_user_ids(args.uids_file)
+        print(f"Migrating only the {len(user_ids)} users listed in {args.uids_file}")
+        if snapshot is not None or args.import_file:
+            wanted_user_ids = set(user_ids)
+            since_filter = user_filter
+            user_filter = lambda user: user.uid in wanted_user_ids and (
+                since_filter is None or since_filter(user)
+            )
+
+    pages = None
+    if snapshot is not None:
+        pages = snapshot.iter_pages(
+            start_offset=int(page_token or 0), page_size=args.page_size
+        )
+    elif args.import_file:
+        pages = iter_export_file_pages(
+            args.import_file,
+            start_offset=int(page_token or 0),
+            workers=args.import_workers,
+        )
+    elif user_ids is not None:
+        # Look the users up by UID instead of listing every Firebase user
+        pages = iter_firebase_user_pages_by_uid(user_ids)
+
+    merge_plan = None
+    if args.merge_duplicates:
+        print("Looking for users sharing an email or phone...")
+        if snapshot is not None:
+            all_pages = snapshot.iter_pages(page_size=args.page_size)
+        elif args.import_file:
+            all_pages = iter_export_file_pages(args.import_file, workers=args.import_workers)
+        else:
+            all_pages = iter_firebase_user_pages(
+                page_size=args.page_size, max_buffered_pages=args.max_buffered_pages
+            )
+        merge_plan = build_merge_plan(iter_firebase_users(pages=all_pages))
+        with open(args.merge_plan, "w") as file:
+            json.dump(merge_plan.to_dict(), file, indent=2)
+        print(
+            f"Found {len(merge_plan.groups)} groups of users sharing an email or phone, {merge_plan.merged_users} users will be merged. Plan written to {args.merge_plan}"
+        )
+
+    # Stream and Create Users
+    firebase_users = CountedUsers(
+        iter_firebase_users(
+            journal=journal,
+            user_filter=user_filter,
+            pages=pages,
+            page_token=page_token,
+            page_size=args.page_size,
+            max_buffered_pages=args.max_buffered_pages,
+        )
+    )
+    reporter = None
+    result_sink = None
+    plan = None
+    if dry_run:
+        plan = DryRunPlan(args.batch_size)
+    else:
+        result_sink = ResultSink(args.results_file)
+        metrics.start(expected_users=args.expected_users)
+        reporter = MetricsReporter(
+            metrics_file=args.metrics_file,
+            interval=args.metrics_interval,
+            prometheus_port=args.prometheus_port,
+        ).start()
+    users = merge_plan.apply(firebase_users) if merge_plan else firebase_users
     (
         failed_users,
         successful_migrated_users,
         merged_users,
         disabled_users_mismatch,
-    ) = process_users(firebase_users, hash_params, dry_run)
+    ) = process_users(
+        users,
+        hash_params,
+        dry_run,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        journal=journal,
+        fingerprints=fingerprints,
+        delta=args.delta,
+        result_sink=result_sink,
+        plan=plan,
+        transform_workers=args.transform_workers,
+        queue_size=args.queue_size,
+        hash_workers=args.hash_workers,
+    )
+    if reporter is not None:
+        reporter.stop()
+    if result_sink is not None:
+        result_sink.close()
+    if journal is not None:
+        journal.close()
+    if fingerprints is not None:
+        fingerprints.close()
+    anon_passwords.close()
+    if snapshot is not None:
+        snapshot.close()
+
+    if dry_run:
+        plan_summary = plan.to_dict(
+            rate_limit=args.rate_limit,
+            workers=args.workers,
+            request_seconds=args.planned_request_seconds,
+        )
+        with open(args.plan_file, "w") as file:
+            json.dump(plan_summary, file, indent=2)
+        print("=================== Migration Plan =============================")
+        users_by_kind = plan_summary["usersByKind"]
+        print(
+            f"Users with a password {users_by_kind['password']}, anonymous {users_by_kind['anonymous']}, passwordless {users_by_kind['passwordless']}"
+        )
+        print(f"Disabled users {plan_summary['disabledUsers']}")
+        if plan_summary["mergedUsers"]:
+            print(f"Users merged into another user {plan_summary['mergedUsers']}")
+        if plan_summary["failedUsers"]:
+            print(f"Users that failed to map {plan_summary['failedUsers']}")
+        print("Descope requests:")
+        for endpoint, count in plan_summary["requests"].items():
+            print(f"  {endpoint} {count}")
+        if plan_summary["attributeRequestsUpperBound"]:
+            print(
+                "  The existing custom attributes couldn't be read from Descope, so customattribute/create is an upper bound"
+            )
+        print(
+            f"Custom attributes {len(plan_summary['attributeSchema'])}, with conflicting types {len(plan_summary['attributeTypeConflicts'])}"
+        )
+        for payload in plan_summary["largestAttributePayloads"][:3]:
+            print(f"  Largest custom attributes: {payload['uid']} {payload['bytes']} bytes")
+        print(
+            f"Projected migration time {plan_summary['projectedSeconds'] / 60:.1f} minutes (this dry run took {plan_summary['dryRunSeconds'] / 60:.1f} minutes)"
+        )
+        print(f"Full plan written to {args.plan_file}")
 
     if dry_run == False:
         print("=================== User Migration =============================")
-        print(f"Firebase Users found via Admin SDK {len(firebase_users)}")
+        print(f"Firebase Users found via Admin SDK {firebase_users.count}")
+        if args.delta:
+            print(f"Skipped unchanged users {fingerprints.unchanged_users}")
         print(f"Successfully migrated {successful_migrated_users} users")
         print(f"Successfully merged {merged_users} users")
-        if len(disabled_users_mismatch) != 0:
+        for warning_code, count in sorted(result_sink.warnings_by_code.items()):
+            print(f"  Migrated with warning {warning_code}: {count}")
+        if disabled_users_mismatch.total != 0:
             print(
-                f"Users migrated, but disabled due to one of the merged accounts being disabled {len(disabled_users_mismatch)}"
+                f"Users migrated, but disabled due to one of the merged accounts being disabled {disabled_users_mismatch.total}"
             )
             print(
-                f"Users disabled due to one of the merged accounts being disabled {disabled_users_mismatch}"
+                f"Users disabled due to one of the merged accounts being disabled {list(disabled_users_mismatch)}"
             )
-        if len(failed_users) != 0:
-            print(f"Failed to migrate {len(failed_users)}")
-            print(f"Users which failed to migrate:")
-            for failed_user in failed_users:
+        if failed_users.total != 0:
+            print(f"Failed to migrate {failed_users.total}")
+            for stage, count in sorted(result_sink.failures_by_stage.items()):
+                print(f"  Failed at {stage}: {count}")
+            for error_code, count in sorted(
+                result_sink.failures_by_error_code.items(), key=lambda item: -item[1]
+            ):
+                print(f"  Error {error_code}: {count}")
+            print(f"First users which failed to migrate:")
+            for failed_user in failed_users[:10]:
                 print(failed_user)
         print(
             f"Created users within Descope {successful_migrated_users - merged_users}"
         )
+        print(f"The outcome of every user was written to {args.results_file}")
 
 
-def parse_hash_params(hash_params_file_path):
+def verify(args):
     """
-    Parse the hash parameters from the given password-hash.txt file.
+    Compare the Descope users with the Firebase users they were migrated from, and report the
+    missing, extra and mismatched users.
     """
-    hash_params = {}
-    try:
-        with open(hash_params_file_path, "r") as file:
-            for line in file:
-                line = line.strip()
-                if line.startswith("algorithm:"):
-                    hash_params["algorithm"] = line.split(":", 1)[1].strip().strip(",")
-                elif line.startswith("base64_signer_key:"):
-                    hash_params["signer_key"] = line.split(":", 1)[1].strip().strip(",")
-                elif line.startswith("base64_salt_separator:"):
-                    hash_params["salt_separator"] = (
-                        line.split(":", 1)[1].strip().strip(",")
-                    )
-                elif line.startswith("rounds:"):
-                    # Added strip(',') to remove any trailing commas
-                    hash_params["rounds"] = int(
-                        line.split(":", 1)[1].strip().strip(",")
-                    )
-                elif line.startswith("mem_cost:"):
-                    # Added strip(',') to remove any trailing commas
-                    hash_params["mem_cost"] = int(
-                        line.split(":", 1)[1].strip().strip(",")
-                    )
-    except FileNotFoundError:
-        print(f"File not found: {hash_params_file_path}")
-        exit(1)
-    except ValueError as e:
-        print(f"Error parsing hash parameters: {e}")
-        exit(1)
-    return hash_params
+    context.connect(firebase=not (args.snapshot_in or args.import_file))
+    rate_limiter.configure(rate=args.rate_limit)
+    configure_http_session(
+        pool_size=args.pool_size or DEFAULT_POOL_SIZE,
+        keep_alive=not args.no_keep_alive,
+    )
+    snapshot = FirebaseSnapshot(args.snapshot_in) if args.snapshot_in else None
+
+    def firebase_pages():
+        if snapshot is not None:
+            return snapshot.iter_pages(page_size=args.page_size)
+        if args.import_file:
+            return iter_export_file_pages(args.import_file, workers=args.import_workers)
+        return iter_firebase_user_pages(
+            page_size=args.page_size, max_buffered_pages=args.max_buffered_pages
+        )
+
+    print("Loading the Descope users...")
+    index = DescopeUserIndex(os.path.join("logs", "descope_users.sqlite"))
+    index.add(iter_descope_users())
+    print(f"Loaded {index.users} Descope users, comparing them with the Firebase users...")
+
+    firebase_users = iter_firebase_users(pages=firebase_pages())
+    if args.merge_duplicates:
+        # Users merged into another user are expected to share its Descope user
+        merge_plan = build_merge_plan(iter_firebase_users(pages=firebase_pages()))
+        firebase_users = merge_plan.apply(firebase_users)
+    with open(args.missing_users_file, "w") as missing_file:
+        report = verify_migration(firebase_users, index, missing_file)
+    summary = report.to_dict(index)
+    with open(args.verify_report, "w") as file:
+        json.dump(summary, file, indent=2)
+    index.close()
+    if snapshot is not None:
+        snapshot.close()
+
+    print("=================== Migration Verification =====================")
+    print(f"Descope users {summary['descopeUsers']}, Firebase users {summary['firebaseUsers']}")
+    print(f"Matching users {summary['matchedUsers']}")
+    if summary["mergedUsers"]:
+        print(f"Users merged into another user {summary['mergedUsers']}")
+    print(f"Missing in Descope {summary['missingUsers']}")
+    if summary["missingUsers"]:
+        print(
+            f"  Their UIDs were written to {args.missing_users_file}, migrate them with --uids-file {args.missing_users_file}"
+        )
+    print(f"In Descope but not in Firebase {summary['extraUsers']}")
+    if summary["unlinkedDescopeUsers"]:
+        print(f"  Descope users without a UUID {summary['unlinkedDescopeUsers']}")
+    if summary["duplicateDescopeUsers"]:
+        print(f"  Descope users sharing a UUID {summary['duplicateDescopeUsers']}")
+    print(f"Users with different fields {summary['mismatchedUsers']}")
+    for field, count in summary["mismatchedFields"].items():
+        print(f"  {field}: {count}")
+    print(f"Full report written to {args.verify_report}")
 
 
 if __name__ == "__main__":
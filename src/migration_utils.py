@@ -1,521 +1,4604 @@
+import array
+import atexit
+import base64
+import copy
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import logging
+import logging.handlers
 import time
 import json
 import bcrypt
+import csv
+import hashlib
+import heapq
+import io
+import mmap
+import multiprocessing
+import pickle
+import re
+import queue
+import random
+import sqlite3
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from collections.abc import MutableMapping
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections.abc import Mapping, MutableMapping
 
 from descope import (
+    API_RATE_LIMIT_RETRY_AFTER_HEADER,
     AuthException,
     DescopeClient,
+    RateLimitException,
     UserPassword,
     UserPasswordFirebase,
     UserPasswordBcrypt,
     UserObj,
 )
 
+import httpx
+
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import auth
-from firebase_admin import db
-from firebase_admin import firestore
-
-log_directory = "logs"
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-# datetime object containing current date and time
-now = datetime.now()
-
-dt_string = now.strftime("%d_%m_%Y_%H:%M:%S")
-logging_file_name = os.path.join(log_directory, f"migration_log_{dt_string}.log")
-logging.basicConfig(
-    filename=logging_file_name,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+from google.api_core.exceptions import GoogleAPIError
+
+DEFAULT_LOG_DIRECTORY = "logs"
+DEFAULT_FIREBASE_CREDENTIALS = os.path.join("creds", "firebase-certs.json")
+DESCOPE_API_URL = "https://api.descope.com"
+
+
+def configure_logging(log_directory=DEFAULT_LOG_DIRECTORY):
+    """
+    Log the migration to a new file named after the current date and time.
+
+    Records are handed to a QueueListener which writes them from a background thread, so logging
+    a line for every user doesn't block the workers on file I/O. The listener is flushed at exit.
+
+    Args:
+    - log_directory (str): The directory of the log file, created if missing
+
+    Returns:
+    - str: The path of the log file
+    """
+    if not os.path.exists(log_directory):
+        os.makedirs(log_directory)
+
+    # datetime object containing current date and time
+    now = datetime.now()
+
+    dt_string = now.strftime("%d_%m_%Y_%H:%M:%S")
+    logging_file_name = os.path.join(log_directory, f"migration_log_{dt_string}.log")
+    file_handler = logging.FileHandler(logging_file_name)
+    file_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(
+        level=logging.INFO,
+        # The queue handler only renders the message, the file handler adds time and level
+        format="%(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+    )
+    return logging_file_name
+
+
+class MigrationContext:
+    """
+    Creates the Descope client, the Firebase app and the Firebase database handles on first use.
+
+    Nothing is read or connected when the context is created, so importing this module has no side
+    effects and each process only pays for the clients it actually uses. Settings which are not
+    passed in are read from the environment and the .env file. A context used in a forked child
+    process creates its own clients instead of sharing the parent's connections.
+    """
+
+    ENVIRONMENT_VARIABLES = {
+        "descope_project_id": "DESCOPE_PROJECT_ID",
+        "descope_management_key": "DESCOPE_MANAGEMENT_KEY",
+        "descope_base_url": "DESCOPE_BASE_URL",
+        "firebase_db_url": "FIREBASE_DB_URL",
+        "firebase_credentials": "FIREBASE_CREDENTIALS",
+    }
+
+    def __init__(
+        self,
+        descope_project_id=None,
+        descope_management_key=None,
+        descope_base_url=None,
+        descope_timeout_seconds=None,
+        firebase_db_url=None,
+        firebase_credentials=None,
+    ):
+        self.settings = {
+            "descope_project_id": descope_project_id,
+            "descope_management_key": descope_management_key,
+            "descope_base_url": descope_base_url,
+            "descope_timeout_seconds": descope_timeout_seconds,
+            "firebase_db_url": firebase_db_url,
+            "firebase_credentials": firebase_credentials,
+        }
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every client, so they are created again on next use
+        """
+        self.pid = os.getpid()
+        self.environment_loaded = False
+        self._descope_client = None
+        self._firebase_app = None
+        self._firestore_client = None
+
+    def setting(self, name):
+        """
+        Return a setting passed to the context, or else read it from the environment
+        """
+        value = self.settings.get(name)
+        if value is not None or name not in self.ENVIRONMENT_VARIABLES:
+            return value
+        with self.lock:
+            if not self.environment_loaded:
+                """Load and read environment variables from .env file"""
+                load_dotenv()
+                self.environment_loaded = True
+        return os.getenv(self.ENVIRONMENT_VARIABLES[name])
+
+    def check_process(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    @property
+    def descope_api_url(self):
+        return (self.setting("descope_base_url") or DESCOPE_API_URL).rstrip("/")
+
+    @property
+    def has_descope_credentials(self):
+        return bool(
+            self.setting("descope_project_id") and self.setting("descope_management_key")
+        )
+
+    @property
+    def management_headers(self):
+        project_id = self.setting("descope_project_id")
+        management_key = self.setting("descope_management_key")
+        return {
+            "Authorization": f"Bearer {project_id}:{management_key}",
+            "Content-Type": "application/json",
+        }
+
+    @property
+    def descope_client(self):
+        with self.lock:
+            self.check_process()
+            if self._descope_client is None:
+                kwargs = {}
+                if self.setting("descope_base_url"):
+                    kwargs["base_url"] = self.setting("descope_base_url")
+                if self.setting("descope_timeout_seconds"):
+                    kwargs["timeout_seconds"] = self.setting("descope_timeout_seconds")
+                self._descope_client = DescopeClient(
+                    project_id=self.setting("descope_project_id"),
+                    management_key=self.setting("descope_management_key"),
+                    **kwargs,
+                )
+            return self._descope_client
+
+    @property
+    def firebase_app(self):
+        with self.lock:
+            self.check_process()
+            if self._firebase_app is None:
+                try:
+                    self._firebase_app = firebase_admin.get_app()
+                except ValueError:
+                    cred = credentials.Certificate(
+                        self.setting("firebase_credentials")
+                        or os.path.join(os.getcwd(), DEFAULT_FIREBASE_CREDENTIALS)
+                    )
+                    options = {}
+                    if self.setting("firebase_db_url"):
+                        options["databaseURL"] = self.setting("firebase_db_url")
+                    self._firebase_app = firebase_admin.initialize_app(cred, options or None)
+            return self._firebase_app
+
+    @property
+    def firestore_client(self):
+        with self.lock:
+            self.check_process()
+            if self._firestore_client is None:
+                from firebase_admin import firestore
+
+                self._firestore_client = firestore.client(app=self.firebase_app)
+            return self._firestore_client
+
+    def database_reference(self, path):
+        """
+        Return a reference to the given path of the Firebase Realtime Database
+        """
+        from firebase_admin import db
+
+        return db.reference(path, app=self.firebase_app)
+
+    def connect(self, descope=True, firebase=True):
+        """
+        Create the clients up front, exiting if the Descope credentials are rejected
+        """
+        if descope:
+            try:
+                self.descope_client
+            except AuthException as error:
+                logging.error(f"Failed to initialize Descope Client: {error}")
+                sys.exit()
+        if firebase:
+            self.firebase_app
+
+
+class ContextAttribute:
+    """
+    Stands in for an attribute of the current migration context, which is only created on first use
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        # Introspection, e.g. by copy or mock, mustn't create the client
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        return getattr(getattr(context, self.name), attribute)
+
+
+context = MigrationContext()
+descope_client = ContextAttribute("descope_client")
+
+
+def set_migration_context(new_context):
+    """
+    Use the given MigrationContext for every following Firebase and Descope request
+    """
+    global context
+    context = new_context
+
+
+def init_worker_process(settings):
+    """
+    Initializer of worker processes, giving each its own context with the parent's settings
+    """
+    set_migration_context(MigrationContext(**settings))
+
+
+attribute_source = None
+attribute_snapshot = None
+
+
+### Begin Metrics
+
+DEFAULT_METRICS_INTERVAL = 5.0
+THROUGHPUT_WINDOW_SECONDS = 30.0
+
+
+class MigrationMetrics:
+    """
+    Timings of each stage of the migration, and counters of users, requests and retries.
+
+    Stages are timed with stage(), e.g. `with metrics.stage("invite_batch"):`, from any thread.
+    Throughput is measured over the last THROUGHPUT_WINDOW_SECONDS, and the ETA is only known when
+    the number of users to migrate was given to start().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue_depths = None
+        self.start()
+
+    def start(self, expected_users=None):
+        with self.lock:
+            self.started_at = time.monotonic()
+            self.expected_users = expected_users
+            # stage name -> [calls, total seconds, max seconds]
+            self.stages = {}
+            self.requests = {}
+            self.retries = {}
+            self.rate_limited = {}
+            self.users = {"migrated": 0, "failed": 0, "skipped": 0}
+            self.samples = deque([(self.started_at, 0)])
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+
+    def count_request(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def count_retry(self, endpoint, rate_limited=False):
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+            if rate_limited:
+                self.rate_limited[endpoint] = self.rate_limited.get(endpoint, 0) + 1
+
+    def count_users(self, migrated=0, failed=0, skipped=0):
+        with self.lock:
+            self.users["migrated"] += migrated
+            self.users["failed"] += failed
+            self.users["skipped"] += skipped
+            now = time.monotonic()
+            self.samples.append((now, self.processed_users()))
+            while len(self.samples) > 2 and self.samples[1][0] < now - THROUGHPUT_WINDOW_SECONDS:
+                self.samples.popleft()
+
+    def watch_queues(self, queue_depths):
+        """
+        Report the depth of the queues between the stages of a pipeline
+
+        Args:
+        - queue_depths (callable): Returns the number of items waiting in each queue, by name
+        """
+        self.queue_depths = queue_depths
+
+    def processed_users(self):
+        return self.users["migrated"] + self.users["failed"] + self.users["skipped"]
+
+    def throughput(self):
+        """
+        Return the users processed per second over the last THROUGHPUT_WINDOW_SECONDS
+        """
+        with self.lock:
+            (first_time, first_count) = self.samples[0]
+            (last_time, last_count) = self.samples[-1]
+        if last_time <= first_time:
+            return 0.0
+        return (last_count - first_count) / (last_time - first_time)
+
+    def eta(self):
+        """
+        Return the estimated seconds left, or None when unknown
+        """
+        throughput = self.throughput()
+        with self.lock:
+            if not self.expected_users or not throughput:
+                return None
+            remaining = max(0, self.expected_users - self.processed_users())
+        return remaining / throughput
+
+    def snapshot(self):
+        """
+        Returns:
+        - dict: Every metric, as written to the JSON metrics file
+        """
+        throughput = self.throughput()
+        eta = self.eta()
+        queue_depths = self.queue_depths() if self.queue_depths is not None else {}
+        with self.lock:
+            return {
+                "elapsedSeconds": round(time.monotonic() - self.started_at, 3),
+                "users": dict(self.users),
+                "expectedUsers": self.expected_users,
+                "usersPerSecond": round(throughput, 2),
+                "etaSeconds": round(eta) if eta is not None else None,
+                "stages": {
+                    name: {
+                        "calls": calls,
+                        "totalSeconds": round(total, 6),
+                        "averageSeconds": round(total / calls, 6) if calls else 0.0,
+                        "maxSeconds": round(slowest, 6),
+                    }
+                    for name, (calls, total, slowest) in self.stages.items()
+                },
+                "requests": dict(self.requests),
+                "retries": dict(self.retries),
+                "rateLimited": dict(self.rate_limited),
+                "queueDepths": queue_depths,
+            }
+
+    def progress_line(self):
+        snapshot = self.snapshot()
+        users = snapshot["users"]
+        line = (
+            f"Migrated {users['migrated']} users, {users['failed']} failed, "
+            f"{users['skipped']} skipped | {snapshot['usersPerSecond']} users/sec"
+        )
+        if snapshot["etaSeconds"] is not None:
+            minutes, seconds = divmod(snapshot["etaSeconds"], 60)
+            line += f" | ETA {minutes // 60}h{minutes % 60:02d}m{seconds:02d}s"
+        # The stage the migration spends the most time in is the likely bottleneck
+        stages = snapshot["stages"]
+        if stages:
+            slowest = max(stages, key=lambda name: stages[name]["totalSeconds"])
+            line += f" | most time in {slowest}"
+        if any(snapshot["queueDepths"].values()):
+            queued = " ".join(f"{name}={depth}" for name, depth in snapshot["queueDepths"].items())
+            line += f" | queued {queued}"
+        retries = sum(snapshot["retries"].values())
+        if retries:
+            line += f" | {retries} retries ({sum(snapshot['rateLimited'].values())} rate limited)"
+        return line
+
+    def to_prometheus(self):
+        """
+        Returns:
+        - str: Every metric in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric(
+            "firebase_migration_users_total",
+            "counter",
+            "Users processed, by outcome",
+            [({"outcome": outcome}, count) for outcome, count in snapshot["users"].items()],
+        )
+        metric(
+            "firebase_migration_stage_seconds_total",
+            "counter",
+            "Time spent in each stage of the migration",
+            [({"stage": name}, stage["totalSeconds"]) for name, stage in snapshot["stages"].items()],
+        )
+        metric(
+            "firebase_migration_stage_calls_total",
+            "counter",
+            "Times each stage of the migration ran",
+            [({"stage": name}, stage["calls"]) for name, stage in snapshot["stages"].items()],
+        )
+        for name, key, help_text in (
+            ("firebase_migration_requests_total", "requests", "Descope requests sent, by endpoint"),
+            ("firebase_migration_retries_total", "retries", "Descope requests retried, by endpoint"),
+            (
+                "firebase_migration_rate_limited_total",
+                "rateLimited",
+                "Descope requests rate limited, by endpoint",
+            ),
+        ):
+            metric(
+                name,
+                "counter",
+                help_text,
+                [({"endpoint": endpoint}, count) for endpoint, count in snapshot[key].items()],
+            )
+        metric(
+            "firebase_migration_users_per_second",
+            "gauge",
+            "Users processed per second, recently",
+            [({}, snapshot["usersPerSecond"])],
+        )
+        if snapshot["queueDepths"]:
+            metric(
+                "firebase_migration_queue_depth",
+                "gauge",
+                "Items waiting in the queue in front of each pipeline stage",
+                [({"queue": name}, depth) for name, depth in snapshot["queueDepths"].items()],
+            )
+        if snapshot["etaSeconds"] is not None:
+            metric(
+                "firebase_migration_eta_seconds",
+                "gauge",
+                "Estimated seconds until every expected user is processed",
+                [({}, snapshot["etaSeconds"])],
+            )
+        return "\n".join(lines) + "\n"
+
+
+metrics = MigrationMetrics()
+
+
+class MetricsReporter:
+    """
+    Reports the metrics while the migration runs: a progress line on stdout and a JSON metrics file
+    every interval seconds, and optionally a Prometheus endpoint at http://<host>:<port>/metrics.
+    """
+
+    def __init__(
+        self,
+        metrics_file=None,
+        interval=DEFAULT_METRICS_INTERVAL,
+        prometheus_port=None,
+        prometheus_host="127.0.0.1",
+        show_progress=True,
+    ):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.prometheus_port = prometheus_port
+        self.prometheus_host = prometheus_host
+        self.show_progress = show_progress
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        if self.prometheus_port is not None:
+            self.server = ThreadingHTTPServer(
+                (self.prometheus_host, self.prometheus_port), PrometheusHandler
+            )
+            self.server.daemon_threads = True
+            threading.Thread(
+                target=self.server.serve_forever, name="metrics-endpoint", daemon=True
+            ).start()
+        self.thread = threading.Thread(target=self.run, name="metrics-reporter", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        if self.show_progress:
+            print(metrics.progress_line())
+        if self.metrics_file:
+            temporary_file = f"{self.metrics_file}.tmp"
+            with open(temporary_file, "w") as file:
+                json.dump(metrics.snapshot(), file, indent=2)
+            os.replace(temporary_file, self.metrics_file)
+
+    def stop(self):
+        """
+        Stop reporting, after a last report of the final metrics
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+### End Metrics
+
+
+class AnonLoginId:
+  """
+  Class used to create anonymous user emails
+  """
+  def __init__(self):
+    self.anon_counter = 0
+    self.lock = threading.Lock()
+
+  def make_anon_login_id(self):
+    with self.lock:
+      login_id = f"anon_user_{self.anon_counter}@anonymous.com"
+      self.anon_counter += 1
+    return login_id
+
+anon = AnonLoginId()
+
+DEFAULT_ANON_PASSWORD_ROUNDS = 12
+ANON_PASSWORD_HASHES_PER_TASK = 16
+
+
+def make_anon_password_hashes(count, rounds):
+    """
+    Hash count random passwords with bcrypt, used as the unknown passwords of anonymous users
+    """
+    return [
+        bcrypt.hashpw(os.urandom(12), bcrypt.gensalt(rounds)).decode("utf-8")
+        for _ in range(count)
+    ]
+
+
+class AnonPasswordPool:
+    """
+    Bcrypt hashes of random passwords for anonymous users, hashed ahead of demand by a process pool.
+
+    Hashing takes tens to hundreds of milliseconds of CPU, so the pool keeps twice as many tasks as
+    workers in flight and the migration only waits when it consumes hashes faster than all cores
+    produce them. The plain passwords are never kept, so every hash is only handed out once.
+    """
+
+    def __init__(self, rounds=DEFAULT_ANON_PASSWORD_ROUNDS, workers=None):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.configure(rounds, workers)
+
+    def configure(self, rounds=DEFAULT_ANON_PASSWORD_ROUNDS, workers=None):
+        """
+        Args:
+        - rounds (int): The bcrypt cost factor, between 4 and 31
+        - workers (int): The number of hashing processes, defaults to the number of CPUs. With 0,
+          passwords are hashed by the calling thread when needed.
+        """
+        if not 4 <= rounds <= 31:
+            raise ValueError(f"bcrypt rounds must be between 4 and 31, got {rounds}")
+        self.close()
+        with self.lock:
+            self.rounds = rounds
+            self.workers = (os.cpu_count() or 1) if workers is None else workers
+            self.hashes = deque()
+            self.pending = deque()
+
+    def take(self):
+        """
+        Return the bcrypt hash of a new random password
+        """
+        if not self.workers:
+            return make_anon_password_hashes(1, self.rounds)[0]
+        with self.lock:
+            if self.executor is None:
+                # Spawned workers don't inherit the locks of the migration's threads
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            while len(self.pending) < self.workers * 2:
+                self.pending.append(
+                    self.executor.submit(
+                        make_anon_password_hashes, ANON_PASSWORD_HASHES_PER_TASK, self.rounds
+                    )
+                )
+            if self.hashes:
+                return self.hashes.popleft()
+            future = self.pending.popleft()
+        hashes = future.result()
+        with self.lock:
+            self.hashes.extend(hashes[1:])
+        return hashes[0]
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+anon_passwords = AnonPasswordPool()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every migration worker.
+
+    Each request to Descope takes a token first. When any worker is rate limited, backoff() pauses
+    the whole bucket so all workers wait together instead of each one retrying on its own.
+
+    The rate adapts to Descope's limit: it is halved every time a request is rate limited and grows
+    again by about one request per second, every second, while requests succeed, up to max_rate.
+    Without a configured rate the bucket is unlimited until the first rate limit.
+    """
+
+    def __init__(self, rate=None, burst=None, min_rate=1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.tokens = self.capacity()
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.window_started_at = self.updated_at
+        self.window_requests = 0
+        self.observed_rate = 0.0
+        self.lock = threading.Lock()
+
+    def capacity(self):
+        return self.burst or max(1.0, self.rate or 1.0)
+
+    def configure(self, rate=None, burst=None):
+        with self.lock:
+            self.max_rate = rate
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, self.capacity())
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait_time = self.paused_until - now
+                if wait_time <= 0:
+                    if not self.rate:
+                        self.count_request(now)
+                        return
+                    self.tokens = min(
+                        self.capacity(), self.tokens + (now - self.updated_at) * self.rate
+                    )
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.count_request(now)
+                        return
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def count_request(self, now):
+        # Keep track of the actual request rate, it is the starting point once a limit is hit
+        self.window_requests += 1
+        elapsed = now - self.window_started_at
+        if elapsed >= 1:
+            self.observed_rate = self.window_requests / elapsed
+            self.window_started_at = now
+            self.window_requests = 0
+
+    def backoff(self, wait_time):
+        """
+        Pause all workers for wait_time seconds.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + wait_time)
+            self.tokens = 0
+
+    def on_rate_limited(self):
+        """
+        Multiplicatively decrease the rate after Descope rate limited a request.
+        """
+        with self.lock:
+            current_rate = self.rate or self.observed_rate or self.min_rate * 2
+            self.rate = max(self.min_rate, current_rate / 2)
+            self.tokens = min(self.tokens, self.capacity())
+            logging.info(f"Lowering the Descope request rate to {self.rate:.1f} requests per second")
+
+    def on_success(self):
+        """
+        Additively increase the rate after a successful request.
+        """
+        with self.lock:
+            if not self.rate:
+                return
+            self.rate += 1 / self.rate
+            if self.max_rate:
+                self.rate = min(self.rate, self.max_rate)
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter whose bucket lives in shared memory, so migrations running in several processes
+    into the same Descope project share a single rate budget and back off together.
+
+    It is passed to the processes when they are started. time.monotonic() is system wide, so the
+    timestamps of the bucket can be compared across processes. Unset values are stored as 0, which
+    the bucket treats the same as None.
+    """
+
+    FIELDS = (
+        "max_rate",
+        "rate",
+        "burst",
+        "min_rate",
+        "tokens",
+        "updated_at",
+        "paused_until",
+        "window_started_at",
+        "window_requests",
+        "observed_rate",
+    )
+
+    def __init__(self, rate=None, burst=None, min_rate=1.0):
+        mp_context = multiprocessing.get_context("spawn")
+        self.state = mp_context.Array("d", len(self.FIELDS), lock=False)
+        super().__init__(rate, burst, min_rate)
+        self.lock = mp_context.Lock()
+
+
+def shared_field(index):
+    return property(
+        lambda self: self.state[index],
+        lambda self, value: self.state.__setitem__(index, value or 0.0),
+    )
+
+
+for index, name in enumerate(SharedRateLimiter.FIELDS):
+    setattr(SharedRateLimiter, name, shared_field(index))
+
+
+rate_limiter = RateLimiter()
+
+
+def set_rate_limiter(new_rate_limiter):
+    """
+    Use the given RateLimiter for every following Descope request, e.g. a SharedRateLimiter
+    """
+    global rate_limiter
+    rate_limiter = new_rate_limiter
+
+DEFAULT_POOL_SIZE = 10
+http_session = None
+http_session_lock = threading.Lock()
+
+
+def configure_http_session(pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+    """
+    Create the pooled HTTP session used for raw Descope management API requests.
+
+    Connections are kept alive and reused across requests, and the session is shared by all workers.
+    When more than pool_size requests are in flight, callers wait for a free connection.
+
+    Args:
+    - pool_size (int): The max number of connections kept open to each host
+    - keep_alive (bool): Reuse connections between requests
+    """
+    global http_session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    with http_session_lock:
+        previous_session, http_session = http_session, session
+    if previous_session is not None:
+        previous_session.close()
+    return session
+
+
+def get_http_session():
+    """
+    Return the shared HTTP session, creating it with the default pool size on first use.
+    """
+    with http_session_lock:
+        session = http_session
+    return session or configure_http_session()
+
+
+class RetryGiveUp(Exception):
+    """
+    Raised by RetryEngine when a request should not be retried again
+    """
+
+
+class EndpointState:
+    """
+    Retry budget and circuit breaker state of a single Descope endpoint
+    """
+
+    def __init__(self, budget):
+        self.retry_tokens = budget
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_timeout = 0.0
+        self.probe_in_flight = False
+
+
+class RetryEngine:
+    """
+    Retry policy shared by the raw and SDK requests to Descope.
+
+    - Waits follow the Retry-After of a rate limit, otherwise decorrelated jitter between base_delay and
+      three times the previous wait, capped at max_delay.
+    - Each endpoint has a retry budget: every request earns budget_ratio of a retry, every retry spends
+      one, so retries can't multiply the load on an endpoint that keeps failing. Rate limited requests
+      are retried for as long as Descope asks, the rate_limiter slows down instead.
+    - After failure_threshold consecutive failures an endpoint's circuit opens. Requests wait until it
+      half-opens, then a single probe decides whether to close it or keep it open for twice as long.
+    - Rate limits are reported to the shared rate_limiter, which pauses and slows down all workers.
+    """
+
+    def __init__(
+        self,
+        base_delay=1.0,
+        max_delay=60.0,
+        budget_ratio=0.2,
+        budget=10.0,
+        failure_threshold=10,
+        open_timeout=30.0,
+        max_open_timeout=300.0,
+    ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget = budget
+        self.failure_threshold = failure_threshold
+        self.initial_open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def endpoint(self, name):
+        state = self.endpoints.get(name)
+        if state is None:
+            state = self.endpoints.setdefault(name, EndpointState(self.budget))
+        return state
+
+    def before_request(self, name):
+        """
+        Wait for the endpoint's circuit to allow a request, then earn a share of a retry.
+
+        Returns:
+        - bool: Whether the request is the probe of a half-open circuit, end it with end_probe()
+        """
+        while True:
+            with self.lock:
+                state = self.endpoint(name)
+                wait_time = state.open_until - time.monotonic()
+                if wait_time <= 0:
+                    if state.open_until and state.probe_in_flight:
+                        wait_time = 0.1
+                    else:
+                        probe = bool(state.open_until)
+                        if probe:
+                            state.probe_in_flight = True
+                        state.retry_tokens = min(
+                            self.budget, state.retry_tokens + self.budget_ratio
+                        )
+                        break
+            time.sleep(wait_time)
+        rate_limiter.acquire()
+        return probe
+
+    def end_probe(self, name):
+        """
+        Let another request probe the endpoint, if the probe ended without recording its outcome
+        """
+        with self.lock:
+            self.endpoint(name).probe_in_flight = False
+
+    def record_success(self, name):
+        with self.lock:
+            state = self.endpoint(name)
+            state.consecutive_failures = 0
+            state.open_until = 0.0
+            state.open_timeout = 0.0
+            state.probe_in_flight = False
+        rate_limiter.on_success()
+
+    def record_failure(self, name, rate_limited=False):
+        """
+        Record a failed attempt, opening the endpoint's circuit after too many failures in a row.
+
+        Args:
+        - name (str): The endpoint the attempt was sent to
+        - rate_limited (bool): Whether the attempt was rate limited
+        """
+        if rate_limited:
+            rate_limiter.on_rate_limited()
+        with self.lock:
+            state = self.endpoint(name)
+            state.consecutive_failures += 1
+            if state.probe_in_flight or state.consecutive_failures >= self.failure_threshold:
+                state.open_timeout = min(
+                    self.max_open_timeout,
+                    state.open_timeout * 2 if state.open_timeout else self.initial_open_timeout,
+                )
+                state.open_until = time.monotonic() + state.open_timeout
+                state.probe_in_flight = False
+                state.consecutive_failures = 0
+                logging.warning(
+                    f"Too many failures for {name}, pausing requests to it for {state.open_timeout:.0f} seconds"
+                )
+
+    def next_delay(self, name, previous_delay, retry_after=None, rate_limited=False):
+        """
+        Spend a retry from the endpoint's budget and work out how long to wait before it.
+
+        Args:
+        - name (str): The endpoint the attempt was sent to
+        - previous_delay (float): The previous wait of this request, or 0 for the first retry
+        - retry_after (float): The wait requested by Descope, if any
+        - rate_limited (bool): Whether the attempt was rate limited
+
+        Returns:
+        - float: Seconds to wait before the next attempt
+        Raises:
+        - RetryGiveUp: If the endpoint's retry budget is spent. Rate limited attempts don't spend
+          the budget, Descope asked to wait rather than to stop
+        """
+        if not rate_limited:
+            with self.lock:
+                state = self.endpoint(name)
+                if state.retry_tokens < 1:
+                    raise RetryGiveUp(f"Retry budget of {name} is spent")
+                state.retry_tokens -= 1
+
+        if retry_after:
+            delay = float(retry_after) + random.uniform(0, self.base_delay)
+        else:
+            delay = min(
+                self.max_delay,
+                random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)),
+            )
+        if rate_limited:
+            # Every worker waits out the rate limit, not only the one that hit it
+            rate_limiter.backoff(delay)
+        return delay
+
+
+retry_engine = RetryEngine()
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(headers):
+    """
+    Parse the Retry-After header in seconds, which may also be an HTTP date
+    """
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def api_request_with_retry(action, url, headers, data=None, max_retries=4, timeout=10):
+    """
+    Handles API requests with additional retry on timeouts, connection errors, server errors and rate limit.
+
+    Args:
+    - action (string): 'get' or 'post'
+    - url (string): The URL of the path for the api request
+    - headers (dict): Headers to be sent with the request
+    - data (json): Optional and used only for post, but the payload to post
+    - max_retries (int): The max number of retries
+    - timeout (int): The timeout for the request in seconds
+    Returns:
+    - API Response
+    - Or None
+    """
+    endpoint = requests.utils.urlparse(url).path
+    response = None
+    retries = 0
+    delay = 0.0
+    while True:
+        probe = retry_engine.before_request(endpoint)
+        try:
+            metrics.count_request(endpoint)
+            retry_after = None
+            try:
+                session = get_http_session()
+                if action == "get":
+                    response = session.get(url, headers=headers, timeout=timeout)
+                else:
+                    response = session.post(
+                        url, headers=headers, data=data, timeout=timeout
+                    )
+
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    retry_engine.record_success(endpoint)
+                    return response
+
+                retry_after = parse_retry_after(response.headers)
+                logging.info(
+                    f"Request to {endpoint} failed with status {response.status_code}."
+                )
+
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                logging.warning(f"Request to {endpoint} failed. (timeout={timeout}): {e}")
+
+            except requests.exceptions.RequestException as e:
+                # Other request exceptions, such as an invalid URL, won't succeed on a retry
+                logging.error(f"A request exception occurred: {e}")
+                retry_engine.record_failure(endpoint)
+                return None
+
+            rate_limited = response is not None and response.status_code == 429
+            retry_engine.record_failure(endpoint, rate_limited=rate_limited)
+        finally:
+            if probe:
+                retry_engine.end_probe(endpoint)
+        # Descope asked to wait, so a rate limit isn't counted against max_retries
+        if not rate_limited:
+            retries += 1
+        if retries > max_retries:
+            break
+        try:
+            delay = retry_engine.next_delay(
+                endpoint, delay, retry_after=retry_after, rate_limited=rate_limited
+            )
+        except RetryGiveUp as e:
+            logging.error(f"{e}. Giving up.")
+            return response
+        metrics.count_retry(endpoint, rate_limited=rate_limited)
+        logging.info(f"Retrying attempt {retries}/{max_retries} in {delay:.1f} seconds...")
+        time.sleep(delay)
+
+    logging.error("Max retries reached. Giving up.")
+    return response
+
+
+def sdk_request_with_retry(sdk_call, *args, max_retries=4, **kwargs):
+    """
+    Calls a Descope SDK management function through the shared retry engine, retrying on rate limit,
+    server errors and connection errors.
+
+    Args:
+    - sdk_call (callable): The SDK function to call, e.g. descope_client.mgmt.user.invite_batch
+    - max_retries (int): The max number of retries
+    Returns:
+    - The SDK function's response
+    Raises:
+    - AuthException: If the call fails, or still fails after max_retries
+    """
+    endpoint = getattr(sdk_call, "__name__", str(sdk_call))
+    retries = 0
+    delay = 0.0
+    while True:
+        probe = retry_engine.before_request(endpoint)
+        try:
+            metrics.count_request(endpoint)
+            retry_after = None
+            rate_limited = False
+            try:
+                response = sdk_call(*args, **kwargs)
+                retry_engine.record_success(endpoint)
+                return response
+            except RateLimitException as error:
+                rate_limited = True
+                retry_after = error.rate_limit_parameters.get(API_RATE_LIMIT_RETRY_AFTER_HEADER)
+                failure = AuthException(error.status_code, error.error_type, error.error_message)
+            except AuthException as error:
+                if error.status_code not in RETRYABLE_STATUS_CODES:
+                    # Descope answered, so the endpoint itself is healthy
+                    retry_engine.record_success(endpoint)
+                    raise
+                failure = error
+            except httpx.TransportError as error:
+                failure = AuthException(None, "transport", str(error))
+
+            logging.info(f"Request to {endpoint} failed: {failure.error_message}")
+            retry_engine.record_failure(endpoint, rate_limited=rate_limited)
+        finally:
+            if probe:
+                retry_engine.end_probe(endpoint)
+        # Descope asked to wait, so a rate limit isn't counted against max_retries
+        if not rate_limited:
+            retries += 1
+        if retries > max_retries:
+            logging.error("Max retries reached. Giving up.")
+            raise failure
+        try:
+            delay = retry_engine.next_delay(
+                endpoint, delay, retry_after=retry_after, rate_limited=rate_limited
+            )
+        except RetryGiveUp as e:
+            logging.error(f"{e}. Giving up.")
+            raise failure
+        metrics.count_retry(endpoint, rate_limited=rate_limited)
+        logging.info(f"Retrying attempt {retries}/{max_retries} in {delay:.1f} seconds...")
+        time.sleep(delay)
+
+
+### Begin Firebase Actions
+
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MAX_BUFFERED_PAGES = 2
+
+
+class MigrationUser:
+    """
+    The fields of a Firebase user that are migrated, and nothing else.
+
+    Records are built once when users are listed or parsed, so the raw Admin SDK payload (provider
+    info, MFA, tokens, ...) of each user is released right away. Slots keep a record several times
+    smaller than the equivalent dict.
+    """
+
+    # Attribute names, mapped to the keys of the Admin SDK's user record _data
+    FIELDS = (
+        ("uid", "localId"),
+        ("email", "email"),
+        ("phone", "phoneNumber"),
+        ("display_name", "displayName"),
+        ("given_name", "givenName"),
+        ("family_name", "familyName"),
+        ("picture", "photoUrl"),
+        ("email_verified", "emailVerified"),
+        ("phone_verified", "phoneVerified"),
+        ("disabled", "disabled"),
+        ("password_hash", "passwordHash"),
+        ("salt", "salt"),
+        ("created_at", "createdAt"),
+        ("last_login_at", "lastLoginAt"),
+        ("last_refresh_at", "lastRefreshAt"),
+        ("password_updated_at", "passwordUpdatedAt"),
+    )
+    # Set on the user a merge plan merged duplicate Firebase users into
+    MERGE_FIELDS = ("merged_user_ids", "disabled_by_merge")
+    __slots__ = tuple(attribute for attribute, _ in FIELDS) + MERGE_FIELDS
+
+    def __init__(self, *values, **fields):
+        for attribute, value in zip(self.__slots__, values):
+            setattr(self, attribute, value)
+        for attribute in self.__slots__[len(values) :]:
+            setattr(self, attribute, fields.get(attribute))
+
+    @classmethod
+    def from_firebase_data(cls, user_data):
+        """
+        Build a record from the _data of a Firebase user record, or an auth:export record
+        """
+        return cls(*[user_data.get(key) for _, key in cls.FIELDS])
+
+    def to_firebase_data(self):
+        """
+        Return the record in the shape of the Admin SDK's user record _data
+        """
+        return {
+            key: getattr(self, attribute)
+            for attribute, key in self.FIELDS
+            if getattr(self, attribute) is not None
+        }
+
+    def get(self, key, default=None):
+        # Lets code written against the Admin SDK's user.__dict__ read a record
+        return {"_data": self.to_firebase_data()} if key == "_data" else default
+
+    def __getitem__(self, key):
+        if key != "_data":
+            raise KeyError(key)
+        return self.to_firebase_data()
+
+    def __eq__(self, other):
+        if not isinstance(other, MigrationUser):
+            return NotImplemented
+        return all(
+            getattr(self, attribute) == getattr(other, attribute) for attribute in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"MigrationUser(uid={self.uid!r}, email={self.email!r}, phone={self.phone!r})"
+
+
+def migration_user(user):
+    """
+    Return the MigrationUser of a user, given as a record, an Admin SDK user record or its __dict__
+    """
+    if isinstance(user, MigrationUser):
+        return user
+    if isinstance(user, dict):
+        return MigrationUser.from_firebase_data(user.get("_data", {}))
+    return MigrationUser.from_firebase_data(getattr(user, "_data", None) or {})
+
+
+class FirebaseUserPage:
+    """
+    A single page of users returned by the Firebase Admin SDK
+    """
+
+    def __init__(self, users, page_token, next_page_token):
+        self.users = users
+        self.page_token = page_token
+        self.next_page_token = next_page_token
+
+
+class CountedUsers:
+    """
+    Wraps an iterable of users and keeps a running count of the users consumed from it
+    """
+
+    def __init__(self, users):
+        self._users = users
+        self.count = 0
+
+    def __iter__(self):
+        for user in self._users:
+            self.count += 1
+            yield user
+
+
+def iter_firebase_user_pages(
+    page_token=None,
+    page_size=DEFAULT_PAGE_SIZE,
+    max_buffered_pages=DEFAULT_MAX_BUFFERED_PAGES,
+):
+    """
+    Stream pages of Firebase users as they are listed.
+
+    Pages are fetched by a background thread so the next page is downloaded while the current one
+    is being migrated. At most max_buffered_pages pages are held in memory at any time.
+
+    Args:
+    - page_token (str): Optional token of the page to start listing from
+    - page_size (int): The number of users to request per page (max 1000)
+    - max_buffered_pages (int): The max number of fetched pages waiting to be processed
+
+    Yields:
+    - FirebaseUserPage: The parsed users of each page, in listing order
+
+    Raises:
+    - Exception: The error of a page that couldn't be fetched, after the pages before it were yielded
+    """
+    pages = queue.Queue(maxsize=max(1, max_buffered_pages))
+    stop = threading.Event()
+    end_of_pages = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(token):
+        try:
+            while True:
+                with metrics.stage("firebase_page_fetch"):
+                    page = auth.list_users(
+                        page_token=token, max_results=page_size, app=context.firebase_app
+                    )
+
+                next_token = page.next_page_token if page.has_next_page else None
+                users = [migration_user(user) for user in page.users]
+                if not put(FirebaseUserPage(users, token, next_token)):
+                    return
+                if next_token is None:
+                    break
+                token = next_token
+        except Exception as error:
+            # Hand the error over to the consumer, so the migration fails instead of ending early
+            logging.error(f"Error fetching Firebase users. Error: {error}")
+            put(error)
+        else:
+            put(end_of_pages)
+
+    producer = threading.Thread(
+        target=produce, args=(page_token,), name="firebase-page-fetch", daemon=True
+    )
+    producer.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is end_of_pages:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+
+
+def iter_firebase_users(journal=None, user_filter=None, pages=None, **kwargs):
+    """
+    Stream parsed Firebase users one at a time. Accepts the same arguments as iter_firebase_user_pages.
+
+    Args:
+    - journal (MigrationJournal): Optional journal that tracks each page, users it has already
+      migrated are skipped
+    - user_filter (callable): Optional predicate, only users it returns True for are yielded
+    - pages (iterable): Optional pages to read users from instead of the Firebase Admin SDK,
+      e.g. iter_export_file_pages()
+
+    Yields:
+    - user (MigrationUser): A parsed Firebase user
+    """
+    if pages is None:
+        pages = iter_firebase_user_pages(**kwargs)
+    for page in pages:
+        if user_filter is not None:
+            page.users = [user for user in page.users if user_filter(user)]
+        if journal is not None:
+            yield from journal.open_page(page)
+        else:
+            yield from page.users
+
+
+# The max number of users auth.get_users looks up per request
+FIREBASE_GET_USERS_LIMIT = 100
+
+
+def iter_firebase_user_pages_by_uid(user_ids, page_size=FIREBASE_GET_USERS_LIMIT):
+    """
+    Stream pages of the given Firebase users only, looked up by UID instead of listing every user.
+    UIDs that don't exist in Firebase anymore are skipped.
+
+    Args:
+    - user_ids (iterable): The UIDs of the users, e.g. read from the missing users file of a verification
+    - page_size (int): The number of users looked up per request (max 100)
+
+    Yields:
+    - FirebaseUserPage: The parsed users of each page, without page tokens
+    """
+    for chunk in iter_chunks(user_ids, min(max(1, page_size), FIREBASE_GET_USERS_LIMIT)):
+        with metrics.stage("firebase_page_fetch"):
+            result = auth.get_users(
+                [auth.UidIdentifier(user_id) for user_id in chunk], app=context.firebase_app
+            )
+        yield FirebaseUserPage([migration_user(user) for user in result.users], None, None)
+
+
+def read_user_ids(path):
+    """
+    Read UIDs from a file with one UID per line, ignoring blank lines and duplicates.
+
+    Returns:
+    - list: The UIDs, in file order
+    """
+    user_ids = {}
+    with open(path) as file:
+        for line in file:
+            user_id = line.strip()
+            if user_id:
+                user_ids[user_id] = None
+    return list(user_ids)
+
+
+DEFAULT_EXPORT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# A user record of an auth:export JSON file starts with its localId. A quote can't appear unescaped
+# inside a JSON string, so this only matches the start of a record.
+EXPORT_JSON_RECORD_START = re.compile(rb'\{\s*"localId"\s*:')
+
+# Columns of an auth:export CSV file, mapped to the keys of the Admin SDK's user record _data
+EXPORT_CSV_COLUMNS = {
+    0: "localId",
+    1: "email",
+    2: "emailVerified",
+    3: "passwordHash",
+    4: "salt",
+    5: "displayName",
+    6: "photoUrl",
+    23: "createdAt",
+    24: "lastLoginAt",
+    25: "phoneNumber",
+    26: "disabled",
+}
+EXPORT_CSV_BOOLEAN_COLUMNS = ("emailVerified", "disabled")
+
+
+def export_json_record_to_user(record):
+    """
+    Map a user record of an auth:export JSON file onto the shape returned by the Firebase Admin SDK
+    """
+    user = MigrationUser.from_firebase_data(record)
+    if user.last_login_at is None:
+        user.last_login_at = record.get("lastSignedInAt")
+    return user
+
+
+def export_csv_row_to_user(row):
+    """
+    Map a row of an auth:export CSV file onto the shape returned by the Firebase Admin SDK
+    """
+    user_data = {}
+    for index, key in EXPORT_CSV_COLUMNS.items():
+        if index < len(row) and row[index] != "":
+            user_data[key] = row[index]
+    for key in EXPORT_CSV_BOOLEAN_COLUMNS:
+        user_data[key] = user_data.get(key, "").lower() == "true"
+    return MigrationUser.from_firebase_data(user_data)
+
+
+def export_csv_chunk_ranges(path, start_offset=0, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    Split an auth:export CSV file into byte ranges of about chunk_size that start and end on record
+    boundaries. Quoted fields may contain newlines, so a newline only ends a record when an even
+    number of quotes came before it, escaped quotes ("") count twice.
+
+    Args:
+    - path (str): The path of the export file
+    - start_offset (int): The byte offset of the record to start from
+
+    Yields:
+    - (start, end): The byte range of each chunk
+    """
+    with open(path, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        if start_offset >= file_size:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            start = start_offset
+            while start < file_size:
+                position = min(file_size, start + max(1, chunk_size))
+                quotes = mapped_file[start:position].count(b'"')
+                while position < file_size:
+                    newline = mapped_file.find(b"\n", position)
+                    if newline == -1:
+                        position = file_size
+                        break
+                    quotes += mapped_file[position:newline].count(b'"')
+                    position = newline + 1
+                    if quotes % 2 == 0:
+                        break
+                yield start, position
+                start = position
+
+
+def parse_export_chunk(path, export_format, start, end):
+    """
+    Parse the users of an auth:export file whose record starts in the byte range [start, end).
+    CSV chunks must start and end on record boundaries, see export_csv_chunk_ranges.
+
+    Runs in a worker process, so each chunk is read and parsed independently of the others.
+
+    Returns:
+    - users (list): The parsed users of the chunk, in file order
+    """
+    users = []
+    with open(path, "rb") as file:
+        if export_format == "csv":
+            file.seek(start)
+            text = file.read(end - start).decode("utf-8")
+            for row in csv.reader(io.StringIO(text, newline="")):
+                if any(field.strip() for field in row):
+                    users.append(export_csv_row_to_user(row))
+            return users
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            first = EXPORT_JSON_RECORD_START.search(mapped_file, start)
+            if first is None or first.start() >= end:
+                return users
+            stop = EXPORT_JSON_RECORD_START.search(mapped_file, max(end, first.end()))
+            text = mapped_file[first.start() : stop.start() if stop else len(mapped_file)]
+            text = text.decode("utf-8")
+
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        # Only commas and whitespace separate records, and the text ends before the next chunk's
+        # first record or at the closing brackets of the file
+        position = text.find("{", position)
+        if position == -1:
+            break
+        record, position = decoder.raw_decode(text, position)
+        users.append(export_json_record_to_user(record))
+    return users
+
+
+def iter_export_file_pages(
+    path,
+    start_offset=0,
+    chunk_size=DEFAULT_EXPORT_CHUNK_SIZE,
+    workers=None,
+    export_format=None,
+):
+    """
+    Stream the users of a file produced by `firebase auth:export`, in JSON or CSV format.
+
+    The file is split into byte ranges of chunk_size which are parsed in parallel by a process pool.
+    Chunks are yielded in file order, and at most twice as many chunks as workers are held in memory.
+
+    Args:
+    - path (str): The path of the export file
+    - start_offset (int): The byte offset to start reading from, used to resume a migration
+    - chunk_size (int): The size in bytes of each chunk parsed by a worker
+    - workers (int): The number of worker processes, defaults to the number of CPUs
+    - export_format (str): 'json' or 'csv', detected from the file extension by default
+
+    Yields:
+    - FirebaseUserPage: The users of each chunk, with the byte offsets of the chunk as page tokens
+    """
+    if export_format is None:
+        export_format = "csv" if path.lower().endswith(".csv") else "json"
+    file_size = os.path.getsize(path)
+    if export_format == "csv":
+        ranges = export_csv_chunk_ranges(path, start_offset, chunk_size)
+    else:
+        ranges = (
+            (start, min(file_size, start + chunk_size))
+            for start in range(start_offset, file_size, max(1, chunk_size))
+        )
+    workers = workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker_process,
+        initargs=(context.settings,),
+    ) as executor:
+        in_flight = deque()
+        while True:
+            while len(in_flight) < workers * 2:
+                start, end = next(ranges, (None, None))
+                if start is None:
+                    break
+                in_flight.append(
+                    (start, end, executor.submit(parse_export_chunk, path, export_format, start, end))
+                )
+            if not in_flight:
+                break
+            start, end, future = in_flight.popleft()
+            with metrics.stage("export_parse"):
+                users = future.result()
+            yield FirebaseUserPage(users, str(start), str(end) if end < file_size else None)
+
+
+def fetch_firebase_users():
+    """
+    Fetch and parse Firebase users.
+
+    Returns:
+    - all_users (Dict): A list of parsed Firebase users if successful, empty list otherwise.
+    """
+    return list(iter_firebase_users())
+
+
+def get_firestore_client():
+    """
+    Return the Firestore client of the migration context, shared by every lookup.
+    """
+    return context.firestore_client
+
+
+def fetch_custom_attributes(user_id):
+    """
+    Fetch custom attributes for a given user ID from either Realtime Database or Firestore
+
+    Args:
+    - user_id (str): The user's ID in Firebase.
+
+    Returns:
+    - dict: A dictionary of custom attributes.
+    """
+    if attribute_source == "firestore":
+        firestore_db = get_firestore_client()
+        doc_ref = firestore_db.collection("users").document(user_id)
+        doc_snapshot = doc_ref.get()
+        if doc_snapshot.exists:
+            return doc_snapshot.to_dict() or {}
+        return {}
+    elif attribute_source == "realtime":
+        ref = context.database_reference(f"users/{user_id}")
+        return ref.get() or {}
+    elif attribute_source == "snapshot":
+        return attribute_snapshot.get_attributes([user_id]).get(user_id) or {}
+    return {}
+
+
+# The max number of concurrent Realtime Database reads of a single prefetch
+REALTIME_PREFETCH_WORKERS = 16
+
+
+def prefetch_custom_attributes(user_ids):
+    """
+    Fetch the custom attributes of many users at once from either Realtime Database or Firestore.
+
+    Firestore documents are read with a single get_all call. Realtime Database users are read one
+    user at a time, with up to REALTIME_PREFETCH_WORKERS requests in flight.
+
+    Args:
+    - user_ids (list): The users' IDs in Firebase.
+
+    Returns:
+    - dict: The custom attributes of each user, keyed by user ID. Users without attributes are omitted.
+    """
+    user_ids = [user_id for user_id in user_ids if user_id]
+    if not user_ids:
+        return {}
+
+    custom_attributes_by_uid = {}
+    if attribute_source == "firestore":
+        firestore_db = get_firestore_client()
+        collection = firestore_db.collection("users")
+        doc_refs = [collection.document(user_id) for user_id in user_ids]
+        for doc_snapshot in firestore_db.get_all(doc_refs):
+            if doc_snapshot.exists:
+                custom_attributes_by_uid[doc_snapshot.id] = doc_snapshot.to_dict() or {}
+    elif attribute_source == "realtime":
+        # UIDs are random, so a key range covering the chunk would download most of the tree
+        user_ids = list(dict.fromkeys(user_ids))
+        with ThreadPoolExecutor(
+            max_workers=min(len(user_ids), REALTIME_PREFETCH_WORKERS),
+            thread_name_prefix="realtime-prefetch",
+        ) as executor:
+            for user_id, attributes in zip(
+                user_ids, executor.map(fetch_custom_attributes, user_ids)
+            ):
+                if attributes:
+                    custom_attributes_by_uid[user_id] = attributes
+    elif attribute_source == "snapshot":
+        custom_attributes_by_uid = attribute_snapshot.get_attributes(user_ids)
+    return custom_attributes_by_uid
+
+
+def iter_custom_attribute_documents(page_size=DEFAULT_PAGE_SIZE):
+    """
+    Stream every custom attribute document from either Realtime Database or Firestore, a page at a time.
+
+    Args:
+    - page_size (int): The number of documents to read per request
+
+    Yields:
+    - (user_id, attributes): The user's ID in Firebase and its custom attributes
+    """
+    if attribute_source == "firestore":
+        collection = get_firestore_client().collection("users")
+        query = collection.order_by("__name__").limit(page_size)
+        last_snapshot = None
+        while True:
+            page = query.start_after(last_snapshot) if last_snapshot else query
+            snapshots = list(page.stream())
+            for snapshot in snapshots:
+                yield snapshot.id, snapshot.to_dict() or {}
+            if len(snapshots) < page_size:
+                break
+            last_snapshot = snapshots[-1]
+    elif attribute_source == "realtime":
+        last_key = None
+        while True:
+            query = context.database_reference("users").order_by_key()
+            if last_key is None:
+                users = query.limit_to_first(page_size).get() or {}
+            else:
+                # start_at is inclusive, so read one extra key and skip the last one already seen
+                users = query.start_at(last_key).limit_to_first(page_size + 1).get() or {}
+                users.pop(last_key, None)
+            for user_id in sorted(users):
+                yield user_id, users[user_id] or {}
+            if not users or len(users) < page_size:
+                break
+            last_key = max(users)
+    elif attribute_source == "snapshot":
+        yield from attribute_snapshot.iter_attribute_documents()
+
+
+def set_custom_attribute_source(source, snapshot=None):
+    """
+    Args:
+    - source (str): 'firestore', 'realtime', 'snapshot' or None to skip custom attributes
+    - snapshot (FirebaseSnapshot): The snapshot to read attributes from, with the 'snapshot' source
+    """
+    global attribute_source, attribute_snapshot
+    attribute_source = source
+    attribute_snapshot = snapshot
+
+
+### End Firebase Actions
+
+### Begin Snapshot Cache
+
+# Firestore values JSON can't hold are saved as objects tagged with their type under this key, and
+# read back as values that flatten_attributes converts exactly like the live ones
+SNAPSHOT_TYPE_KEY = "__snapshotType__"
+
+
+class SnapshotGeoPoint:
+    """
+    A Firestore GeoPoint read back from a snapshot
+    """
+
+    __slots__ = ("latitude", "longitude")
+
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __eq__(self, other):
+        if not is_geo_point(other):
+            return NotImplemented
+        return (self.latitude, self.longitude) == (other.latitude, other.longitude)
+
+
+class SnapshotDocumentReference:
+    """
+    A Firestore DocumentReference read back from a snapshot, only its path is kept
+    """
+
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def parent(self):
+        return self.path.rpartition("/")[0]
+
+    def __eq__(self, other):
+        if not is_document_reference(other):
+            return NotImplemented
+        return self.path == other.path
+
+
+def snapshot_json_default(value):
+    """
+    Tag the Firestore values of an attribute document with their type, see SNAPSHOT_TYPE_KEY
+    """
+    if isinstance(value, datetime):
+        return {SNAPSHOT_TYPE_KEY: "timestamp", "value": value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {SNAPSHOT_TYPE_KEY: "bytes", "value": base64.b64encode(value).decode("ascii")}
+    if is_document_reference(value):
+        return {SNAPSHOT_TYPE_KEY: "reference", "path": value.path}
+    if is_geo_point(value):
+        return {
+            SNAPSHOT_TYPE_KEY: "geopoint",
+            "latitude": value.latitude,
+            "longitude": value.longitude,
+        }
+    return str(value)
+
+
+def snapshot_json_object_hook(value):
+    value_type = value.get(SNAPSHOT_TYPE_KEY)
+    if value_type == "timestamp":
+        return datetime.fromisoformat(value["value"])
+    if value_type == "bytes":
+        return base64.b64decode(value["value"])
+    if value_type == "reference":
+        return SnapshotDocumentReference(value["path"])
+    if value_type == "geopoint":
+        return SnapshotGeoPoint(value["latitude"], value["longitude"])
+    return value
+
+
+def dump_attribute_document(document):
+    return json.dumps(document, default=snapshot_json_default, ensure_ascii=False)
+
+
+def load_attribute_document(document):
+    return json.loads(document, object_hook=snapshot_json_object_hook)
+
+
+class FirebaseSnapshot:
+    """
+    The users and custom attribute documents of a Firebase project, saved to SQLite.
+
+    A snapshot is captured once, then every rehearsal migrates from it without reading Firebase, with
+    the exact same input each time. Users are stored in listing order as JSON records and read back a
+    page at a time, through SQLite's memory mapped reads. Attribute documents keep the types of their
+    Firestore values, see SNAPSHOT_TYPE_KEY.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA mmap_size=1073741824")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS users (seq INTEGER PRIMARY KEY, uid TEXT, record TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS attributes (uid TEXT PRIMARY KEY, document TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def capture(self, pages, attribute_source=None):
+        """
+        Replace the snapshot with the given users and, from the given source, their custom attributes.
+
+        Args:
+        - pages (iterable): The FirebaseUserPage's to save, e.g. iter_firebase_user_pages()
+        - attribute_source (str): 'firestore' or 'realtime' to also save the custom attributes
+
+        Returns:
+        - int: The number of users saved
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM users")
+            self.connection.execute("DELETE FROM attributes")
+            self.connection.execute("DELETE FROM meta")
+            self.connection.commit()
+        users = 0
+        for page in pages:
+            page_users = [migration_user(user) for user in page.users]
+            attributes_by_uid = {}
+            if attribute_source:
+                with metrics.stage("attribute_fetch"):
+                    attributes_by_uid = prefetch_custom_attributes(
+                        [user.uid for user in page_users]
+                    )
+            with self.lock:
+                self.connection.executemany(
+                    "INSERT INTO users (uid, record) VALUES (?, ?)",
+                    (
+                        (user.uid, json.dumps(user.to_firebase_data(), sort_keys=True))
+                        for user in page_users
+                    ),
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO attributes (uid, document) VALUES (?, ?)",
+                    (
+                        (user_id, dump_attribute_document(document))
+                        for user_id, document in attributes_by_uid.items()
+                    ),
+                )
+                self.connection.commit()
+            users += len(page_users)
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [
+                    ("attribute_source", attribute_source),
+                    ("users", str(users)),
+                    ("captured_at", datetime.now().isoformat()),
+                ],
+            )
+            self.connection.commit()
+        return users
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    @property
+    def attribute_source(self):
+        return self.get_meta("attribute_source")
+
+    def iter_pages(self, start_offset=0, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Stream the saved users a page at a time, in the order they were listed.
+
+        Args:
+        - start_offset (int): The position of the first user to read, used to resume a migration
+        - page_size (int): The number of users per page
+
+        Yields:
+        - FirebaseUserPage: The users of each page, with their positions as page tokens
+        """
+        position = start_offset
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT seq, record FROM users WHERE seq > ? ORDER BY seq LIMIT ?",
+                    (position, page_size),
+                ).fetchall()
+            if not rows:
+                return
+            users = [MigrationUser.from_firebase_data(json.loads(record)) for _, record in rows]
+            next_position = rows[-1][0]
+            yield FirebaseUserPage(
+                users,
+                str(position) if position else None,
+                str(next_position) if len(rows) == page_size else None,
+            )
+            position = next_position
+
+    def get_attributes(self, user_ids):
+        """
+        Returns:
+        - dict: The saved custom attributes of each user, keyed by user ID
+        """
+        user_ids = [user_id for user_id in user_ids if user_id]
+        attributes_by_uid = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(user_ids), 500):
+            batch = user_ids[start : start + 500]
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT uid, document FROM attributes WHERE uid IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+            for user_id, document in rows:
+                attributes_by_uid[user_id] = load_attribute_document(document)
+        return attributes_by_uid
+
+    def iter_attribute_documents(self):
+        """
+        Yields:
+        - (user_id, attributes): Every saved custom attribute document, ordered by user ID
+        """
+        last_uid = ""
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT uid, document FROM attributes WHERE uid > ? ORDER BY uid LIMIT 1000",
+                    (last_uid,),
+                ).fetchall()
+            if not rows:
+                return
+            for user_id, document in rows:
+                yield user_id, load_attribute_document(document)
+            last_uid = rows[-1][0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+### End Snapshot Cache
+
+### Begin Descope Actions
+
+
+def parse_hash_params(hash_params_file_path):
+    """
+    Parse the hash parameters from the given password-hash.txt file.
+    """
+    hash_params = {}
+    try:
+        with open(hash_params_file_path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if line.startswith("algorithm:"):
+                    hash_params["algorithm"] = line.split(":", 1)[1].strip().strip(",")
+                elif line.startswith("base64_signer_key:"):
+                    hash_params["signer_key"] = line.split(":", 1)[1].strip().strip(",")
+                elif line.startswith("base64_salt_separator:"):
+                    hash_params["salt_separator"] = (
+                        line.split(":", 1)[1].strip().strip(",")
+                    )
+                elif line.startswith("rounds:"):
+                    # Added strip(',') to remove any trailing commas
+                    hash_params["rounds"] = int(
+                        line.split(":", 1)[1].strip().strip(",")
+                    )
+                elif line.startswith("mem_cost:"):
+                    # Added strip(',') to remove any trailing commas
+                    hash_params["mem_cost"] = int(
+                        line.split(":", 1)[1].strip().strip(",")
+                    )
+    except FileNotFoundError:
+        print(f"File not found: {hash_params_file_path}")
+        exit(1)
+    except ValueError as e:
+        print(f"Error parsing hash parameters: {e}")
+        exit(1)
+    return hash_params
+
+
+def build_user_password(user, hash_params):
+    """
+    Build the hashed password a Firebase user is created with in Descope.
+
+    Anonymous users (no email and no phone) get a random bcrypt password from anon_passwords.
+
+    Returns:
+    - UserPassword: The user's password, or None for users without one
+    """
+    password = None
+    if user.password_hash:
+        password = UserPassword(
+            hashed=UserPasswordFirebase(
+                hash=user.password_hash,
+                salt=user.salt or "",
+                salt_separator=hash_params["salt_separator"],
+                signer_key=hash_params["signer_key"],
+                memory=hash_params["mem_cost"],
+                rounds=hash_params["rounds"],
+            )
+        )
+    # Create temporary password if anonymous user
+    elif (not user.email) and (not user.phone):
+        with metrics.stage("bcrypt"):
+            anon_password_hash = anon_passwords.take()
+        password = UserPassword(hashed=UserPasswordBcrypt(hash=anon_password_hash))
+    return password
+
+
+def build_user_object_with_passwords(
+    user, hash_params, login_id, custom_attributes, with_password=True
+):
+    """
+    Build the Descope user object of a Firebase user, with its hashed password if it has one.
+
+    Args:
+    - user (MigrationUser): The Firebase user
+    - hash_params (dict): The password hash parameters of the Firebase project
+    - login_id (str): The login ID of the user in Descope
+    - custom_attributes (dict): The custom attributes of the user in Descope
+    - with_password (bool): Whether to hash the password, users that are only updated don't need it
+
+    Returns:
+    - user_object (list): The UserObj to create
+    """
+    password = build_user_password(user, hash_params) if with_password else None
+    return [
+        UserObj(
+            login_id=login_id,
+            email=user.email,
+            display_name=user.display_name,
+            given_name=user.given_name,
+            family_name=user.family_name,
+            phone=user.phone,
+            picture=user.picture,
+            verified_email=user.email_verified or False,
+            verified_phone=(user.phone_verified or False) if user.phone else False,
+            password=password,
+            custom_attributes=custom_attributes,
+            status="disabled" if user.disabled else "enabled",
+        )
+    ]
+
+
+DEFAULT_BATCH_SIZE = 100
+
+
+def invite_batch(user_objects):
+    """
+    Create users in Descope in a single batch request. Each user is created with the status set
+    on its UserObj, so no follow up activate / deactivate calls are needed.
+
+    Args:
+    - user_objects (list): The UserObj's to create
+
+    Returns:
+    - results (list): A (login_id, success, reason) tuple for each user in user_objects
+    """
+    login_ids = [user_object.login_id for user_object in user_objects]
+    try:
+        with metrics.stage("invite_batch"):
+            resp = sdk_request_with_retry(
+                descope_client.mgmt.user.invite_batch,
+                users=user_objects,
+                invite_url="https://localhost",
+                send_mail=False,
+                send_sms=False,
+            )
+    except AuthException as error:
+        logging.error(
+            f"Unable to create users with password. Error: {error.error_message}"
+        )
+        print(f"Unable to create users with password. Error: {error.error_message}")
+        return [(login_id, False, error.error_message) for login_id in login_ids]
+
+    return parse_batch_response(resp, login_ids, "created")
+
+
+def parse_batch_response(resp, login_ids, action):
+    """
+    Match the per user failures of a batch response to the login IDs that were sent.
+
+    Args:
+    - resp (dict): The batch response, failures are reported in its "failedUsers" list
+    - login_ids (list): The login IDs of the users sent in the batch
+    - action (str): What was done to the users, used for logging
+
+    Returns:
+    - results (list): A (login_id, success, reason) tuple for each login ID
+    """
+    failures = {}
+    for failed_user in resp.get("failedUsers") or []:
+        for login_id in failed_user.get("user", {}).get("loginIds") or []:
+            failures[login_id] = failed_user.get("failure", "Unknown failure")
+
+    results = []
+    for login_id in login_ids:
+        if login_id in failures:
+            logging.error(f"User {login_id} was not {action}. Error: {failures[login_id]}")
+            results.append((login_id, False, failures[login_id]))
+        else:
+            logging.info(f"User {login_id} {action} in Descope.")
+            results.append((login_id, True, None))
+    return results
+
+
+class UserBatcher:
+    """
+    Collects mapped users and creates them in Descope batch_size users at a time
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = max(1, batch_size)
+        self.user_objects = []
+
+    def add(self, user_objects):
+        """
+        Queue users for creation, flushing the batch once it is full.
+
+        Returns:
+        - results (list): The results of the flushed batch, or an empty list if nothing was sent
+        """
+        self.user_objects.extend(user_objects)
+        if len(self.user_objects) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Create all queued users in Descope.
+
+        Returns:
+        - results (list): A (login_id, success, reason) tuple for each queued user
+        """
+        if not self.user_objects:
+            return []
+        results = invite_batch(self.user_objects)
+        self.user_objects = []
+        return results
+
+
+def delete_user(login_id):
+    """
+    Delete a user from Descope, so it can be created again.
+
+    Returns:
+    - result (tuple): The (login_id, success, reason) of the deletion
+    """
+    try:
+        with metrics.stage("delete"):
+            sdk_request_with_retry(descope_client.mgmt.user.delete, login_id=login_id)
+    except AuthException as error:
+        logging.error(f"Unable to delete user {login_id}. Error: {error.error_message}")
+        return login_id, False, error.error_message
+    return login_id, True, None
+
+
+def patch_batch(user_objects):
+    """
+    Update users that already exist in Descope, including their status, in a single batch request.
+
+    Args:
+    - user_objects (list): The UserObj's to update, passwords are ignored
+
+    Returns:
+    - results (list): A (login_id, success, reason) tuple for each user in user_objects
+    """
+    patched_user_objects = []
+    for user_object in user_objects:
+        patched_user_object = copy.copy(user_object)
+        patched_user_object.password = None
+        patched_user_objects.append(patched_user_object)
+    login_ids = [user_object.login_id for user_object in user_objects]
+    try:
+        with metrics.stage("patch_batch"):
+            resp = sdk_request_with_retry(
+                descope_client.mgmt.user.patch_batch, users=patched_user_objects
+            )
+    except AuthException as error:
+        logging.error(f"Unable to update users. Error: {error.error_message}")
+        return [(login_id, False, error.error_message) for login_id in login_ids]
+
+    return parse_batch_response(resp, login_ids, "updated")
+
+
+def map_firebase_user(
+    user,
+    hash_params,
+    custom_attributes_by_uid=None,
+    login_id=None,
+    flattened_attributes_by_uid=None,
+    with_password=True,
+):
+    """
+    Map a Firebase user onto the Descope user objects that will be created for it.
+
+    Args:
+    - user (MigrationUser): The Firebase user, or the user details fetched from Firebase Admin SDK.
+    - custom_attributes_by_uid (dict): Optional custom attributes prefetched with prefetch_custom_attributes,
+      otherwise the user's attributes are fetched individually
+    - login_id (str): Optional login ID the user was already migrated with
+    - flattened_attributes_by_uid (dict): Optional custom attributes already flattened with
+      flatten_custom_attributes, used instead of flattening custom_attributes_by_uid again
+    - with_password (bool): Whether to hash the user's password, see build_user_password
+
+    Returns:
+    - user_object (list): The UserObj's to create
+    - login_id (str): The login ID of the user in Descope
+    - is_disabled (bool): Whether the user is disabled in Firebase
+    """
+    user = migration_user(user)
+
+    custom_attributes = {"freshlyMigrated": True}
+    is_disabled = user.disabled or False
+    # Use Email if exists, otherwise phone, otherwise is anon user create anon login email
+    if not login_id:
+        login_id = user.email if user.email else user.phone if user.phone else anon.make_anon_login_id()
+
+    #Put the UUID in the UUID custom attribute per user
+    user_id = user.uid
+    if user_id:
+        custom_attributes.update({"UUID":user_id})
+    
+    # Fetch custom attributes from Firestore or Realtime Database, if a source was chosen
+    if attribute_source:
+        if user_id and flattened_attributes_by_uid is not None:
+            if user_id in flattened_attributes_by_uid:
+                flattend_attributes, mapped_dict = flattened_attributes_by_uid[user_id]
+                attribute_schema.ensure(mapped_dict)
+                custom_attributes.update(attribute_schema.conform(flattend_attributes))
+        elif user_id:
+            if custom_attributes_by_uid is not None:
+                additional_attributes = custom_attributes_by_uid.get(user_id)
+            else:
+                with metrics.stage("attribute_fetch"):
+                    additional_attributes = fetch_custom_attributes(user_id)
+
+            if additional_attributes:
+                with metrics.stage("flatten"):
+                    flattend_attributes, mapped_dict = flatten_attributes(additional_attributes)
+
+                # Only attributes that don't exist in Descope yet are created
+                attribute_schema.ensure(mapped_dict)
+                custom_attributes.update(attribute_schema.conform(flattend_attributes))
+
+    user_object = build_user_object_with_passwords(
+        user, hash_params, login_id, custom_attributes, with_password=with_password
+    )
+    return user_object, login_id, is_disabled
+
+
+def create_descope_user(user, hash_params):
+    """
+    Create a Descope user based on matched Firebase user data using Descope Python SDK.
+
+    Args:
+    - user (dict): A dictionary containing user details fetched from Firebase Admin SDK.
+    """
+    try:
+        user_object, login_id, is_disabled = map_firebase_user(user, hash_params)
+
+        # Create the Descope user
+        ((_, success, reason),) = invite_batch(user_object)
+        if not success:
+            return False, False, False, f"{login_id} Reason: {reason}"
+
+        return success, False, False, login_id
+
+    except AuthException as error:
+        logging.error(f"Unable to create user. {user}")
+        logging.error(f"Error: {error.error_message}")
+        return (
+            False,
+            False,
+            False,
+            (migration_user(user).uid or "") + " Reason: " + error.error_message,
+        )
+
+CUSTOM_ATTRIBUTE_TYPES = {
+    'String': 1,
+    'Number': 2,
+    'Boolean': 3
+}
+
+
+def create_custom_attributes_in_descope(custom_attr_dict):
+    """
+    Creates custom attributes in Descope
+
+    Args:
+    - custom_attr_dict: Dictionary of custom attribute names and assosciated data types {"name" : dataType, ...} 
+
+    Returns:
+    - bool: True if the attributes were created
+    """
+
+    # Takes indivdual custom attribute and makes a json body for create attribute post request
+    custom_attr_post_body = []
+    for custom_attr_name, custom_attr_type in custom_attr_dict.items():
+        custom_attr_body = {
+            "name": custom_attr_name,
+            "type": CUSTOM_ATTRIBUTE_TYPES.get(custom_attr_type, 1), # Defualt to 0 if type not found
+            "options": [],
+            "displayName": custom_attr_name,
+            "defaultValue": {},
+            "viewPermissions": [],
+            "editPermissions": [],
+            "editable": True
+        }
+        custom_attr_post_body.append(custom_attr_body)
+
+    #Combine all custom attribute post request bodies into one
+    #Request for custom attributes to be created using a post request
+    try:
+        endpoint = f"{context.descope_api_url}/v1/mgmt/user/customattribute/create"
+        data = {"attributes":custom_attr_post_body}
+        with metrics.stage("schema_create"):
+            response = api_request_with_retry(
+                action="post",
+                url=endpoint,
+                headers=context.management_headers,
+                data=json.dumps(data)
+                )
+        if response is None:
+            logging.error("Failed to create custom Attributes: no response from Descope")
+            return False
+
+        if response.ok:
+            logging.info(f"Custom attributes successfully created in Descope")
+            return True
+        else: 
+            response.raise_for_status()
+
+    except requests.HTTPError as e:
+        error_dict = {
+            "status_code":e.response.status_code,
+            "error_reason":e.response.reason,
+            "error_message":e.response.text
+            }
+        logging.error(f"Failed to create custom Attributes: {str(error_dict)}")
+    return False
+
+
+def load_custom_attributes_from_descope():
+    """
+    Loads the custom attributes that already exist in the Descope project
+
+    Returns:
+    - dict: Dictionary of custom attribute names and assosciated data types {"name" : dataType, ...}, or None on failure
+    """
+    type_names = {type_id: type_name for type_name, type_id in CUSTOM_ATTRIBUTE_TYPES.items()}
+    try:
+        endpoint = f"{context.descope_api_url}/v1/mgmt/user/customattributes"
+        response = api_request_with_retry(
+            action="get", url=endpoint, headers=context.management_headers
+        )
+        if response is None:
+            logging.error("Failed to load custom Attributes: no response from Descope")
+            return None
+        response.raise_for_status()
+
+    except requests.HTTPError as e:
+        error_dict = {
+            "status_code":e.response.status_code,
+            "error_reason":e.response.reason,
+            "error_message":e.response.text
+            }
+        logging.error(f"Failed to load custom Attributes: {str(error_dict)}")
+        return None
+
+    return {
+        attribute["name"]: type_names.get(attribute.get("type"), "String")
+        for attribute in response.json().get("data") or []
+        if attribute.get("name")
+    }
+
+
+class CustomAttributeSchema:
+    """
+    Registry of the custom attributes known to exist in the Descope project.
+
+    The registry is seeded from the project's existing attributes on first use, and only attributes it
+    has not seen yet are sent to Descope, in a single create request. Safe to share between workers.
+    In a dry run the existing attributes are still read when Descope credentials are set, but the
+    create requests are only counted.
+    """
+
+    def __init__(self):
+        self.attribute_types = {}
+        self.type_conflicts = {}
+        self.seeded = False
+        # Whether the existing attributes were read from Descope, and the seed request it took
+        self.existing_attributes_loaded = False
+        self.seed_requests = 0
+        self.frozen = False
+        self.dry_run = False
+        self.planned_create_requests = 0
+        self.lock = threading.Lock()
+
+    def seed(self):
+        self.seeded = True
+        if self.dry_run and not context.has_descope_credentials:
+            return
+        self.seed_requests += 1
+        existing_attributes = load_custom_attributes_from_descope()
+        if existing_attributes is not None:
+            self.attribute_types.update(existing_attributes)
+            self.existing_attributes_loaded = True
+
+    def ensure(self, custom_attr_dict):
+        """
+        Make sure the given custom attributes exist in Descope, creating the missing ones.
+
+        Args:
+        - custom_attr_dict: Dictionary of custom attribute names and assosciated data types {"name" : dataType, ...}
+        """
+        with self.lock:
+            if not self.seeded and not self.frozen:
+                self.seed()
+
+            missing_attributes = {}
+            for name, attribute_type in custom_attr_dict.items():
+                known_type = self.attribute_types.get(name)
+                if known_type is None:
+                    missing_attributes[name] = attribute_type
+                elif known_type != attribute_type:
+                    conflicting_types = self.type_conflicts.setdefault(name, {known_type})
+                    if attribute_type not in conflicting_types:
+                        conflicting_types.add(attribute_type)
+                        logging.warning(
+                            f"Custom attribute {name} is a {known_type} in Descope, but a {attribute_type} value was found"
+                        )
+
+            if not missing_attributes:
+                return
+            if self.frozen:
+                logging.warning(
+                    f"Custom attributes missing from the discovered schema: {list(missing_attributes)}"
+                )
+                return
+            if self.dry_run:
+                self.planned_create_requests += 1
+                self.attribute_types.update(missing_attributes)
+                return
+            if create_custom_attributes_in_descope(missing_attributes):
+                self.attribute_types.update(missing_attributes)
+
+    def freeze(self, custom_attr_dict):
+        """
+        Create every attribute of a discovered schema up front and stop creating attributes afterwards.
+
+        Args:
+        - custom_attr_dict: Dictionary of custom attribute names and assosciated data types {"name" : dataType, ...}
+        """
+        self.ensure(custom_attr_dict)
+        with self.lock:
+            self.attribute_types.update(custom_attr_dict)
+            self.frozen = True
+
+    def conform(self, attributes):
+        """
+        Convert attribute values to String where the registered attribute type was widened to String.
+
+        Args:
+        - attributes (dict): Flattened custom attribute values
+
+        Returns:
+        - dict: The attribute values, matching the registered attribute types
+        """
+        return {
+            key: (
+                str(value)
+                if self.attribute_types.get(key) == "String" and not isinstance(value, str)
+                else value
+            )
+            for key, value in attributes.items()
+        }
+
+
+attribute_schema = CustomAttributeSchema()
+
+
+def infer_custom_attribute_types(flattend_attributes):
+    """
+    Infer the Descope data type of each flattened custom attribute value
+
+    Returns:
+    - dict: Dictionary of custom attribute names and assosciated data types {"name" : dataType, ...}
+    """
+    return {
+        key: (
+            "String" if isinstance(value, str) else
+            "Boolean" if isinstance(value, bool) else
+            "Number" if isinstance(value, (int, float)) else
+            "String"
+        )
+        for key, value in flattend_attributes.items()
+    }
+
+
+def widen_custom_attribute_type(current_type, new_type):
+    """
+    Widen two inferred attribute types into one that can hold the values of both
+    """
+    if current_type is None or current_type == new_type:
+        return new_type
+    return "String"
+
+
+class CustomAttributeSchemaReport:
+    """
+    The union schema of the custom attributes of every user, along with how often each attribute is set
+    """
+
+    def __init__(self):
+        self.documents = 0
+        self.attribute_types = {}
+        self.value_types = {}
+        self.users_per_attribute = {}
+
+    def add(self, flattend_attributes, attribute_types=None):
+        self.documents += 1
+        if attribute_types is None:
+            attribute_types = infer_custom_attribute_types(flattend_attributes)
+        for key, attribute_type in attribute_types.items():
+            self.attribute_types[key] = widen_custom_attribute_type(
+                self.attribute_types.get(key), attribute_type
+            )
+            self.value_types.setdefault(key, set()).add(attribute_type)
+            self.users_per_attribute[key] = self.users_per_attribute.get(key, 0) + 1
+
+    def keys_per_field(self, separator="_"):
+        """
+        Count the distinct flattened attribute keys coming from each top level field. Fields keyed by
+        dynamic values (IDs, dates, etc.) show up here with a very high count.
+        """
+        counts = {}
+        for key in self.attribute_types:
+            field = key.split(separator, 1)[0]
+            counts[field] = counts.get(field, 0) + 1
+        return counts
+
+    def to_dict(self):
+        return {
+            "documents": self.documents,
+            "attributes": len(self.attribute_types),
+            "keysPerField": dict(
+                sorted(self.keys_per_field().items(), key=lambda item: -item[1])
+            ),
+            "schema": {
+                key: {
+                    "type": attribute_type,
+                    "valueTypes": sorted(self.value_types[key]),
+                    "users": self.users_per_attribute[key],
+                }
+                for key, attribute_type in sorted(self.attribute_types.items())
+            },
+        }
+
+
+def discover_custom_attribute_schema(documents):
+    """
+    Scan custom attribute documents and compute the union of their schemas, widening conflicting types.
+
+    Args:
+    - documents (iterable): (user_id, attributes) tuples, e.g. from iter_custom_attribute_documents()
+
+    Returns:
+    - CustomAttributeSchemaReport: The discovered schema and its key cardinality
+    """
+    report = CustomAttributeSchemaReport()
+    for _, attributes in documents:
+        if attributes:
+            report.add(*flatten_attributes(attributes))
+    return report
+
+
+def flatten_dict(dictionary, parent_key='', separator='_' ):
+    """
+    Takes a dictonary and flattens it if it has nested attributes. 
+    Nested attribute names will be Root.Parents.AttributeName
+
+    The migration uses flatten_attributes, which also converts the values. This is kept as the
+    reference it is benchmarked against.
+
+    Args:
+    - dictionary: dictionary of attributes some of which may be nested
+    - parent_key: used for recursion and defines the root key for attribute names
+    - separator: will be the seperating delimiter between root,parents, and attribute name
+    """
+    items = []
+    for key, value in dictionary.items():
+        new_key = parent_key + separator + key if parent_key else key
+        if isinstance(value, MutableMapping):
+            items.extend(flatten_dict(value,new_key,separator=separator).items())
+        else:
+            items.append((new_key,value))
+    return dict(items)
+
+class AttributeLimits:
+    """
+    Limits on the custom attributes flattened from a single user's document. None means no limit.
+
+    - max_depth: Maps nested deeper are kept as a single JSON string attribute
+    - max_keys: Attributes past this count are dropped
+    - max_value_bytes: Longer string values are truncated to this many UTF-8 bytes
+    """
+
+    def __init__(self, max_depth=None, max_keys=None, max_value_bytes=None):
+        self.configure(max_depth, max_keys, max_value_bytes)
+
+    def configure(self, max_depth=None, max_keys=None, max_value_bytes=None):
+        for name, limit in (
+            ("max_depth", max_depth),
+            ("max_keys", max_keys),
+            ("max_value_bytes", max_value_bytes),
+        ):
+            if limit is not None and limit < 1:
+                raise ValueError(f"Custom attribute {name} must be at least 1, got {limit}")
+        self.max_depth = max_depth
+        self.max_keys = max_keys
+        self.max_value_bytes = max_value_bytes
+
+
+attribute_limits = AttributeLimits()
+
+
+def is_geo_point(value):
+    # Firestore GeoPoint, without importing the Firestore client
+    return hasattr(value, "latitude") and hasattr(value, "longitude")
+
+
+def is_document_reference(value):
+    # Firestore DocumentReference, without importing the Firestore client
+    return hasattr(value, "path") and hasattr(value, "parent")
+
+
+def attribute_json_default(value):
+    """
+    Convert the Firestore values found inside lists and maps that are stored as JSON strings
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    if is_geo_point(value):
+        return {"latitude": value.latitude, "longitude": value.longitude}
+    if is_document_reference(value):
+        return value.path
+    return str(value)
+
+
+def convert_attribute_value(value, max_value_bytes=None):
+    """
+    Convert a custom attribute value to a value Descope accepts, along with its Descope data type.
+
+    Timestamps become ISO 8601 strings, bytes become base64, document references become their path
+    and lists become JSON strings.
+
+    Returns:
+    - (value, attribute_type): The converted value and its type, "String", "Number" or "Boolean"
+    """
+    if isinstance(value, str):
+        attribute_type = "String"
+    elif isinstance(value, bool):
+        return value, "Boolean"
+    elif isinstance(value, (int, float)):
+        return value, "Number"
+    elif value is None:
+        return value, "String"
+    elif isinstance(value, datetime):
+        value, attribute_type = value.isoformat(), "String"
+    elif isinstance(value, (bytes, bytearray)):
+        value, attribute_type = base64.b64encode(value).decode("ascii"), "String"
+    elif isinstance(value, (list, tuple, Mapping)):
+        value = json.dumps(value, default=attribute_json_default, ensure_ascii=False)
+        attribute_type = "String"
+    elif is_document_reference(value):
+        value, attribute_type = value.path, "String"
+    else:
+        value, attribute_type = str(value), "String"
+    # A character takes at most 4 UTF-8 bytes, so most values don't need to be encoded to be checked
+    if max_value_bytes is not None and len(value) * 4 > max_value_bytes:
+        encoded = value.encode("utf-8")
+        if len(encoded) > max_value_bytes:
+            value = encoded[:max_value_bytes].decode("utf-8", "ignore")
+    return value, attribute_type
+
+
+# Descope data type of the values that are migrated as they are
+SCALAR_ATTRIBUTE_TYPES = {str: "String", bool: "Boolean", int: "Number", float: "Number"}
+
+
+def flatten_attributes(document, separator="_", limits=None):
+    """
+    Flatten a custom attribute document and infer the Descope type of each value, in a single
+    iterative pass. Nested attribute names are joined with the separator, e.g. address_city.
+
+    Firestore GeoPoints become a _latitude and a _longitude Number attribute, other values are
+    converted with convert_attribute_value.
+
+    Args:
+    - document (dict): The custom attributes of a user, some of which may be nested
+    - separator (str): The delimiter between the names of nested attributes
+    - limits (AttributeLimits): The limits to apply, the module's attribute_limits by default
+
+    Returns:
+    - flattened (dict): The flattened attribute values
+    - attribute_types (dict): The Descope data type of each flattened attribute
+    """
+    limits = attribute_limits if limits is None else limits
+    max_depth, max_keys, max_value_bytes = (
+        limits.max_depth,
+        limits.max_keys,
+        limits.max_value_bytes,
+    )
+    flattened = {}
+    attribute_types = {}
+    dropped_keys = 0
+    # Depth first, so attributes keep the order of the document
+    stack = [("", 1, iter(document.items()))]
+    while stack:
+        parent_key, depth, items = stack[-1]
+        for key, value in items:
+            if parent_key:
+                key = parent_key + separator + key
+            attribute_type = SCALAR_ATTRIBUTE_TYPES.get(type(value))
+            if attribute_type is not None and max_value_bytes is None:
+                if max_keys is not None and len(flattened) >= max_keys:
+                    dropped_keys += 1
+                    continue
+                flattened[key] = value
+                attribute_types[key] = attribute_type
+                continue
+            if type(value) is dict or isinstance(value, Mapping):
+                if max_depth is None or depth < max_depth:
+                    stack.append((key, depth + 1, iter(value.items())))
+                    break
+            elif is_geo_point(value) and not is_document_reference(value):
+                values = (
+                    (key + separator + "latitude", value.latitude),
+                    (key + separator + "longitude", value.longitude),
+                )
+                for geo_key, coordinate in values:
+                    if max_keys is not None and len(flattened) >= max_keys:
+                        dropped_keys += 1
+                        continue
+                    flattened[geo_key] = coordinate
+                    attribute_types[geo_key] = "Number"
+                continue
+            if max_keys is not None and len(flattened) >= max_keys:
+                dropped_keys += 1
+                continue
+            flattened[key], attribute_types[key] = convert_attribute_value(value, max_value_bytes)
+        else:
+            stack.pop()
+    if dropped_keys:
+        logging.warning(
+            f"Dropped {dropped_keys} custom attributes past the limit of {max_keys} attributes per user"
+        )
+    return flattened, attribute_types
+
+
+def flatten_custom_attributes(custom_attributes_by_uid, limits=None):
+    """
+    Flatten the custom attributes of a chunk of users and infer their types. Only uses its arguments,
+    so it can run in another process.
+
+    Args:
+    - custom_attributes_by_uid (dict): The custom attributes of each user, keyed by user ID
+    - limits (AttributeLimits): The limits to apply, the module's attribute_limits by default
+
+    Returns:
+    - dict: (flattened attributes, attribute types) of each user that has custom attributes
+    """
+    flattened_attributes_by_uid = {}
+    for user_id, attributes in custom_attributes_by_uid.items():
+        if attributes:
+            flattened_attributes_by_uid[user_id] = flatten_attributes(attributes, limits=limits)
+    return flattened_attributes_by_uid
+
+### End Descope Actions:
+
+### Begin Delta Sync
+
+
+def user_fingerprint(user_object):
+    """
+    Hash the fields of a mapped user that are migrated to Descope, excluding the password.
+    """
+    fields = {
+        "login_id": user_object.login_id,
+        "email": user_object.email,
+        "phone": user_object.phone,
+        "display_name": user_object.display_name,
+        "given_name": user_object.given_name,
+        "family_name": user_object.family_name,
+        "picture": user_object.picture,
+        "verified_email": user_object.verified_email,
+        "verified_phone": user_object.verified_phone,
+        "custom_attributes": user_object.custom_attributes,
+        "status": user_object.status,
+    }
+    return hashlib.sha256(
+        json.dumps(fields, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def password_fingerprint(user):
+    """
+    Hash a Firebase user's password hash and salt, so password changes can be detected.
+    """
+    password_hash = user.password_hash or ""
+    if not password_hash:
+        return ""
+    salt = user.salt or ""
+    return hashlib.sha256(f"{password_hash}:{salt}".encode("utf-8")).hexdigest()
+
+
+def parse_since(since):
+    """
+    Parse a --since value, either epoch milliseconds or an ISO 8601 date, into epoch milliseconds
+    """
+    if since.isdigit():
+        return int(since)
+    return int(datetime.fromisoformat(since.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def user_updated_since(user, since_ms):
+    """
+    Check the Firebase user metadata for a sign up, sign in, token refresh or password change after since_ms.
+
+    Args:
+    - user (MigrationUser): The Firebase user
+    - since_ms (int): Epoch milliseconds
+    """
+    user = migration_user(user)
+    timestamps = []
+    for timestamp in (user.created_at, user.last_login_at, user.password_updated_at):
+        if timestamp:
+            timestamps.append(int(timestamp))
+    if user.last_refresh_at:
+        timestamps.append(parse_since(user.last_refresh_at))
+    return any(timestamp >= since_ms for timestamp in timestamps)
+
+
+class FingerprintIndex:
+    """
+    Persistent index of the Firebase users already migrated, keyed by UID, stored in SQLite.
+
+    For each user it keeps the login ID used in Descope and fingerprints of the migrated fields and of the
+    password hash, so a delta run can tell new, changed and unchanged users apart.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                uid TEXT PRIMARY KEY,
+                login_id TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                password_fingerprint TEXT NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.unchanged_users = 0
+
+    def lookup(self, user_ids):
+        """
+        Returns:
+        - dict: (login_id, fingerprint, password_fingerprint) of the given user IDs that were migrated before
+        """
+        user_ids = [user_id for user_id in user_ids if user_id]
+        entries = {}
+        with self.lock:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start : start + 500]
+                rows = self.connection.execute(
+                    "SELECT uid, login_id, fingerprint, password_fingerprint FROM fingerprints "
+                    f"WHERE uid IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                for user_id, login_id, fingerprint, password in rows:
+                    entries[user_id] = (login_id, fingerprint, password)
+        return entries
+
+    def update(self, entries):
+        """
+        Args:
+        - entries (list): (user_id, login_id, fingerprint, password_fingerprint) tuples of migrated users
+        """
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fingerprints (uid, login_id, fingerprint, password_fingerprint) "
+                "VALUES (?, ?, ?, ?)",
+                entries,
+            )
+            self.connection.commit()
+
+    def count_unchanged(self, count):
+        with self.lock:
+            self.unchanged_users += count
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+### End Delta Sync
+
+### Begin Merge Planning
+
+
+def normalize_email(email):
+    return email.strip().lower() if email and email.strip() else None
+
+
+def normalize_phone(phone):
+    if not phone:
+        return None
+    digits = "".join(character for character in phone if character.isdigit())
+    return f"+{digits}" if digits else None
+
+
+def user_identifiers(user):
+    """
+    Return the normalized email and phone of a user, the identifiers that must be unique in Descope
+    """
+    identifiers = []
+    email = normalize_email(user.email)
+    if email:
+        identifiers.append(("email", email))
+    phone = normalize_phone(user.phone)
+    if phone:
+        identifiers.append(("phone", phone))
+    return identifiers
+
+
+class MergePlan:
+    """
+    Groups of Firebase users that share a normalized email or phone, and would collide in Descope.
+
+    Build it with build_merge_plan() in a first pass over every user, then pass the users of the
+    migration through apply(). Users of a group are held back until the whole group was seen and
+    are then sent once, as a single merged user.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.group_by_uid = {}
+        for group_id, user_ids in enumerate(groups):
+            for user_id in user_ids:
+                self.group_by_uid[user_id] = group_id
+
+    @property
+    def merged_users(self):
+        return sum(len(user_ids) - 1 for user_ids in self.groups)
+
+    def apply(self, users):
+        """
+        Yield the users, with every group of colliding users replaced by a single merged user
+        """
+        held = {}
+        for user in users:
+            user = migration_user(user)
+            group_id = self.group_by_uid.get(user.uid)
+            if group_id is None:
+                yield user
+                continue
+            members = held.setdefault(group_id, [])
+            members.append(user)
+            if len(members) == len(self.groups[group_id]):
+                del held[group_id]
+                yield merge_users(members)
+        # Members already migrated by a resumed run never show up, merge the members that did
+        for members in held.values():
+            yield merge_users(members) if len(members) > 1 else members[0]
+
+    def to_dict(self):
+        return {
+            "groups": len(self.groups),
+            "mergedUsers": self.merged_users,
+            "userIds": self.groups,
+        }
+
+
+def build_merge_plan(users):
+    """
+    Find the Firebase users that share a normalized email or phone, in a single pass.
+
+    A hash index maps every identifier to the first user that had it, and a union-find joins users
+    transitively, e.g. when A shares an email with B and B shares a phone with C.
+
+    Args:
+    - users (iterable): Every Firebase user to migrate
+
+    Returns:
+    - MergePlan: The groups of colliding users
+    """
+    user_ids = []
+    parents = array.array("l")
+    first_user_by_identifier = {}
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for user in users:
+        user = migration_user(user)
+        index = len(user_ids)
+        user_ids.append(user.uid)
+        parents.append(index)
+        for identifier in user_identifiers(user):
+            first_user = first_user_by_identifier.setdefault(identifier, index)
+            if first_user != index:
+                root, other_root = find(first_user), find(index)
+                if root != other_root:
+                    parents[max(root, other_root)] = min(root, other_root)
+
+    # Only users that were joined to another get a group
+    groups = {find(index): [] for index in range(len(user_ids)) if parents[index] != index}
+    for index, user_id in enumerate(user_ids):
+        group = groups.get(find(index))
+        if group is not None:
+            group.append(user_id)
+    return MergePlan(list(groups.values()))
+
+
+def merge_users(members):
+    """
+    Merge Firebase users that collide in Descope into one user.
+
+    The primary user is the one with a password, preferring the most recent sign in, so its
+    password and UID are kept. Fields the primary lacks are taken from the other users, and if any
+    of them is disabled the merged user is disabled too.
+
+    Returns:
+    - MigrationUser: The merged user, with the UIDs of the other users in merged_user_ids
+    """
+
+    def priority(user):
+        return (bool(user.password_hash), int(user.last_login_at or 0), int(user.created_at or 0))
+
+    primary = max(members, key=priority)
+    others = [user for user in members if user is not primary]
+    merged = MigrationUser(
+        **{attribute: getattr(primary, attribute) for attribute in MigrationUser.__slots__}
+    )
+    for attribute in ("email", "phone", "display_name", "given_name", "family_name", "picture"):
+        if not getattr(merged, attribute):
+            for user in others:
+                if getattr(user, attribute):
+                    setattr(merged, attribute, getattr(user, attribute))
+                    break
+    # An identifier is verified if any of the users verified it
+    merged.email_verified = any(
+        user.email_verified
+        for user in members
+        if normalize_email(user.email) == normalize_email(merged.email)
+    )
+    merged.phone_verified = any(
+        user.phone_verified
+        for user in members
+        if normalize_phone(user.phone) == normalize_phone(merged.phone)
+    )
+    merged.disabled = any(user.disabled for user in members)
+    merged.disabled_by_merge = merged.disabled and not primary.disabled
+    merged.merged_user_ids = [user.uid for user in others]
+    return merged
+
+
+### End Merge Planning
+
+### Begin Checkpoint Journal
+
+
+class MigrationJournal:
+    """
+    Durable, on disk record of the migration's progress stored in SQLite.
+
+    The outcome of every user is recorded, and a Firebase page is committed once all of its users have
+    an outcome. A resumed run restarts listing from the last committed page and skips the users of that
+    page which were already migrated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                uid TEXT PRIMARY KEY,
+                login_id TEXT,
+                status TEXT NOT NULL,
+                reason TEXT
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        # Pages in listing order: [next_page_token, uids still waiting for an outcome]
+        self.open_pages = []
+        self.page_by_uid = {}
+
+    def reset(self):
+        """
+        Forget the progress of any previous run.
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM users")
+            self.connection.execute("DELETE FROM state")
+            self.connection.commit()
+
+    def get_state(self, key, default=None):
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)),
+        )
+
+    def resume_page_token(self):
+        """
+        Returns:
+        - str: The page token to resume listing Firebase users from, or None to start from the first page
+        """
+        return self.get_state("page_token")
+
+    def migrated_user_ids(self, user_ids):
+        """
+        Returns:
+        - set: The given user IDs that were already migrated
+        """
+        migrated = set()
+        user_ids = list(user_ids)
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start : start + 500]
+            rows = self.connection.execute(
+                f"SELECT uid FROM users WHERE status = 'migrated' AND uid IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            migrated.update(row[0] for row in rows)
+        return migrated
+
+    def open_page(self, page):
+        """
+        Start tracking a page of Firebase users.
+
+        Returns:
+        - users (list): The users of the page that still need to be migrated
+        """
+        with self.lock:
+            user_ids = [migration_user(user).uid for user in page.users]
+            migrated = self.migrated_user_ids(user_id for user_id in user_ids if user_id)
+            remaining_users = []
+            pending_user_ids = set()
+            for user, user_id in zip(page.users, user_ids):
+                if user_id in migrated:
+                    continue
+                remaining_users.append(user)
+                if user_id:
+                    pending_user_ids.add(user_id)
+
+            open_page = [page.next_page_token, pending_user_ids]
+            self.open_pages.append(open_page)
+            for user_id in pending_user_ids:
+                self.page_by_uid[user_id] = open_page
+            self.commit_finished_pages()
+            return remaining_users
+
+    def record(self, results):
+        """
+        Record the outcome of migrated users, committing every page whose users are all done.
+
+        Args:
+        - results (list): (user_id, login_id, success, reason) tuples
+        """
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO users (uid, login_id, status, reason) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        user_id,
+                        login_id,
+                        "skipped" if success is None else "migrated" if success else "failed",
+                        reason,
+                    )
+                    for user_id, login_id, success, reason in results
+                    if user_id
+                ],
+            )
+            for user_id, _, _, _ in results:
+                open_page = self.page_by_uid.pop(user_id, None)
+                if open_page is not None:
+                    open_page[1].discard(user_id)
+            self.commit_finished_pages()
+
+    def commit_finished_pages(self):
+        committed = False
+        while self.open_pages and not self.open_pages[0][1]:
+            next_page_token, _ = self.open_pages.pop(0)
+            self.set_state("page_token", next_page_token)
+            committed = True
+        if committed:
+            self.set_state("anon_counter", anon.anon_counter)
+        self.connection.commit()
+
+    def restore_anon_counter(self):
+        """
+        Continue numbering anonymous login IDs from where the previous run stopped.
+        """
+        anon.anon_counter = max(anon.anon_counter, self.get_state("anon_counter", 0))
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+### End Checkpoint Journal
+
+### Begin Result Reporting
+
+DEFAULT_FAILURE_SAMPLE_SIZE = 100
+MAX_ERROR_CODES = 50
+RESULT_FIELDS = ("uid", "login_id", "outcome", "stage", "error_code", "reason")
+DESCOPE_ERROR_CODE = re.compile(r"\bE\d{6}\b")
+
+
+class UserResult(namedtuple("UserResult", ["user_id", "login_id", "success", "reason"])):
+    """
+    The outcome of migrating one user: a (user_id, login_id, success, reason) tuple, with the stage
+    a failure happened in and its Descope error code as attributes.
+
+    success is None for users that were skipped.
+    """
+
+    def __new__(
+        cls,
+        user_id,
+        login_id,
+        success,
+        reason,
+        stage=None,
+        error_code=None,
+        disabled_by_merge=False,
+    ):
+        result = super().__new__(cls, user_id, login_id, success, reason)
+        result.stage = stage
+        result.error_code = error_code
+        result.disabled_by_merge = disabled_by_merge
+        if success is False and error_code is None:
+            result.error_code = descope_error_code(reason)
+        return result
+
+    @property
+    def outcome(self):
+        if self.success is None:
+            return "skipped"
+        if self.success and self.stage == "merge":
+            return "merged"
+        return "migrated" if self.success else "failed"
+
+
+def descope_error_code(reason):
+    """
+    Extract the Descope error code of a failure, from its JSON error body or its message
+    """
+    if not reason:
+        return None
+    try:
+        error_code = json.loads(reason).get("errorCode")
+        if error_code:
+            return error_code
+    except (ValueError, AttributeError):
+        pass
+    match = DESCOPE_ERROR_CODE.search(reason)
+    return match.group(0) if match else None
+
+
+class ResultSample(list):
+    """
+    Keeps the first limit items appended to it, and counts all of them in total
+    """
+
+    def __init__(self, limit=DEFAULT_FAILURE_SAMPLE_SIZE):
+        super().__init__()
+        self.limit = limit
+        self.total = 0
+
+    def append(self, item):
+        self.total += 1
+        if len(self) < self.limit:
+            super().append(item)
+
+
+class ResultFileHandler(logging.Handler):
+    """
+    Writes the user results put on the result sink's queue as JSON lines or CSV rows
+    """
+
+    def __init__(self, file, result_format):
+        super().__init__()
+        self.file = file
+        self.result_format = result_format
+        if result_format == "csv":
+            self.writer = csv.writer(file)
+            self.writer.writerow(RESULT_FIELDS)
+
+    def emit(self, record):
+        if self.result_format == "csv":
+            self.writer.writerows(record.rows)
+        else:
+            self.file.writelines(
+                json.dumps(dict(zip(RESULT_FIELDS, row))) + "\n" for row in record.rows
+            )
+
+    def flush(self):
+        self.file.flush()
+
+
+class ResultSink:
+    """
+    Streams the outcome of every user to a JSONL or CSV file.
+
+    Results are put on a queue and written by a background QueueListener through a buffered file,
+    so workers never wait on disk. Only counters are kept in memory: users by outcome, failures by
+    stage, and failures by error code (at most MAX_ERROR_CODES codes, the rest count as 'other').
+    """
+
+    def __init__(self, path, result_format=None, buffer_size=1024 * 1024):
+        self.path = path
+        self.result_format = result_format or ("csv" if path.lower().endswith(".csv") else "jsonl")
+        self.file = open(path, "w", buffering=buffer_size, newline="", encoding="utf-8")
+        self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(
+            self.queue, ResultFileHandler(self.file, self.result_format)
+        )
+        self.listener.start()
+        self.lock = threading.Lock()
+        self.outcomes = {"migrated": 0, "merged": 0, "failed": 0, "skipped": 0}
+        self.failures_by_stage = {}
+        self.failures_by_error_code = {}
+        # Users migrated with a warning, e.g. password_changed, by error code
+        self.warnings_by_code = {}
+
+    def write(self, results):
+        """
+        Args:
+        - results (list): UserResult's or (user_id, login_id, success, reason) tuples
+        """
+        rows = []
+        with self.lock:
+            for result in results:
+                if not isinstance(result, UserResult):
+                    result = UserResult(*result)
+                self.outcomes[result.outcome] += 1
+                if result.success is False:
+                    stage = result.stage or "unknown"
+                    self.failures_by_stage[stage] = self.failures_by_stage.get(stage, 0) + 1
+                    error_code = result.error_code or "unknown"
+                    if (
+                        error_code not in self.failures_by_error_code
+                        and len(self.failures_by_error_code) >= MAX_ERROR_CODES
+                    ):
+                        error_code = "other"
+                    self.failures_by_error_code[error_code] = (
+                        self.failures_by_error_code.get(error_code, 0) + 1
+                    )
+                elif result.success and result.error_code:
+                    self.warnings_by_code[result.error_code] = (
+                        self.warnings_by_code.get(result.error_code, 0) + 1
+                    )
+                rows.append(
+                    (
+                        result.user_id,
+                        result.login_id,
+                        result.outcome,
+                        result.stage,
+                        result.error_code,
+                        result.reason,
+                    )
+                )
+        if rows:
+            self.queue.put_nowait(logging.makeLogRecord({"rows": rows}))
+
+    def close(self):
+        """
+        Write the remaining results and close the file
+        """
+        self.listener.stop()
+        self.file.close()
+
+
+### End Result Reporting
+
+### Begin Dry Run Planning
+
+DEFAULT_PLANNED_REQUEST_SECONDS = 1.0
+LARGEST_PAYLOADS = 10
+
+
+class DryRunPlan:
+    """
+    What a migration would do, collected by a dry run through the real mapping path.
+
+    Users are mapped exactly as in a migration, with their custom attributes flattened, typed and
+    conformed to the schema, but batches are counted instead of sent to Descope.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.users = {"password": 0, "anonymous": 0, "passwordless": 0}
+        self.disabled_users = 0
+        self.merged_users = 0
+        self.failed_users = 0
+        self.requests = {}
+        # Min heap of the (size, uid) of the largest custom attribute payloads
+        self.largest_payloads = []
+        self.mapping_seconds = 0.0
+        self.attribute_types = {}
+        self.type_conflicts = {}
+        # Without the existing attributes of the project, every attribute counts as created
+        self.attribute_requests_upper_bound = False
+        self.started_at = time.monotonic()
+        self.elapsed_seconds = 0.0
+
+    def add_chunk(self, users, mapped_users, failed_users, seconds):
+        """
+        Args:
+        - users (list): The MigrationUser's of the chunk that were mapped
+        - mapped_users (list): The UserObj mapped for each of them
+        - failed_users (int): The number of users of the chunk that failed to map
+        - seconds (float): The time it took to map the chunk
+        """
+        payloads = [
+            (len(json.dumps(user_object.custom_attributes, default=str)), user.uid)
+            for user, user_object in zip(users, mapped_users)
+        ]
+        with self.lock:
+            for user, user_object in zip(users, mapped_users):
+                if user.password_hash:
+                    self.users["password"] += 1
+                elif user_object.password is not None:
+                    self.users["anonymous"] += 1
+                else:
+                    self.users["passwordless"] += 1
+                if user.disabled:
+                    self.disabled_users += 1
+                if user.merged_user_ids:
+                    self.merged_users += len(user.merged_user_ids)
+            for payload in payloads:
+                if len(self.largest_payloads) < LARGEST_PAYLOADS:
+                    heapq.heappush(self.largest_payloads, payload)
+                else:
+                    heapq.heappushpop(self.largest_payloads, payload)
+            self.failed_users += failed_users
+            self.mapping_seconds += seconds
+            if mapped_users:
+                batches = -(-len(mapped_users) // max(1, self.batch_size))
+                self.requests["invite_batch"] = self.requests.get("invite_batch", 0) + batches
+
+    def finish(self, schema):
+        """
+        Record the requests the custom attribute schema would send to Descope
+        """
+        with self.lock:
+            self.elapsed_seconds = time.monotonic() - self.started_at
+            self.attribute_types = dict(schema.attribute_types)
+            self.type_conflicts = {
+                name: sorted(types) for name, types in schema.type_conflicts.items()
+            }
+            if schema.seed_requests:
+                self.requests["customattributes"] = schema.seed_requests
+            if schema.planned_create_requests:
+                self.requests["customattribute/create"] = schema.planned_create_requests
+                self.attribute_requests_upper_bound = not schema.existing_attributes_loaded
+
+    def projected_seconds(self, rate_limit=None, workers=1, request_seconds=DEFAULT_PLANNED_REQUEST_SECONDS):
+        """
+        Project the wall-clock time of the migration.
+
+        Listing and mapping users overlap with the requests to Descope, so the migration takes about
+        as long as the slower of the two: this dry run, or the Descope requests. These are paced by
+        the rate limit when one is set, and otherwise take request_seconds each, workers at a time.
+        """
+        total_requests = sum(self.requests.values())
+        if rate_limit:
+            descope_seconds = total_requests / rate_limit
+        else:
+            descope_seconds = total_requests * request_seconds / max(1, workers)
+        return max(self.elapsed_seconds, descope_seconds), descope_seconds
+
+    def to_dict(self, rate_limit=None, workers=1, request_seconds=DEFAULT_PLANNED_REQUEST_SECONDS):
+        projected_seconds, descope_seconds = self.projected_seconds(
+            rate_limit, workers, request_seconds
+        )
+        return {
+            "users": sum(self.users.values()),
+            "usersByKind": dict(self.users),
+            "disabledUsers": self.disabled_users,
+            "mergedUsers": self.merged_users,
+            "failedUsers": self.failed_users,
+            "requests": dict(self.requests),
+            "attributeRequestsUpperBound": self.attribute_requests_upper_bound,
+            "attributeSchema": self.attribute_types,
+            "attributeTypeConflicts": self.type_conflicts,
+            "largestAttributePayloads": [
+                {"uid": uid, "bytes": size} for size, uid in sorted(self.largest_payloads, reverse=True)
+            ],
+            "dryRunSeconds": round(self.elapsed_seconds, 3),
+            "mappingSeconds": round(self.mapping_seconds, 3),
+            "descopeSeconds": round(descope_seconds, 3),
+            "projectedSeconds": round(projected_seconds, 3),
+            "rateLimit": rate_limit,
+            "workers": workers,
+        }
+
+
+def plan_user_chunk(users, hash_params, plan):
+    """
+    Map a chunk of Firebase users like migrate_user_chunk, adding them to a DryRunPlan instead of
+    creating them in Descope.
+    """
+    started = time.perf_counter()
+    users = [migration_user(user) for user in users]
+    custom_attributes_by_uid = prefetch_chunk_attributes([user.uid for user in users])
+    mapped_users = []
+    planned_users = []
+    failed_users = 0
+    for user in users:
+        try:
+            (user_object,), _, _ = map_firebase_user(user, hash_params, custom_attributes_by_uid)
+        except AuthException as error:
+            logging.error(f"Unable to map user. {user} Error: {error.error_message}")
+            failed_users += 1
+            continue
+        planned_users.append(user)
+        mapped_users.append(user_object)
+    plan.add_chunk(planned_users, mapped_users, failed_users, time.perf_counter() - started)
+
+
+### End Dry Run Planning
+
+### Begin Verification
+
+DEFAULT_VERIFY_PAGE_SIZE = 100
+# The fields of a Descope user compared with the Firebase user it was migrated from
+VERIFIED_FIELDS = (
+    "email",
+    "phone",
+    "name",
+    "givenName",
+    "familyName",
+    "picture",
+    "verifiedEmail",
+    "verifiedPhone",
+    "disabled",
+)
+
+
+def expected_descope_fields(user):
+    """
+    The fields a Firebase user should have in Descope once migrated, as mapped by
+    build_user_object_with_passwords.
+
+    Returns:
+    - login_id (str): The expected login ID, None for anonymous users whose login ID is generated
+    - fields (dict): The expected value of each of VERIFIED_FIELDS
+    """
+    user = migration_user(user)
+    fields = {
+        "email": user.email or "",
+        "phone": user.phone or "",
+        "name": user.display_name or "",
+        "givenName": user.given_name or "",
+        "familyName": user.family_name or "",
+        "picture": user.picture or "",
+        "verifiedEmail": bool(user.email_verified),
+        "verifiedPhone": bool(user.phone_verified) if user.phone else False,
+        "disabled": bool(user.disabled),
+    }
+    return user.email or user.phone or None, fields
+
+
+def descope_user_fields(descope_user):
+    """
+    Returns:
+    - login_id (str): The first login ID of a user returned by the Descope search API
+    - fields (dict): The value of each of VERIFIED_FIELDS
+    """
+    login_ids = descope_user.get("loginIds") or []
+    fields = {
+        "email": descope_user.get("email") or "",
+        "phone": descope_user.get("phone") or "",
+        "name": descope_user.get("name") or "",
+        "givenName": descope_user.get("givenName") or "",
+        "familyName": descope_user.get("familyName") or "",
+        "picture": descope_user.get("picture") or "",
+        "verifiedEmail": bool(descope_user.get("verifiedEmail")),
+        "verifiedPhone": bool(descope_user.get("verifiedPhone")),
+        "disabled": descope_user.get("status") == "disabled",
+    }
+    return (login_ids[0] if login_ids else None), fields
+
+
+def record_hash(fields):
+    """
+    Hash the verified fields of a user, so two users can be compared without keeping their fields
+    """
+    return hashlib.sha256(
+        json.dumps(fields, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def iter_descope_users(page_size=DEFAULT_VERIFY_PAGE_SIZE):
+    """
+    Page through every user of the Descope project with the management search API, through the
+    shared HTTP session and retry engine.
+
+    Args:
+    - page_size (int): The number of users requested per page
 
-"""Load and read environment variables from .env file"""
-load_dotenv()
-FIREBASE_DB_URL = os.getenv("FIREBASE_DB_URL")
-DESCOPE_PROJECT_ID = os.getenv("DESCOPE_PROJECT_ID")
-DESCOPE_MANAGEMENT_KEY = os.getenv("DESCOPE_MANAGEMENT_KEY")
+    Yields:
+    - dict: Each Descope user, as returned by the search API
 
-try:
-    descope_client = DescopeClient(
-        project_id=DESCOPE_PROJECT_ID, management_key=DESCOPE_MANAGEMENT_KEY
-    )
-except AuthException as error:
-    logging.error(f"Failed to initialize Descope Client: {error}")
-    sys.exit()
+    Raises:
+    - requests.RequestException: If a page can't be read, even after retries
+    """
+    url = f"{context.descope_api_url}/v2/mgmt/user/search"
+    page = 0
+    while True:
+        with metrics.stage("descope_search"):
+            response = api_request_with_retry(
+                action="post",
+                url=url,
+                headers=context.management_headers,
+                data=json.dumps({"limit": page_size, "page": page, "withTestUser": False}),
+            )
+        if response is None:
+            raise requests.exceptions.ConnectionError(
+                f"Unable to search Descope users: no response for page {page}"
+            )
+        response.raise_for_status()
+        users = response.json().get("users") or []
+        yield from users
+        if len(users) < page_size:
+            return
+        page += 1
 
-cred = credentials.Certificate(
-    os.getcwd() + "/creds/firebase-certs.json"
-)
 
-if FIREBASE_DB_URL:
-    firebase_admin.initialize_app(cred, {"databaseURL": FIREBASE_DB_URL})
-else:
-    firebase_admin.initialize_app(cred)
+class DescopeUserIndex:
+    """
+    The Descope users keyed by the UUID custom attribute of their Firebase user, stored in SQLite so
+    millions of users can be joined with Firebase in bounded memory. Only the login ID, a hash of the
+    verified fields and the fields themselves (to explain a mismatch) are kept per user.
+    """
 
-attribute_source = None
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS descope_users (
+                uid TEXT PRIMARY KEY,
+                login_id TEXT,
+                hash TEXT NOT NULL,
+                fields TEXT NOT NULL,
+                seen INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self.connection.execute("DELETE FROM descope_users")
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.users = 0
+        # Descope users without a UUID, which weren't migrated from Firebase
+        self.unlinked_users = ResultSample()
+        # Descope users sharing the UUID of another Descope user
+        self.duplicate_users = ResultSample()
 
+    def add(self, descope_users):
+        """
+        Args:
+        - descope_users (iterable): The users returned by the search API, e.g. iter_descope_users()
+        """
+        for chunk in iter_chunks(descope_users, 1000):
+            rows = []
+            for descope_user in chunk:
+                self.users += 1
+                login_id, fields = descope_user_fields(descope_user)
+                user_id = (descope_user.get("customAttributes") or {}).get("UUID")
+                if not user_id:
+                    self.unlinked_users.append(login_id)
+                    continue
+                rows.append((user_id, login_id, record_hash(fields), json.dumps(fields)))
+            with self.lock:
+                for row in rows:
+                    try:
+                        self.connection.execute(
+                            "INSERT INTO descope_users (uid, login_id, hash, fields) VALUES (?, ?, ?, ?)",
+                            row,
+                        )
+                    except sqlite3.IntegrityError:
+                        self.duplicate_users.append(row[1])
+                self.connection.commit()
+        return self
 
-class AnonLoginId:
-  """
-  Class used to create anonymous user emails
-  """
-  def __init__(self):
-    self.anon_counter = 0
+    def lookup(self, user_ids):
+        """
+        Look up Descope users by UID, and mark them as seen.
 
-  def make_anon_login_id(self):
-    login_id = f"anon_user_{self.anon_counter}@anonymous.com"
-    self.anon_counter += 1
-    return login_id
+        Returns:
+        - dict: (login_id, hash, fields JSON) of the given UIDs found in Descope
+        """
+        user_ids = [user_id for user_id in user_ids if user_id]
+        entries = {}
+        with self.lock:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT uid, login_id, hash, fields FROM descope_users WHERE uid IN ({placeholders})",
+                    chunk,
+                )
+                for user_id, login_id, fields_hash, fields in rows:
+                    entries[user_id] = (login_id, fields_hash, fields)
+                self.connection.execute(
+                    f"UPDATE descope_users SET seen = 1 WHERE uid IN ({placeholders})", chunk
+                )
+            self.connection.commit()
+        return entries
 
-anon = AnonLoginId()
+    def iter_unseen(self):
+        """
+        Yields:
+        - (user_id, login_id): The Descope users no Firebase user was looked up for
+        """
+        last_uid = ""
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT uid, login_id FROM descope_users WHERE seen = 0 AND uid > ? ORDER BY uid LIMIT 1000",
+                    (last_uid,),
+                ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_uid = rows[-1][0]
 
-def api_request_with_retry(action, url, headers, data=None, max_retries=4, timeout=10):
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class VerificationReport:
+    """
+    The differences between the Firebase users and the Descope users migrated from them
+    """
+
+    def __init__(self):
+        self.firebase_users = 0
+        self.matched_users = 0
+        self.merged_users = 0
+        self.missing_users = ResultSample()
+        self.extra_users = ResultSample()
+        self.mismatched_users = ResultSample()
+        self.mismatched_fields = {}
+
+    def add_mismatch(self, user_id, login_id, fields):
+        self.mismatched_users.append({"uid": user_id, "loginId": login_id, "fields": fields})
+        for field in fields:
+            self.mismatched_fields[field] = self.mismatched_fields.get(field, 0) + 1
+
+    def to_dict(self, index=None):
+        report = {
+            "firebaseUsers": self.firebase_users,
+            "matchedUsers": self.matched_users,
+            "mergedUsers": self.merged_users,
+            "missingUsers": self.missing_users.total,
+            "extraUsers": self.extra_users.total,
+            "mismatchedUsers": self.mismatched_users.total,
+            "mismatchedFields": dict(
+                sorted(self.mismatched_fields.items(), key=lambda item: -item[1])
+            ),
+            "missingSample": list(self.missing_users),
+            "extraSample": list(self.extra_users),
+            "mismatchedSample": list(self.mismatched_users),
+        }
+        if index is not None:
+            report["descopeUsers"] = index.users
+            report["unlinkedDescopeUsers"] = index.unlinked_users.total
+            report["duplicateDescopeUsers"] = index.duplicate_users.total
+        return report
+
+
+def verify_migration(firebase_users, index, missing_file=None, chunk_size=1000):
     """
-    Handles API requests with additional retry on timeout and rate limit.
+    Stream-join the Firebase users with the Descope users migrated from them, by UID.
+
+    Firebase users are compared by the hash of their verified fields, the fields are only compared
+    one by one to explain a mismatch. Users merged into another user are matched with its Descope user.
 
     Args:
-    - action (string): 'get' or 'post'
-    - url (string): The URL of the path for the api request
-    - headers (dict): Headers to be sent with the request
-    - data (json): Optional and used only for post, but the payload to post
-    - max_retries (int): The max number of retries
-    - timeout (int): The timeout for the request in seconds
+    - firebase_users (iterable): The Firebase users, e.g. iter_firebase_users()
+    - index (DescopeUserIndex): The Descope users
+    - missing_file (file): Optional file the UID of every missing user is written to, one per line
+    - chunk_size (int): The number of Firebase users looked up in the index at once
+
     Returns:
-    - API Response
-    - Or None
+    - VerificationReport: The missing, extra and mismatched users
     """
-    retries = 0
-    while retries < max_retries:
-        try:
-            if action == "get":
-                response = requests.get(url, headers=headers, timeout=timeout)
-            else:
-                response = requests.post(
-                    url, headers=headers, data=data, timeout=timeout
+    report = VerificationReport()
+    for chunk in iter_chunks(firebase_users, chunk_size):
+        users = [migration_user(user) for user in chunk]
+        merged_user_ids = [
+            merged_user_id for user in users for merged_user_id in user.merged_user_ids or []
+        ]
+        entries = index.lookup([user.uid for user in users] + merged_user_ids)
+        for user in users:
+            report.firebase_users += 1 + len(user.merged_user_ids or [])
+            entry = entries.get(user.uid)
+            if entry is None:
+                report.missing_users.append(user.uid)
+                if missing_file is not None:
+                    missing_file.write(f"{user.uid}\n")
+                    missing_file.writelines(
+                        f"{merged_user_id}\n" for merged_user_id in user.merged_user_ids or []
+                    )
+                continue
+            login_id, fields_hash, fields = entry
+            expected_login_id, expected_fields = expected_descope_fields(user)
+            mismatched_fields = []
+            if expected_login_id is not None and login_id != expected_login_id:
+                mismatched_fields.append("loginId")
+            if record_hash(expected_fields) != fields_hash:
+                actual_fields = json.loads(fields)
+                mismatched_fields.extend(
+                    field
+                    for field in VERIFIED_FIELDS
+                    if actual_fields.get(field) != expected_fields[field]
                 )
+            if mismatched_fields:
+                report.add_mismatch(user.uid, login_id, mismatched_fields)
+            else:
+                report.matched_users += 1
+            report.merged_users += len(user.merged_user_ids or [])
+    for user_id, login_id in index.iter_unseen():
+        report.extra_users.append({"uid": user_id, "loginId": login_id})
+    return report
 
-            if (
-                response.status_code != 429
-            ):  # Not a rate limit error, proceed with response
-                return response
 
-            # If rate limit error, prepare for retry
-            retries += 1
-            wait_time = 5**retries
-            logging.info(f"Rate limit reached. Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
+### End Verification
 
-        except requests.exceptions.ReadTimeout as e:
-            # Handle read timeout exception
-            logging.warning(f"Read timed out. (read timeout={timeout}): {e}")
-            retries += 1
-            wait_time = 5**retries
-            logging.info(f"Retrying attempt {retries}/{max_retries}...")
-            time.sleep(
-                wait_time
-            )  # Wait for 5 seconds before retrying or use a backoff strategy
+### Begin Process Functions
 
-        except requests.exceptions.RequestException as e:
-            # Handle other request exceptions
-            logging.error(f"A request exception occurred: {e}")
-            break  # In case of other exceptions, you may want to break the loop
 
-    logging.error("Max retries reached. Giving up.")
-    return None
+DEFAULT_WORKERS = 1
 
 
-### Begin Firebase Actions
+def prefetch_chunk_attributes(user_ids):
+    """
+    Prefetch the custom attributes of a chunk of users, if a source was chosen.
+
+    Returns:
+    - dict: The custom attributes by UID, or None to fetch the attributes of each user on its own
+    """
+    if not attribute_source:
+        return None
+    try:
+        with metrics.stage("attribute_fetch"):
+            return prefetch_custom_attributes(user_ids)
+    except (firebase_admin.exceptions.FirebaseError, GoogleAPIError) as error:
+        # Fall back to fetching the attributes of each user on its own
+        logging.warning(f"Unable to prefetch custom attributes. Error: {error}")
+        return None
 
 
-def fetch_firebase_users():
+PASSWORD_CHANGED_WARNING = (
+    "Created again with the password it changed in Firebase, hashed passwords can only be imported "
+    "when a user is created. Its Descope user ID changed"
+)
+
+
+class MappedChunk:
     """
-    Fetch and parse Firebase users.
+    A chunk of users mapped onto Descope user objects, waiting to be written to Descope
+    """
+
+    def __init__(self, users):
+        self.users = users
+        # UserResult's of the users that won't be written, e.g. failed to map or unchanged
+        self.results = []
+        self.new_user_objects = []
+        self.changed_user_objects = []
+        self.user_ids_by_login_id = {}
+        self.fingerprints_by_login_id = {}
+        # Users whose password changed, deleted and created again to import the new password
+        self.recreated_user_objects = []
+        # (MigrationUser, UserObj) of the users whose password hash_user_chunk still has to build
+        self.unhashed_users = []
+        # The users to create, batch_size per invite_batch request, grouped by batch_user_chunk
+        self.invite_batches = None
+
+
+def map_user_chunk(
+    users,
+    hash_params,
+    custom_attributes_by_uid=None,
+    fingerprints=None,
+    delta=False,
+    flattened_attributes_by_uid=None,
+    hash_passwords=True,
+):
+    """
+    Map a chunk of Firebase users onto the Descope users to create or update, without writing them.
+
+    Args:
+    - users (list): The users fetched from Firebase Admin SDK.
+    - custom_attributes_by_uid (dict): The prefetched custom attributes of the chunk, or None to fetch
+      the attributes of each user on its own
+    - fingerprints (FingerprintIndex): Optional index the fingerprints of migrated users are saved to
+    - delta (bool): Only migrate users that are new or changed since they were saved to fingerprints
+    - flattened_attributes_by_uid (dict): Optional custom attributes already flattened with
+      flatten_custom_attributes
+    - hash_passwords (bool): Whether to build the passwords of the users created, otherwise they
+      are left to hash_user_chunk
 
     Returns:
-    - all_users (Dict): A list of parsed Firebase users if successful, empty list otherwise.
+    - MappedChunk: The mapped users, to pass to write_user_chunk
     """
-    all_users = []
-    page_token = None
+    chunk = MappedChunk([migration_user(user) for user in users])
+    user_ids = [user.uid for user in chunk.users]
 
-    while True:
+    previous_entries = {}
+    if fingerprints is not None and delta:
+        previous_entries = fingerprints.lookup(user_ids)
+
+    unchanged_users = 0
+    for user, user_id in zip(chunk.users, user_ids):
+        previous_entry = previous_entries.get(user_id)
         try:
-            page = auth.list_users(page_token=page_token)
-            for user in page.users:
-                user_dict = user.__dict__
-
-                # Fetch custom attributes from Firebase Database
-                # if FIREBASE_DB_URL:
-                #     custom_attributes = db.reference(
-                #         f"path/to/user/{user.uid}/customAttributes"
-                #     ).get()
-                #     user_dict["customAttributes"] = custom_attributes or {}
-                all_users.append(user_dict)
-
-            if not page.has_next_page:
-                break
+            user_object, login_id, is_disabled = map_firebase_user(
+                user,
+                hash_params,
+                custom_attributes_by_uid,
+                login_id=previous_entry[0] if previous_entry else None,
+                flattened_attributes_by_uid=flattened_attributes_by_uid,
+                # Passwords are built by hash_user_chunk, and only for the users created
+                with_password=False,
+            )
+        except AuthException as error:
+            logging.error(f"Unable to create user. {user}")
+            logging.error(f"Error: {error.error_message}")
+            chunk.results.append(
+                UserResult(user_id or "", None, False, error.error_message, stage="map")
+            )
+            continue
 
-            page_token = page.next_page_token
+        chunk.user_ids_by_login_id[login_id] = user_id or ""
+        (mapped_user,) = user_object
+        if fingerprints is not None:
+            fingerprint = user_fingerprint(mapped_user)
+            password = password_fingerprint(user)
+            chunk.fingerprints_by_login_id[login_id] = (fingerprint, password)
 
-        except firebase_admin.exceptions.FirebaseError as error:
-            logging.error(f"Error fetching Firebase users. Error: {error}")
-            break
+            if previous_entry:
+                _, previous_fingerprint, previous_password = previous_entry
+                if password != previous_password:
+                    # Descope only imports hashed passwords when a user is created
+                    chunk.unhashed_users.append((user, mapped_user))
+                    chunk.recreated_user_objects.append(user_object)
+                    continue
+                if fingerprint == previous_fingerprint:
+                    unchanged_users += 1
+                    chunk.results.append(
+                        UserResult(
+                            user_id, login_id, None, "Unchanged since last migrated", stage="delta"
+                        )
+                    )
+                    continue
+                chunk.changed_user_objects.extend(user_object)
+                continue
 
-    return all_users
+        chunk.unhashed_users.append((user, mapped_user))
+        chunk.new_user_objects.append(user_object)
+    if fingerprints is not None and unchanged_users:
+        fingerprints.count_unchanged(unchanged_users)
+    if hash_passwords:
+        hash_user_chunk(chunk, hash_params)
+    return chunk
 
 
-def fetch_custom_attributes(user_id):
+def hash_user_chunk(chunk, hash_params):
     """
-    Fetch custom attributes for a given user ID from either Realtime Database or Firestore
+    Build the passwords of the users a mapped chunk creates in Descope, see build_user_password.
+    The bcrypt hashing of anonymous users' passwords is CPU bound, so several chunks can be hashed
+    at the same time by different workers.
 
     Args:
-    - user_id (str): The user's ID in Firebase.
+    - chunk (MappedChunk): The users mapped by map_user_chunk without their passwords
+    - hash_params (dict): The password hash parameters of the Firebase project
 
     Returns:
-    - dict: A dictionary of custom attributes.
+    - MappedChunk: The same chunk, with its passwords
     """
-    if attribute_source == "firestore":
-        firestore_db = firestore.client()
-        doc_ref = firestore_db.collection("users").document(user_id)
-        doc_snapshot = doc_ref.get()
-        if doc_snapshot.exists:
-            return doc_snapshot.to_dict() or {}
-        return {}
-    elif attribute_source == "realtime":
-        ref = db.reference(f"users/{user_id}")
-        return ref.get() or {}
-    return {}
+    for user, mapped_user in chunk.unhashed_users:
+        mapped_user.password = build_user_password(user, hash_params)
+    chunk.unhashed_users = []
+    return chunk
 
 
-def set_custom_attribute_source(source):
-    global attribute_source
-    attribute_source = source
-
-
-### End Firebase Actions
+def batch_user_chunk(chunk, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Group the users a mapped chunk creates in Descope into invite_batch requests of at most batch_size
+    users. Users created again because their password changed come first.
 
-### Begin Descope Actions
+    Returns:
+    - MappedChunk: The same chunk, with its invite_batches
+    """
+    batch_size = max(1, batch_size)
+    user_objects = [
+        mapped_user
+        for user_object in chunk.recreated_user_objects + chunk.new_user_objects
+        for mapped_user in user_object
+    ]
+    chunk.invite_batches = [
+        user_objects[start : start + batch_size]
+        for start in range(0, len(user_objects), batch_size)
+    ]
+    return chunk
 
 
-def build_user_object_with_passwords(extracted_user, hash_params):
+def write_user_chunk(chunk, batch_size=DEFAULT_BATCH_SIZE, fingerprints=None):
+    """
+    Create and update the users of a mapped chunk in Descope. Safe to run concurrently from several workers.
+    Users whose password changed are deleted and created again, with their new password.
 
-    if extracted_user["password_hash"]:
-        userPasswordToCreate = UserPassword(
-            hashed=UserPasswordFirebase(
-                hash=extracted_user["password_hash"],
-                salt=extracted_user["salt"],
-                salt_separator=hash_params["salt_separator"],
-                signer_key=hash_params["signer_key"],
-                memory=hash_params["mem_cost"],
-                rounds=hash_params["rounds"],
-            )
-        )
+    Args:
+    - chunk (MappedChunk): The users mapped by map_user_chunk, with their passwords
+    - batch_size (int): The number of users to create per invite_batch request, when the chunk
+      wasn't grouped by batch_user_chunk already
+    - fingerprints (FingerprintIndex): Optional index the fingerprints of migrated users are saved to
 
-        user_object = [
-            UserObj(
-                login_id=extracted_user["login_id"],
-                email=extracted_user["email"],
-                display_name=extracted_user["display_name"],
-                given_name=extracted_user["given_name"],
-                family_name=extracted_user["family_name"],
-                phone=extracted_user["phone"],
-                picture=extracted_user["picture"],
-                verified_email=extracted_user["verified_email"],
-                verified_phone=extracted_user["verified_phone"],
-                password=userPasswordToCreate,
-                custom_attributes=extracted_user["custom_attributes"],
-            )
+    Returns:
+    - results (list): A UserResult for each user of the chunk, success is None for users skipped
+      because they did not change
+    """
+    if chunk.unhashed_users:
+        raise ValueError("The passwords of the chunk weren't built, see hash_user_chunk")
+    if chunk.invite_batches is None:
+        batch_user_chunk(chunk, batch_size)
+    results = list(chunk.results)
+    batch_results = []
+    recreated_login_ids = set()
+    failed_delete_login_ids = set()
+    for user_object in chunk.recreated_user_objects:
+        (mapped_user,) = user_object
+        login_id, success, reason = delete_user(mapped_user.login_id)
+        if not success:
+            user_id = chunk.user_ids_by_login_id.get(login_id)
+            results.append(UserResult(user_id, login_id, False, reason, stage="delete"))
+            failed_delete_login_ids.add(mapped_user.login_id)
+            continue
+        recreated_login_ids.add(login_id)
+    for invite_batch_user_objects in chunk.invite_batches:
+        # A user that couldn't be deleted would only fail to be created again
+        invite_batch_user_objects = [
+            mapped_user
+            for mapped_user in invite_batch_user_objects
+            if mapped_user.login_id not in failed_delete_login_ids
         ]
-        return user_object
-    
-    # Create temporary password if anonymous user
-    elif (not extracted_user["email"]) and (not extracted_user["phone"]):
-        result = os.urandom(12)
-        hash = bcrypt.hashpw(result, bcrypt.gensalt())
-   
-        userPasswordToCreate = UserPassword(
-            hashed=UserPasswordBcrypt(
-                hash=hash.decode('utf-8')
+        if invite_batch_user_objects:
+            batch_results.extend(
+                ("invite_batch", result) for result in invite_batch(invite_batch_user_objects)
             )
+    if chunk.changed_user_objects:
+        batch_results.extend(
+            ("patch_batch", result) for result in patch_batch(chunk.changed_user_objects)
         )
 
-        user_object = [
-            UserObj(
-                login_id=extracted_user["login_id"],
-                email=extracted_user["email"],
-                display_name=extracted_user["display_name"],
-                given_name=extracted_user["given_name"],
-                family_name=extracted_user["family_name"],
-                phone=extracted_user["phone"],
-                picture=extracted_user["picture"],
-                verified_email=extracted_user["verified_email"],
-                verified_phone=extracted_user["verified_phone"],
-                password=userPasswordToCreate,
-                custom_attributes=extracted_user["custom_attributes"],
+    migrated_entries = []
+    for stage, (login_id, success, reason) in batch_results:
+        user_id = chunk.user_ids_by_login_id.get(login_id)
+        if success and login_id in recreated_login_ids:
+            logging.warning(f"Created user {login_id} again, its password changed in Firebase")
+            results.append(
+                UserResult(
+                    user_id,
+                    login_id,
+                    success,
+                    PASSWORD_CHANGED_WARNING,
+                    stage=stage,
+                    error_code="password_changed",
+                )
             )
-        ]
+        else:
+            results.append(UserResult(user_id, login_id, success, reason, stage=stage))
+        if success and user_id and login_id in chunk.fingerprints_by_login_id:
+            migrated_entries.append((user_id, login_id, *chunk.fingerprints_by_login_id[login_id]))
+    if fingerprints is not None and migrated_entries:
+        fingerprints.update(migrated_entries)
 
-        return user_object
+    # The users merged into another user share its outcome
+    merged_users_by_uid = {user.uid: user for user in chunk.users if user.merged_user_ids}
+    if merged_users_by_uid:
+        for index, result in enumerate(list(results)):
+            user = merged_users_by_uid.get(result.user_id)
+            if user is None:
+                continue
+            if user.disabled_by_merge and result.success:
+                results[index] = UserResult(*result, stage=result.stage, disabled_by_merge=True)
+            for merged_user_id in user.merged_user_ids:
+                if result.success is False:
+                    merged_result = UserResult(
+                        merged_user_id,
+                        result.login_id,
+                        False,
+                        result.reason,
+                        stage=result.stage,
+                        error_code=result.error_code,
+                    )
+                else:
+                    merged_result = UserResult(
+                        merged_user_id,
+                        result.login_id,
+                        result.success,
+                        f"Merged into {user.uid}",
+                        stage="merge" if result.success else result.stage,
+                    )
+                results.append(merged_result)
+    return results
 
-    else:
-        user_object = [
-            UserObj(
-                login_id=extracted_user["login_id"],
-                email=extracted_user["email"],
-                display_name=extracted_user["display_name"],
-                given_name=extracted_user["given_name"],
-                family_name=extracted_user["family_name"],
-                phone=extracted_user["phone"],
-                picture=extracted_user["picture"],
-                verified_email=extracted_user["verified_email"],
-                verified_phone=extracted_user["verified_phone"],
-                custom_attributes=extracted_user["custom_attributes"],
-            )
-        ]
-        return user_object
 
+def migrate_user_chunk(
+    users, hash_params, batch_size=DEFAULT_BATCH_SIZE, fingerprints=None, delta=False
+):
+    """
+    Map a chunk of Firebase users and create them in Descope. Safe to run concurrently from several workers.
+    The custom attributes of the whole chunk are prefetched in bulk before the users are mapped.
 
-def invite_batch(user_objects, login_id, is_disabled):
-    # Create the user
-    try:
-        resp = descope_client.mgmt.user.invite_batch(
-            users=user_objects,
-            invite_url="https://localhost",
-            send_mail=False,
-            send_sms=False,
-        )
+    Args:
+    - users (list): The users fetched from Firebase Admin SDK.
+    - batch_size (int): The number of users to create per invite_batch request
+    - fingerprints (FingerprintIndex): Optional index the fingerprints of migrated users are saved to
+    - delta (bool): Only migrate users that are new or changed since they were saved to fingerprints.
+      Changed users are updated in place with patch_batch.
 
-        # Update user status in Descope based on Firebase status
-        if is_disabled:
-            descope_client.mgmt.user.deactivate(login_id=login_id)
-            logging.info(f"User {login_id} deactivated in Descope.")
-        else:
-            descope_client.mgmt.user.activate(login_id=login_id)
-            logging.info(f"User {login_id} activated in Descope.")
+    Returns:
+    - results (list): A UserResult for each user, success is None for users skipped because they
+      did not change
+    """
+    users = [migration_user(user) for user in users]
+    custom_attributes_by_uid = prefetch_chunk_attributes([user.uid for user in users])
+    chunk = map_user_chunk(users, hash_params, custom_attributes_by_uid, fingerprints, delta)
+    return write_user_chunk(chunk, batch_size, fingerprints)
 
-        return True
-    except AuthException as error:
-        logging.error(
-            f"Unable to create users with password. Error: {error.error_message}"
-        )
-        print(f"Unable to create users with password. Error: {error.error_message}")
-        return False
 
+def iter_chunks(items, chunk_size):
+    """
+    Split an iterable into lists of at most chunk_size items without materializing it.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-def create_descope_user(user, hash_params):
+
+PIPELINE_DONE = object()
+
+
+class MigrationPipeline:
     """
-    Create a Descope user based on matched Firebase user data using Descope Python SDK.
+    Stages connected by bounded queues, each stage running in its own worker threads.
 
-    Args:
-    - user (dict): A dictionary containing user details fetched from Firebase Admin SDK.
+    Every stage takes items from the queue in front of it and puts what it returns on the queue of
+    the next stage, blocking while that queue is full. A slow stage therefore only holds back the
+    stages before it once their queues filled up, and memory stays bounded. The first error raised
+    by a stage stops the whole pipeline and is raised again by run().
     """
-    try:
-        # Extracting user data from the nested '_data' structure
-        user_data = user.get("_data", {})
-
-        custom_attributes = {"freshlyMigrated": True}
-        is_disabled = user_data.get("disabled", False)
-        # Use Email if exists, otherwise phone, otherwise is anon user create anon login email
-        login_id = user_data.get("email") if user_data.get("email") else user_data.get("phoneNumber") if user_data.get("phoneNumber") else anon.make_anon_login_id()
-
-        password_hash = user_data.get("passwordHash") or "" 
-        salt = user_data.get("salt") or ""
-
-        # Default Firebase user attributes
-        extracted_user = {
-            "login_id": login_id,
-            "email": user_data.get("email"), #login_id if (not user_data.get("email")) and (not user_data.get("phoneNumber")) else user_data.get("email"), # Uses email if it exists else uses anon_email
-            "phone": user_data.get("phoneNumber"),
-            "display_name": user_data.get("displayName"),
-            "given_name": user_data.get("givenName"),
-            "family_name": user_data.get("familyName"),
-            "picture": user_data.get("photoUrl"),
-            "verified_email": user_data.get("emailVerified", False),
-            "verified_phone": (
-                user_data.get("phoneVerified", False)
-                if user_data.get("phoneNumber")
-                else False
-            ),
-            "custom_attributes": custom_attributes,
-            "is_disabled": is_disabled,
-            "password_hash": password_hash,
-            "salt": salt,
-        }
 
-        #Put the UUID in the UUID custom attribute per user
-        user_id = user_data.get("localId")
-        if user_id:
-            custom_attributes.update({"UUID":user_id})
-        
-        # Fetch custom attributes from Firebase Realtime Database, if URL is provided
-        if FIREBASE_DB_URL:
-            user_id = user_data.get("localId")
-            if user_id:
-                additional_attributes = fetch_custom_attributes(
-                    user_data.get("localId")
-                )
+    def __init__(self, queue_size=2):
+        self.queue_size = max(1, queue_size)
+        # (name, function, workers) of each stage, in order
+        self.stages = []
+        self.queues = {}
+        self.stop_event = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
 
-                if additional_attributes:
-                    flattend_attributes = flatten_dict(additional_attributes)
-                    mapped_dict = {
-                        key: (
-                            "String" if isinstance(value, str) else
-                            "Boolean" if isinstance(value, bool) else
-                            "Number" if isinstance(value, (int, float)) else
-                            "String"
-                        )
-                        for key, value in flattend_attributes.items()
-                    }
+    def add_stage(self, name, function, workers=1):
+        """
+        Args:
+        - name (str): The name of the stage, also the name of the queue in front of it
+        - function (callable): Called with each item, returns the item passed to the next stage
+        - workers (int): The number of threads running the stage
+        """
+        self.stages.append((name, function, max(1, workers)))
+        return self
 
-                    # Create the custom attributes will not make duplicates
-                    create_custom_attributes_in_descope(mapped_dict)
-                    custom_attributes.update(flattend_attributes)
+    def queue_depths(self):
+        return {name: queue_.qsize() for name, queue_ in self.queues.items()}
 
-        # Create the Descope user
-        user_object = build_user_object_with_passwords(extracted_user, hash_params)
-        success = invite_batch(user_object, login_id, is_disabled)
+    def put(self, queue_, item):
+        while not self.stop_event.is_set():
+            try:
+                queue_.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-        return success, False, False, login_id
+    def get(self, queue_):
+        while not self.stop_event.is_set():
+            try:
+                return queue_.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return PIPELINE_DONE
 
-    except AuthException as error:
-        logging.error(f"Unable to create user. {user}")
-        logging.error(f"Error: {error.error_message}")
-        return (
-            False,
-            False,
-            False,
-            user.get("user_id") + " Reason: " + error.error_message,
-        )
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stop_event.set()
 
-def create_custom_attributes_in_descope(custom_attr_dict):
-    """
-    Creates custom attributes in Descope
+    def feed(self, items, outbound):
+        try:
+            for item in items:
+                if not self.put(outbound, item):
+                    return
+        except BaseException as error:
+            self.fail(error)
+        finally:
+            self.put(outbound, PIPELINE_DONE)
 
-    Args:
-    - custom_attr_dict: Dictionary of custom attribute names and assosciated data types {"name" : dataType, ...} 
-    """
+    def work(self, name, function, inbound, outbound, remaining):
+        try:
+            while True:
+                item = self.get(inbound)
+                if item is PIPELINE_DONE:
+                    # Pass the end of the input on to the other workers of this stage
+                    self.put(inbound, PIPELINE_DONE)
+                    break
+                if not self.put(outbound, function(item)):
+                    break
+        except BaseException as error:
+            self.fail(error)
+        finally:
+            with self.lock:
+                remaining[name] -= 1
+                last_worker = remaining[name] == 0
+            if last_worker:
+                self.put(outbound, PIPELINE_DONE)
 
-    type_mapping = {
-        'String': 1,
-        'Number': 2,
-        'Boolean': 3
-    }
-  
-    # Takes indivdual custom attribute and makes a json body for create attribute post request
-    custom_attr_post_body = []
-    for custom_attr_name, custom_attr_type in custom_attr_dict.items():
-        custom_attr_body = {
-            "name": custom_attr_name,
-            "type": type_mapping.get(custom_attr_type, 1), # Defualt to 0 if type not found
-            "options": [],
-            "displayName": custom_attr_name,
-            "defaultValue": {},
-            "viewPermissions": [],
-            "editPermissions": [],
-            "editable": True
-        }
-        custom_attr_post_body.append(custom_attr_body)
+    def run(self, items):
+        """
+        Run the items through every stage.
 
-    #Combine all custom attribute post request bodies into one
-    #Request for custom attributes to be created using a post request
-    try:
-        endpoint = "https://api.descope.com/v1/mgmt/user/customattribute/create"
-        data = {"attributes":custom_attr_post_body}
-        headers = {
-            "Authorization": f"Bearer {DESCOPE_PROJECT_ID}:{DESCOPE_MANAGEMENT_KEY}",
-            "Content-Type": "application/json"
-            }
-        response = api_request_with_retry(
-            action="post",
-            url=endpoint,
-            headers=headers,
-            data=json.dumps(data)
-            )
-        
-        if response.ok:
-            logging.info(f"Custom attributes successfully created in Descope")
-        else: 
-            response.raise_for_status()
+        Args:
+        - items (iterable): The input of the first stage, consumed by a background thread
 
-    except requests.HTTPError as e:
-        error_dict = {
-            "status_code":e.response.status_code,
-            "error_reason":e.response.reason,
-            "error_message":e.response.text
-            }
-        logging.error(f"Failed to create custom Attributes: {str(error_dict)}")
+        Yields:
+        - The output of the last stage, in the order it is produced
+        """
+        self.queues = {
+            name: queue.Queue(maxsize=self.queue_size) for name, _, _ in self.stages
+        }
+        output = queue.Queue(maxsize=self.queue_size)
+        inbound_queues = list(self.queues.values())
+        outbound_queues = inbound_queues[1:] + [output]
+        remaining = {name: workers for name, _, workers in self.stages}
+        threads = [
+            threading.Thread(
+                target=self.feed,
+                args=(items, inbound_queues[0]),
+                name="pipeline-feed",
+                daemon=True,
+            )
+        ]
+        for (name, function, workers), inbound, outbound in zip(
+            self.stages, inbound_queues, outbound_queues
+        ):
+            threads.extend(
+                threading.Thread(
+                    target=self.work,
+                    args=(name, function, inbound, outbound, remaining),
+                    name=f"pipeline-{name}-{index}",
+                    daemon=True,
+                )
+                for index in range(workers)
+            )
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self.get(output)
+                if item is PIPELINE_DONE:
+                    break
+                yield item
+        finally:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+            # Drop what is left, e.g. the end of input markers
+            for queue_ in self.queues.values():
+                while not queue_.empty():
+                    queue_.get_nowait()
+        if self.error is not None:
+            raise self.error
 
 
-def flatten_dict(dictionary, parent_key='', separator='_' ):
+class AttributeFlattener:
     """
-    Takes a dictonary and flattens it if it has nested attributes. 
-    Nested attribute names will be Root.Parents.AttributeName
-
-    Args:
-    - dictionary: dictionary of attributes some of which may be nested
-    - parent_key: used for recursion and defines the root key for attribute names
-    - separator: will be the seperating delimiter between root,parents, and attribute name
+    Flattens the custom attributes of chunks of users with flatten_custom_attributes, in a pool of
+    processes so large attribute documents don't hold the other stages back. With 0 workers the
+    attributes are flattened in the calling thread.
     """
-    items = []
-    for key, value in dictionary.items():
-        new_key = parent_key + separator + key if parent_key else key
-        if isinstance(value, MutableMapping):
-            items.extend(flatten_dict(value,new_key,separator=separator).items())
-        else:
-            items.append((new_key,value))
-    return dict(items)
 
-### End Descope Actions:
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.executor = None
+        if workers:
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
 
-### Begin Process Functions
+    def flatten(self, custom_attributes_by_uid):
+        if not custom_attributes_by_uid:
+            return None
+        with metrics.stage("flatten"):
+            if self.executor is not None:
+                try:
+                    # The limits are passed along, the other processes only have the defaults
+                    return self.executor.submit(
+                        flatten_custom_attributes, custom_attributes_by_uid, attribute_limits
+                    ).result()
+                except (pickle.PicklingError, TypeError) as error:
+                    # Some attribute values can't be sent to another process
+                    logging.warning(f"Flattening custom attributes in process. Error: {error}")
+            return flatten_custom_attributes(custom_attributes_by_uid)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
 
-def process_users(api_response_users, hash_params, dry_run):
+def process_users(
+    api_response_users,
+    hash_params,
+    dry_run,
+    batch_size=DEFAULT_BATCH_SIZE,
+    workers=DEFAULT_WORKERS,
+    journal=None,
+    fingerprints=None,
+    delta=False,
+    result_sink=None,
+    plan=None,
+    transform_workers=0,
+    queue_size=None,
+    hash_workers=None,
+):
     """
-    Process the list of users from Firebase by mapping and creating them in Descope.
+    Process the users from Firebase by mapping and creating them in Descope.
+
+    Users are consumed incrementally, so a generator such as iter_firebase_users() can be passed
+    in to start migrating before the whole Firebase user list has been fetched. Chunks of users
+    flow through a MigrationPipeline: their custom attributes are fetched, flattened, the users
+    are mapped, their passwords hashed, grouped into batches, then created in Descope batch_size
+    users per request. The stages run concurrently, so the migration is only as slow as its slowest
+    stage. The fetch and write stages run in `workers` threads each, the hash stage in
+    `hash_workers` threads, and all of them share the module's rate_limiter.
 
     Args:
-    - api_response_users (list): A list of users fetched from Firebase Admin SDK.
+    - api_response_users (iterable): The users fetched from Firebase Admin SDK.
+    - batch_size (int): The number of users to create per invite_batch request
+    - workers (int): The number of chunks to migrate concurrently
+    - journal (MigrationJournal): Optional journal the outcome of every user is recorded in
+    - fingerprints (FingerprintIndex): Optional index the fingerprints of migrated users are saved to
+    - delta (bool): Only migrate users that are new or changed according to fingerprints
+    - result_sink (ResultSink): Optional sink the outcome of every user is streamed to
+    - plan (DryRunPlan): The plan a dry run adds the mapped users to
+    - transform_workers (int): The number of processes flattening custom attributes, 0 to flatten
+      them in a thread
+    - queue_size (int): The number of chunks queued in front of each stage (default: the number of workers)
+    - hash_workers (int): The number of chunks whose passwords are hashed concurrently (default: the
+      number of workers)
+
+    Returns:
+    - failed_users (ResultSample): The first failures, with the number of failed users as .total
+    - successful_migrated_users (int): The number of users migrated
+    - merged_users (int): The number of users merged into another user
+    - disabled_users_mismatch (ResultSample): The first users disabled because of a merge
     """
-    failed_users = []
+    failed_users = ResultSample()
     successful_migrated_users = 0
     merged_users = 0
-    disabled_users_mismatch = []
-    if dry_run:
-        print(f"Would migrate {len(api_response_users)} users from Firebase to Descope")
-    else:
-        print(
-            f"Starting migration of {len(api_response_users)} users found via Firebase Admin SDK"
-        )
-        # create freshlyMigrated and UUID custom attributes 
-        freshly_migrated = {"freshlyMigrated":"Boolean"}
-        uuid_attribute = {"UUID":"String"}
-        create_custom_attributes_in_descope(freshly_migrated)
-        create_custom_attributes_in_descope(uuid_attribute)
-        
-        for user in api_response_users:
-            success, merged, disabled_mismatch, user_id_error = create_descope_user(
-                user, hash_params
-            )
+    disabled_users_mismatch = ResultSample()
+
+    def record_results(results):
+        nonlocal successful_migrated_users, merged_users
+        if not results:
+            return
+        if journal is not None:
+            journal.record(results)
+        if result_sink is not None:
+            result_sink.write(results)
+        for result in results:
+            user_id, login_id, success, reason = result
+            if success is None:
+                continue
             if success:
                 successful_migrated_users += 1
-                if merged:
+                if getattr(result, "stage", None) == "merge":
                     merged_users += 1
-                    if success and disabled_mismatch:
-                        disabled_users_mismatch.append(user_id_error)
+                if getattr(result, "disabled_by_merge", False):
+                    disabled_users_mismatch.append(login_id)
             else:
-                failed_users.append(user_id_error)
-            if successful_migrated_users > 0 and (successful_migrated_users % 10 == 0):
-                print(f"Still working, migrated {successful_migrated_users} users.")
+                failed_users.append(f"{login_id or user_id} Reason: {reason}")
+        metrics.count_users(
+            migrated=sum(1 for result in results if result[2]),
+            failed=sum(1 for result in results if result[2] is False),
+            skipped=sum(1 for result in results if result[2] is None),
+        )
+
+    if dry_run:
+        # Map every user for real, but only count what would be sent to Descope
+        plan = plan if plan is not None else DryRunPlan(batch_size)
+        schema_dry_run, attribute_schema.dry_run = attribute_schema.dry_run, True
+        try:
+            attribute_schema.ensure({"freshlyMigrated": "Boolean", "UUID": "String"})
+            for chunk in iter_chunks(api_response_users, max(1, batch_size)):
+                plan_user_chunk(chunk, hash_params, plan)
+        finally:
+            attribute_schema.dry_run = schema_dry_run
+        plan.finish(attribute_schema)
+        print(f"Would migrate {sum(plan.users.values())} users from Firebase to Descope")
+    else:
+        print("Starting migration of users found via Firebase Admin SDK")
+        # create freshlyMigrated and UUID custom attributes 
+        attribute_schema.ensure({"freshlyMigrated": "Boolean", "UUID": "String"})
+
+        workers = max(1, workers)
+        flattener = AttributeFlattener(transform_workers)
+
+        def fetch_attributes(chunk):
+            users = [migration_user(user) for user in chunk]
+            return users, prefetch_chunk_attributes([user.uid for user in users])
+
+        def flatten_attributes(item):
+            users, custom_attributes_by_uid = item
+            return users, custom_attributes_by_uid, flattener.flatten(custom_attributes_by_uid)
+
+        def map_users(item):
+            users, custom_attributes_by_uid, flattened_attributes_by_uid = item
+            return map_user_chunk(
+                users,
+                hash_params,
+                custom_attributes_by_uid,
+                fingerprints,
+                delta,
+                flattened_attributes_by_uid,
+                hash_passwords=False,
+            )
+
+        def hash_passwords(chunk):
+            return hash_user_chunk(chunk, hash_params)
+
+        def batch_users(chunk):
+            return batch_user_chunk(chunk, batch_size)
+
+        def write_users(chunk):
+            return write_user_chunk(chunk, batch_size, fingerprints)
+
+        pipeline = (
+            MigrationPipeline(queue_size or workers)
+            .add_stage("attributes", fetch_attributes, workers)
+            .add_stage("transform", flatten_attributes, max(1, transform_workers))
+            .add_stage("map", map_users)
+            .add_stage("hash", hash_passwords, hash_workers or workers)
+            .add_stage("batch", batch_users)
+            .add_stage("write", write_users, workers)
+        )
+        metrics.watch_queues(pipeline.queue_depths)
+        try:
+            for results in pipeline.run(
+                iter_chunks(api_response_users, max(1, batch_size))
+            ):
+                record_results(results)
+        finally:
+            flattener.close()
     return (
         failed_users,
         successful_migrated_users,
@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import multiprocessing
+
+import migration_utils
+
+
+DEFAULT_PARALLEL_PROJECTS = 4
+DEFAULT_MANIFEST_LOG_DIRECTORY = os.path.join("logs", "projects")
+
+# Settings of a project that may also be given once in the manifest's "defaults"
+PROJECT_DEFAULTS = {
+    "firebaseDbUrl": None,
+    "attributeSource": None,
+    "importFile": None,
+    "snapshotIn": None,
+    "descopeBaseUrl": None,
+    "descopeManagementKey": None,
+    "descopeManagementKeyEnv": None,
+    "rateLimit": None,
+    "batchSize": migration_utils.DEFAULT_BATCH_SIZE,
+    "workers": migration_utils.DEFAULT_WORKERS,
+    "pageSize": migration_utils.DEFAULT_PAGE_SIZE,
+    "anonPasswordRounds": migration_utils.DEFAULT_ANON_PASSWORD_ROUNDS,
+    "anonPasswordWorkers": 1,
+    "delta": False,
+}
+REQUIRED_PROJECT_SETTINGS = ("name", "passwordHash", "descopeProjectId")
+
+
+def load_manifest(path):
+    """
+    Load a manifest of the Firebase projects to migrate, and the Descope project of each.
+
+    The manifest is a JSON object with a "projects" list. Every project needs a unique "name", the
+    "passwordHash" file of its Firebase project, the "descopeProjectId" to migrate into, and the
+    management key of that Descope project: either "descopeManagementKey" or the name of the
+    environment variable holding it in "descopeManagementKeyEnv". Settings shared by every project
+    can be given once in "defaults".
+
+    Returns:
+    - list: The settings of each project, with the defaults filled in
+    """
+    with open(path) as file:
+        manifest = json.load(file)
+    defaults = {**PROJECT_DEFAULTS, **manifest.get("defaults", {})}
+    projects = []
+    names = set()
+    for index, entry in enumerate(manifest.get("projects") or []):
+        project = {**defaults, **entry}
+        missing = [name for name in REQUIRED_PROJECT_SETTINGS if not project.get(name)]
+        if missing:
+            raise ValueError(f"Project {index} of {path} is missing {', '.join(missing)}")
+        if project["name"] in names:
+            raise ValueError(f"Project name {project['name']} is used twice in {path}")
+        if bool(project["descopeManagementKey"]) == bool(project["descopeManagementKeyEnv"]):
+            # Falling back to DESCOPE_MANAGEMENT_KEY could write to a project with another project's key
+            raise ValueError(
+                f"Project {project['name']} needs either descopeManagementKey or descopeManagementKeyEnv"
+            )
+        if project["descopeManagementKeyEnv"] and not os.environ.get(
+            project["descopeManagementKeyEnv"]
+        ):
+            raise ValueError(
+                f"Project {project['name']} reads its management key from {project['descopeManagementKeyEnv']}, which isn't set"
+            )
+        if project["attributeSource"] not in (None, "firestore", "realtime"):
+            raise ValueError(
+                f"Project {project['name']} has an unknown attributeSource {project['attributeSource']}"
+            )
+        names.add(project["name"])
+        project.setdefault(
+            "firebaseCredentials", os.path.join("creds", project["name"], "firebase-certs.json")
+        )
+        projects.append(project)
+    if not projects:
+        raise ValueError(f"{path} doesn't list any projects")
+    return projects
+
+
+def descope_target(project):
+    return (project["descopeProjectId"], project["descopeBaseUrl"] or migration_utils.DESCOPE_API_URL)
+
+
+def shared_rate_limiters(projects):
+    """
+    Create one SharedRateLimiter per Descope project, shared by every Firebase project migrated into
+    it. When these projects set different rate limits, the lowest one applies.
+
+    Returns:
+    - dict: The SharedRateLimiter of each Descope project, keyed by (project ID, base URL)
+    """
+    rates = {}
+    for project in projects:
+        target = descope_target(project)
+        rates.setdefault(target, None)
+        if project["rateLimit"] is not None:
+            rates[target] = min(project["rateLimit"], rates[target] or project["rateLimit"])
+    return {target: migration_utils.SharedRateLimiter(rate=rate) for target, rate in rates.items()}
+
+
+def migrate_project(project, rate_limiter, log_directory, resume):
+    """
+    Migrate a single Firebase project into its Descope project, in the current process.
+
+    Returns:
+    - dict: The summary of the project's migration
+    """
+    project_directory = os.path.join(log_directory, project["name"])
+    migration_utils.configure_logging(project_directory)
+    management_key = project["descopeManagementKey"]
+    if project["descopeManagementKeyEnv"]:
+        management_key = os.environ.get(project["descopeManagementKeyEnv"])
+    migration_utils.set_migration_context(
+        migration_utils.MigrationContext(
+            descope_project_id=project["descopeProjectId"],
+            descope_management_key=management_key,
+            descope_base_url=project["descopeBaseUrl"],
+            firebase_db_url=project["firebaseDbUrl"],
+            firebase_credentials=project["firebaseCredentials"],
+        )
+    )
+    migration_utils.set_rate_limiter(rate_limiter)
+    migration_utils.context.connect(
+        firebase=not (project["importFile"] or project["snapshotIn"])
+    )
+    if not os.path.isfile(project["passwordHash"]):
+        raise FileNotFoundError(f"Password hash parameters {project['passwordHash']} not found")
+    hash_params = migration_utils.parse_hash_params(project["passwordHash"])
+
+    snapshot = None
+    attribute_source = project["attributeSource"]
+    if project["snapshotIn"]:
+        snapshot = migration_utils.FirebaseSnapshot(project["snapshotIn"])
+        attribute_source = "snapshot" if snapshot.attribute_source else None
+    migration_utils.set_custom_attribute_source(attribute_source, snapshot)
+    migration_utils.anon_passwords.configure(
+        rounds=project["anonPasswordRounds"], workers=project["anonPasswordWorkers"]
+    )
+    migration_utils.configure_http_session(
+        pool_size=max(migration_utils.DEFAULT_POOL_SIZE, project["workers"])
+    )
+
+    fingerprints = migration_utils.FingerprintIndex(
+        os.path.join(project_directory, "migration_state.sqlite")
+    )
+    journal = migration_utils.MigrationJournal(
+        os.path.join(project_directory, "migration_journal.sqlite")
+    )
+    page_token = None
+    if resume:
+        page_token = journal.resume_page_token()
+        journal.restore_anon_counter()
+    else:
+        journal.reset()
+
+    if snapshot is not None:
+        pages = snapshot.iter_pages(start_offset=int(page_token or 0), page_size=project["pageSize"])
+    elif project["importFile"]:
+        pages = migration_utils.iter_export_file_pages(
+            project["importFile"], start_offset=int(page_token or 0)
+        )
+    else:
+        pages = migration_utils.iter_firebase_user_pages(
+            page_token=page_token, page_size=project["pageSize"]
+        )
+    firebase_users = migration_utils.CountedUsers(
+        migration_utils.iter_firebase_users(journal=journal, pages=pages)
+    )
+    result_sink = migration_utils.ResultSink(
+        os.path.join(project_directory, "migration_results.jsonl")
+    )
+    migration_utils.metrics.start()
+    started = time.monotonic()
+    try:
+        migration_utils.process_users(
+            firebase_users,
+            hash_params,
+            False,
+            batch_size=project["batchSize"],
+            workers=project["workers"],
+            journal=journal,
+            fingerprints=fingerprints,
+            delta=project["delta"],
+            result_sink=result_sink,
+        )
+    finally:
+        result_sink.close()
+        journal.close()
+        fingerprints.close()
+        migration_utils.anon_passwords.close()
+        if snapshot is not None:
+            snapshot.close()
+
+    snapshot_metrics = migration_utils.metrics.snapshot()
+    return {
+        "name": project["name"],
+        "descopeProjectId": project["descopeProjectId"],
+        "firebaseUsers": firebase_users.count,
+        "outcomes": dict(result_sink.outcomes),
+        "failuresByStage": dict(result_sink.failures_by_stage),
+        "failuresByErrorCode": dict(result_sink.failures_by_error_code),
+        "retries": sum(snapshot_metrics["retries"].values()),
+        "rateLimited": sum(snapshot_metrics["rateLimited"].values()),
+        "seconds": round(time.monotonic() - started, 1),
+        "resultsFile": result_sink.path,
+    }
+
+
+def run_project(project, rate_limiter, log_directory, resume, summaries):
+    """
+    Entry point of a project's worker process. Puts the project's summary, or its error, on summaries.
+    """
+    try:
+        summary = migrate_project(project, rate_limiter, log_directory, resume)
+    except SystemExit:
+        # Raised when the Descope credentials are rejected, the reason is in the project's log
+        summary = {
+            "name": project["name"],
+            "error": f"Stopped, see the log in {os.path.join(log_directory, project['name'])}",
+        }
+    except Exception as error:
+        summary = {"name": project["name"], "error": f"{type(error).__name__}: {error}"}
+    summaries.put(summary)
+
+
+def run_projects(
+    projects,
+    parallel=DEFAULT_PARALLEL_PROJECTS,
+    log_directory=DEFAULT_MANIFEST_LOG_DIRECTORY,
+    resume=False,
+):
+    """
+    Migrate every project in its own process, at most parallel projects at a time.
+
+    Args:
+    - projects (list): The projects, as loaded by load_manifest()
+    - parallel (int): The max number of projects migrated at the same time
+    - log_directory (str): Every project writes its logs, journal and results to a subdirectory
+    - resume (bool): Resume every project from its journal
+
+    Returns:
+    - list: The summary of each project, in the order they finished
+    """
+    mp_context = multiprocessing.get_context("spawn")
+    rate_limiters = shared_rate_limiters(projects)
+    summaries = mp_context.Queue()
+    pending = list(projects)
+    running = {}
+    finished = []
+    while pending or running:
+        while pending and len(running) < max(1, parallel):
+            project = pending.pop(0)
+            process = mp_context.Process(
+                target=run_project,
+                args=(project, rate_limiters[descope_target(project)], log_directory, resume, summaries),
+                name=f"migrate-{project['name']}",
+            )
+            process.start()
+            running[project["name"]] = process
+            print(f"Started migrating {project['name']} into {project['descopeProjectId']}")
+        try:
+            summary = summaries.get(timeout=1)
+        except queue.Empty:
+            # run_project always reports, a process that exited with an error code was killed
+            crashed = [
+                name
+                for name, process in running.items()
+                if not process.is_alive() and process.exitcode != 0
+            ]
+            if not crashed:
+                continue
+            summary = {
+                "name": crashed[0],
+                "error": f"Process exited with code {running[crashed[0]].exitcode}",
+            }
+        running.pop(summary["name"]).join()
+        finished.append(summary)
+        if "error" in summary:
+            print(f"Failed to migrate {summary['name']}: {summary['error']}")
+        else:
+            print(
+                f"Finished migrating {summary['name']}: {summary['outcomes']['migrated']} migrated, "
+                f"{summary['outcomes']['failed']} failed in {summary['seconds']}s"
+            )
+    return finished
+
+
+def aggregate_report(summaries):
+    """
+    Returns:
+    - dict: The totals over every project, along with the summary of each project
+    """
+    totals = {"migrated": 0, "merged": 0, "failed": 0, "skipped": 0}
+    firebase_users = 0
+    failures_by_error_code = {}
+    for summary in summaries:
+        if "error" in summary:
+            continue
+        firebase_users += summary["firebaseUsers"]
+        for outcome, count in summary["outcomes"].items():
+            totals[outcome] = totals.get(outcome, 0) + count
+        for error_code, count in summary["failuresByErrorCode"].items():
+            failures_by_error_code[error_code] = failures_by_error_code.get(error_code, 0) + count
+    return {
+        "projects": len(summaries),
+        "failedProjects": sorted(summary["name"] for summary in summaries if "error" in summary),
+        "firebaseUsers": firebase_users,
+        "outcomes": totals,
+        "failuresByErrorCode": dict(
+            sorted(failures_by_error_code.items(), key=lambda item: -item[1])
+        ),
+        "projectSummaries": sorted(summaries, key=lambda summary: summary["name"]),
+    }
+
+
+def main():
+    """
+    Migrate several Firebase projects in parallel, each into its Descope project, from a manifest.
+    """
+    parser = argparse.ArgumentParser(
+        description="Migrate several Firebase projects to Descope in parallel, as listed in a manifest."
+    )
+    parser.add_argument("manifest", help="JSON manifest of the projects to migrate")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_PARALLEL_PROJECTS,
+        help="Max number of projects migrated at the same time",
+    )
+    parser.add_argument(
+        "--log-directory",
+        default=DEFAULT_MANIFEST_LOG_DIRECTORY,
+        help="Every project writes its logs, journal and results to a subdirectory named after it",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="Resume every project from its journal"
+    )
+    parser.add_argument(
+        "--report",
+        default=os.path.join("logs", "orchestrator_report.json"),
+        help="Where to write the aggregated report",
+    )
+    args = parser.parse_args()
+
+    try:
+        projects = load_manifest(args.manifest)
+    except (OSError, ValueError) as error:
+        print(f"Unable to load the manifest: {error}")
+        sys.exit(1)
+
+    summaries = run_projects(
+        projects, parallel=args.parallel, log_directory=args.log_directory, resume=args.resume
+    )
+    report = aggregate_report(summaries)
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print("=================== Multi-Project Migration ====================")
+    print(f"Projects {report['projects']}, failed {len(report['failedProjects'])}")
+    for name in report["failedProjects"]:
+        print(f"  Failed: {name}")
+    outcomes = report["outcomes"]
+    print(f"Firebase users {report['firebaseUsers']}")
+    print(
+        f"Migrated {outcomes['migrated']}, merged {outcomes['merged']}, failed {outcomes['failed']}, skipped {outcomes['skipped']}"
+    )
+    for error_code, count in list(report["failuresByErrorCode"].items())[:10]:
+        print(f"  Error {error_code}: {count}")
+    print(f"Full report written to {args.report}")
+    if report["failedProjects"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,85 @@
+import csv
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+import io
+import multiprocessing
+import time
 import unittest
 from unittest.mock import patch, MagicMock
-from src.migration_utils import fetch_firebase_users, create_descope_user
+from descope import RateLimitException
+from src.migration_utils import (
+    fetch_firebase_users,
+    create_descope_user,
+    iter_firebase_user_pages,
+    iter_firebase_users,
+    CountedUsers,
+    UserBatcher,
+    RateLimiter,
+    process_users,
+    prefetch_custom_attributes,
+    set_custom_attribute_source,
+    CustomAttributeSchema,
+    discover_custom_attribute_schema,
+    FirebaseUserPage,
+    MigrationJournal,
+    FingerprintIndex,
+    migrate_user_chunk,
+    build_user_password,
+    user_updated_since,
+    api_request_with_retry,
+    sdk_request_with_retry,
+    configure_http_session,
+    RetryEngine,
+    RetryGiveUp,
+    iter_export_file_pages,
+    MigrationContext,
+    AnonPasswordPool,
+    MigrationUser,
+    map_firebase_user,
+    MigrationMetrics,
+    MetricsReporter,
+    ResultSink,
+    ResultSample,
+    UserResult,
+    build_merge_plan,
+    DryRunPlan,
+    FirebaseSnapshot,
+    MigrationPipeline,
+    DescopeUserIndex,
+    iter_descope_users,
+    verify_migration,
+    AttributeLimits,
+    SharedRateLimiter,
+    flatten_attributes,
+    flatten_dict,
+    infer_custom_attribute_types,
+    fetch_custom_attributes,
+)
+
+# The command line tools import migration_utils from src/, like when they are run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+import benchmark
+import orchestrate
+
+
+PASSWORD_HASH_PARAMS = """hash_config {
+  algorithm: SCRYPT,
+  base64_signer_key: c2lnbmVyLWtleQ==,
+  base64_salt_separator: Bw==,
+  rounds: 8,
+  mem_cost: 14,
+}
+"""
+
+
+def take_rate_limit_tokens(limiter, count):
+    for _ in range(count):
+        limiter.acquire()
 
 
 class TestMigration(unittest.TestCase):
@@ -45,6 +124,1099 @@ class TestMigration(unittest.TestCase):
         user_data = {"localId": "mockuser"}
         result = create_descope_user(user_data)
 
+    @patch("src.migration_utils.context")
+    @patch("src.migration_utils.auth.list_users")
+    def test_iter_firebase_user_pages_follows_page_tokens(self, mock_list_users, mock_context):
+        def make_page(uids, next_token):
+            page = MagicMock()
+            page.users = []
+            for uid in uids:
+                user = MagicMock()
+                user.__dict__ = {"_data": {"localId": uid}}
+                page.users.append(user)
+            page.has_next_page = next_token is not None
+            page.next_page_token = next_token
+            return page
+
+        mock_list_users.side_effect = [
+            make_page(["user1", "user2"], "token2"),
+            make_page(["user3"], None),
+        ]
+
+        pages = list(iter_firebase_user_pages(page_size=2, max_buffered_pages=1))
+
+        self.assertEqual(len(pages), 2)
+        self.assertIsNone(pages[0].page_token)
+        self.assertEqual(pages[0].next_page_token, "token2")
+        self.assertEqual(pages[1].page_token, "token2")
+        self.assertEqual(pages[1].users[0]["_data"]["localId"], "user3")
+        mock_list_users.assert_any_call(
+            page_token="token2", max_results=2, app=mock_context.firebase_app
+        )
+
+    @patch("src.migration_utils.context")
+    @patch("src.migration_utils.auth.list_users")
+    def test_iter_firebase_users_raises_when_a_page_fails(self, mock_list_users, mock_context):
+        page = MagicMock()
+        user = MagicMock()
+        user.__dict__ = {"_data": {"localId": "user1"}}
+        page.users = [user]
+        page.has_next_page = True
+        page.next_page_token = "token2"
+        mock_list_users.side_effect = [page, ConnectionError("connection reset")]
+
+        users = []
+        with self.assertRaises(ConnectionError):
+            for user in iter_firebase_users(page_size=1):
+                users.append(user)
+        self.assertEqual(len(users), 1)
+
+    def test_counted_users_counts_while_streaming(self):
+        users = CountedUsers(iter([{"_data": {}}, {"_data": {}}]))
+        self.assertEqual(users.count, 0)
+        self.assertEqual(len(list(users)), 2)
+        self.assertEqual(users.count, 2)
+
+    @patch("src.migration_utils.descope_client")
+    def test_user_batcher_sends_one_request_per_batch(self, mock_descope_client):
+        mock_user_api = mock_descope_client.mgmt.user
+        mock_user_api.invite_batch.return_value = {
+            "createdUsers": [{"loginIds": ["a@test.com"]}],
+            "failedUsers": [
+                {"failure": "invalid phone", "user": {"loginIds": ["b@test.com"]}}
+            ],
+        }
+        batcher = UserBatcher(batch_size=2)
+
+        user_a = MagicMock(login_id="a@test.com")
+        user_b = MagicMock(login_id="b@test.com")
+        self.assertEqual(batcher.add([user_a]), [])
+        results = batcher.add([user_b])
+
+        mock_user_api.invite_batch.assert_called_once()
+        self.assertEqual(
+            mock_user_api.invite_batch.call_args.kwargs["users"], [user_a, user_b]
+        )
+        self.assertEqual(
+            results,
+            [("a@test.com", True, None), ("b@test.com", False, "invalid phone")],
+        )
+        self.assertEqual(batcher.flush(), [])
+        mock_user_api.activate.assert_not_called()
+        mock_user_api.deactivate.assert_not_called()
+
+    def test_rate_limiter_backoff_pauses_all_callers(self):
+        limiter = RateLimiter()
+        limiter.backoff(0.2)
+        started = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    @patch("src.migration_utils.attribute_schema")
+    @patch("src.migration_utils.descope_client")
+    def test_process_users_with_workers_counts_every_user(
+        self, mock_descope_client, mock_attribute_schema
+    ):
+        def invite_batch(users, **kwargs):
+            return {
+                "createdUsers": [{"loginIds": [u.login_id]} for u in users],
+                "failedUsers": [],
+            }
+
+        mock_descope_client.mgmt.user.invite_batch.side_effect = invite_batch
+        users = (
+            {
+                "_data": {
+                    "localId": f"user{i}",
+                    "email": f"user{i}@test.com",
+                    "disabled": i % 5 == 0,
+                }
+            }
+            for i in range(25)
+        )
+
+        failed, migrated, merged, mismatched = process_users(
+            users, {}, False, batch_size=4, workers=3
+        )
+
+        self.assertEqual(failed, [])
+        self.assertEqual(migrated, 25)
+        self.assertEqual(mock_descope_client.mgmt.user.invite_batch.call_count, 7)
+        statuses = [
+            user.status
+            for call in mock_descope_client.mgmt.user.invite_batch.call_args_list
+            for user in call.kwargs["users"]
+        ]
+        self.assertEqual(statuses.count("disabled"), 5)
+        self.assertEqual(statuses.count("enabled"), 20)
+
+    @patch("src.migration_utils.anon_passwords")
+    @patch("src.migration_utils.attribute_schema")
+    @patch("src.migration_utils.descope_client")
+    def test_process_users_hashes_passwords_in_their_own_stage(
+        self, mock_descope_client, mock_attribute_schema, mock_anon_passwords
+    ):
+        lock = threading.Lock()
+        hashing = []
+        max_hashing = []
+        hash_threads = set()
+
+        def take():
+            with lock:
+                hashing.append(None)
+                max_hashing.append(len(hashing))
+                hash_threads.add(threading.current_thread().name.rsplit("-", 1)[0])
+            time.sleep(0.1)
+            with lock:
+                hashing.pop()
+            return "$2b$04$anon"
+
+        def invite_batch(users, **kwargs):
+            return {
+                "createdUsers": [{"loginIds": [u.login_id]} for u in users],
+                "failedUsers": [],
+            }
+
+        mock_anon_passwords.take.side_effect = take
+        mock_descope_client.mgmt.user.invite_batch.side_effect = invite_batch
+        # Anonymous users, each one gets a random bcrypt password
+        users = ({"_data": {"localId": f"user{i}"}} for i in range(8))
+
+        failed, migrated, _, _ = process_users(
+            users, {}, False, batch_size=2, workers=1, hash_workers=3
+        )
+
+        self.assertEqual(failed, [])
+        self.assertEqual(migrated, 8)
+        self.assertEqual(hash_threads, {"pipeline-hash"})
+        # The passwords of several batches were hashed at the same time
+        self.assertGreater(max(max_hashing), 1)
+        invited = [
+            user
+            for call in mock_descope_client.mgmt.user.invite_batch.call_args_list
+            for user in call.kwargs["users"]
+        ]
+        self.assertEqual(len(invited), 8)
+        self.assertTrue(all(user.password.hashed.hash == "$2b$04$anon" for user in invited))
+
+    @patch("src.migration_utils.get_firestore_client")
+    def test_prefetch_custom_attributes_reads_firestore_in_one_call(
+        self, mock_get_firestore_client
+    ):
+        def make_snapshot(uid, data):
+            snapshot = MagicMock(id=uid, exists=data is not None)
+            snapshot.to_dict.return_value = data
+            return snapshot
+
+        mock_firestore = mock_get_firestore_client.return_value
+        mock_firestore.get_all.return_value = [
+            make_snapshot("user1", {"plan": "pro"}),
+            make_snapshot("user2", None),
+        ]
+        set_custom_attribute_source("firestore")
+        try:
+            attributes = prefetch_custom_attributes(["user1", "user2", None])
+        finally:
+            set_custom_attribute_source(None)
+
+        mock_firestore.get_all.assert_called_once()
+        self.assertEqual(len(mock_firestore.get_all.call_args.args[0]), 2)
+        self.assertEqual(attributes, {"user1": {"plan": "pro"}})
+
+    @patch("src.migration_utils.context")
+    def test_prefetch_custom_attributes_reads_realtime_users_by_key(self, mock_context):
+        documents = {"users/user1": {"plan": "pro"}, "users/user2": None}
+        mock_context.database_reference.side_effect = lambda path: MagicMock(
+            **{"get.return_value": documents[path]}
+        )
+        set_custom_attribute_source("realtime")
+        try:
+            attributes = prefetch_custom_attributes(["user1", "user2", "user1", None])
+        finally:
+            set_custom_attribute_source(None)
+
+        self.assertEqual(mock_context.database_reference.call_count, 2)
+        self.assertEqual(attributes, {"user1": {"plan": "pro"}})
+
+    @patch("src.migration_utils.create_custom_attributes_in_descope")
+    @patch("src.migration_utils.load_custom_attributes_from_descope")
+    def test_custom_attribute_schema_creates_only_unseen_attributes(
+        self, mock_load_attributes, mock_create_attributes
+    ):
+        mock_load_attributes.return_value = {"UUID": "String"}
+        mock_create_attributes.return_value = True
+        schema = CustomAttributeSchema()
+
+        schema.ensure({"UUID": "String", "plan": "String"})
+        schema.ensure({"plan": "String"})
+        schema.ensure({"plan": "Number"})
+
+        mock_load_attributes.assert_called_once()
+        mock_create_attributes.assert_called_once_with({"plan": "String"})
+        self.assertEqual(schema.type_conflicts, {"plan": {"String", "Number"}})
+
+    def test_discover_custom_attribute_schema_widens_conflicting_types(self):
+        documents = [
+            ("user1", {"plan": "pro", "age": 30, "devices": {"a1": True}}),
+            ("user2", {"plan": "free", "age": "unknown", "devices": {"b2": False}}),
+            ("user3", {}),
+        ]
+
+        report = discover_custom_attribute_schema(documents)
+
+        self.assertEqual(report.documents, 2)
+        self.assertEqual(
+            report.attribute_types,
+            {
+                "plan": "String",
+                "age": "String",
+                "devices_a1": "Boolean",
+                "devices_b2": "Boolean",
+            },
+        )
+        self.assertEqual(report.keys_per_field()["devices"], 2)
+        self.assertEqual(
+            report.to_dict()["schema"]["age"],
+            {"type": "String", "valueTypes": ["Number", "String"], "users": 2},
+        )
+
+    def test_migration_journal_commits_pages_in_order_and_skips_migrated_users(self):
+        def make_page(uids, page_token, next_page_token):
+            users = [{"_data": {"localId": uid}} for uid in uids]
+            return FirebaseUserPage(users, page_token, next_page_token)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal.sqlite")
+            journal = MigrationJournal(path)
+            journal.open_page(make_page(["u1", "u2"], None, "token2"))
+            journal.open_page(make_page(["u3"], "token2", None))
+
+            # The second page finishing first must not move the checkpoint past the first page
+            journal.record([("u3", "c@test.com", True, None)])
+            self.assertIsNone(journal.resume_page_token())
+            journal.record([("u1", "a@test.com", True, None)])
+            journal.close()
+
+            resumed = MigrationJournal(path)
+            self.assertIsNone(resumed.resume_page_token())
+            remaining = resumed.open_page(make_page(["u1", "u2"], None, "token2"))
+            self.assertEqual(remaining, [{"_data": {"localId": "u2"}}])
+            resumed.record([("u2", "b@test.com", False, "invalid email")])
+            self.assertEqual(resumed.resume_page_token(), "token2")
+            resumed.close()
+
+    @patch("src.migration_utils.descope_client")
+    def test_delta_migration_patches_only_changed_users(self, mock_descope_client):
+        mock_user_api = mock_descope_client.mgmt.user
+        mock_user_api.invite_batch.side_effect = lambda users, **kwargs: {
+            "createdUsers": [{"loginIds": [u.login_id]} for u in users]
+        }
+        mock_user_api.patch_batch.side_effect = lambda users, **kwargs: {
+            "patchedUsers": [{"loginIds": [u.login_id]} for u in users]
+        }
+
+        def make_users(display_name):
+            return [
+                {"_data": {"localId": "u1", "email": "a@test.com"}},
+                {"_data": {"localId": "u2", "email": "b@test.com", "displayName": display_name}},
+            ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            fingerprints = FingerprintIndex(os.path.join(directory, "state.sqlite"))
+            migrate_user_chunk(make_users("Bob"), {}, fingerprints=fingerprints)
+            results = migrate_user_chunk(
+                make_users("Robert"), {}, fingerprints=fingerprints, delta=True
+            )
+            fingerprints.close()
+
+        self.assertEqual(mock_user_api.invite_batch.call_count, 1)
+        patched_users = mock_user_api.patch_batch.call_args.kwargs["users"]
+        self.assertEqual([u.login_id for u in patched_users], ["b@test.com"])
+        self.assertEqual(fingerprints.unchanged_users, 1)
+        self.assertIn(("u2", "b@test.com", True, None), results)
+
+    @patch("src.migration_utils.descope_client")
+    def test_delta_migration_recreates_users_whose_password_changed(self, mock_descope_client):
+        mock_user_api = mock_descope_client.mgmt.user
+        mock_user_api.invite_batch.side_effect = lambda users, **kwargs: {
+            "createdUsers": [{"loginIds": [u.login_id]} for u in users]
+        }
+        hash_params = {"salt_separator": "Bw==", "signer_key": "a2V5", "mem_cost": 14, "rounds": 8}
+
+        def make_users(password_hash, display_name):
+            return [
+                {
+                    "_data": {
+                        "localId": "u1",
+                        "email": "a@test.com",
+                        "displayName": display_name,
+                        "passwordHash": password_hash,
+                        "salt": "c2FsdA==",
+                    }
+                }
+            ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            fingerprints = FingerprintIndex(os.path.join(directory, "state.sqlite"))
+            migrate_user_chunk(make_users("aGFzaA==", "Bob"), hash_params, fingerprints=fingerprints)
+            results = migrate_user_chunk(
+                make_users("bmV3", "Robert"), hash_params, fingerprints=fingerprints, delta=True
+            )
+            with patch(
+                "src.migration_utils.build_user_password", wraps=build_user_password
+            ) as mock_build_password:
+                rerun_results = migrate_user_chunk(
+                    make_users("bmV3", "Robert"), hash_params, fingerprints=fingerprints, delta=True
+                )
+            fingerprints.close()
+
+        mock_user_api.delete.assert_called_once_with(login_id="a@test.com")
+        created_user = mock_user_api.invite_batch.call_args.kwargs["users"][0]
+        self.assertEqual(created_user.display_name, "Robert")
+        self.assertEqual(created_user.password.hashed.hash, "bmV3")
+        mock_user_api.patch_batch.assert_not_called()
+        self.assertTrue(results[0].success)
+        self.assertEqual(results[0].error_code, "password_changed")
+        # Unchanged users are skipped before their password is hashed
+        self.assertIsNone(rerun_results[0].success)
+        mock_build_password.assert_not_called()
+
+    def test_user_updated_since_checks_firebase_metadata(self):
+        user = {"_data": {"createdAt": "1000", "lastRefreshAt": "2024-01-01T00:00:00.000Z"}}
+        self.assertTrue(user_updated_since(user, 1704067200000))
+        self.assertFalse(user_updated_since(user, 1704067200001))
+
+    def test_api_requests_share_one_pooled_session(self):
+        session = configure_http_session(pool_size=4)
+        self.assertEqual(session.get_adapter("https://api.descope.com")._pool_maxsize, 4)
+
+        with patch.object(session, "post") as mock_post:
+            mock_post.return_value = MagicMock(status_code=200)
+            api_request_with_retry("post", "https://api.descope.com/a", {}, data="{}")
+            api_request_with_retry("post", "https://api.descope.com/b", {}, data="{}")
+
+        self.assertEqual(mock_post.call_count, 2)
+
+    def test_api_request_with_retry_honors_retry_after(self):
+        session = configure_http_session()
+        rate_limited = MagicMock(status_code=429, headers={"Retry-After": "0.05"})
+        ok = MagicMock(status_code=200, headers={})
+        limiter = RateLimiter()
+
+        with patch("src.migration_utils.rate_limiter", limiter), patch(
+            "src.migration_utils.retry_engine", RetryEngine(base_delay=0.01)
+        ), patch.object(session, "get", side_effect=[rate_limited, ok]) as mock_get:
+            started = time.monotonic()
+            response = api_request_with_retry("get", "https://api.descope.com/a", {})
+
+        self.assertIs(response, ok)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        # The shared limiter slowed down after the rate limit
+        self.assertIsNotNone(limiter.rate)
+
+    def test_retry_engine_budget_and_circuit_breaker(self):
+        engine = RetryEngine(budget=1, budget_ratio=0, failure_threshold=2, open_timeout=5)
+
+        engine.next_delay("invite_batch", 0)
+        with self.assertRaises(RetryGiveUp):
+            engine.next_delay("invite_batch", 0)
+
+        engine.record_failure("create")
+        self.assertEqual(engine.endpoint("create").open_until, 0.0)
+        engine.record_failure("create")
+        self.assertGreater(engine.endpoint("create").open_until, time.monotonic())
+        # Other endpoints keep their own state
+        self.assertEqual(engine.endpoint("invite_batch").open_until, 0.0)
+
+    def test_sdk_retries_release_the_probe_and_wait_out_rate_limits(self):
+        engine = RetryEngine(base_delay=0.001, max_delay=0.001, budget=0, budget_ratio=0)
+        with patch("src.migration_utils.retry_engine", engine), patch(
+            "src.migration_utils.rate_limiter", RateLimiter(min_rate=1000)
+        ):
+            # A probe that fails with an unexpected error lets the next request probe again
+            engine.endpoint("invite_batch").open_until = time.monotonic() - 1
+            failing_call = MagicMock(__name__="invite_batch", side_effect=ValueError("bad"))
+            with self.assertRaises(ValueError):
+                sdk_request_with_retry(failing_call)
+            self.assertFalse(engine.endpoint("invite_batch").probe_in_flight)
+
+            # Rate limits are waited out past max_retries and an empty retry budget
+            rate_limited = RateLimitException(429, "rate limit", rate_limit_parameters={})
+            call = MagicMock(__name__="patch_batch", side_effect=[rate_limited] * 5 + ["ok"])
+            self.assertEqual(sdk_request_with_retry(call, max_retries=1), "ok")
+            self.assertEqual(call.call_count, 6)
+
+    def test_iter_export_file_pages_splits_json_into_byte_ranges(self):
+        users = [
+            {"localId": f"user{i}", "email": f"user{i}@test.com", "lastSignedInAt": "1"}
+            for i in range(200)
+        ]
+        # A value that looks like a record start must not split a record
+        users[10]["displayName"] = '{"localId": "fake"}'
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.json")
+            with open(path, "w") as file:
+                json.dump({"users": users}, file, indent=2)
+
+            pages = list(iter_export_file_pages(path, chunk_size=1024, workers=2))
+
+        parsed = [user for page in pages for user in page.users]
+        self.assertGreater(len(pages), 1)
+        self.assertEqual(
+            [user["_data"]["localId"] for user in parsed],
+            [f"user{i}" for i in range(200)],
+        )
+        self.assertEqual(parsed[10]["_data"]["displayName"], '{"localId": "fake"}')
+        self.assertEqual(parsed[0]["_data"]["lastLoginAt"], "1")
+        self.assertIsNone(pages[-1].next_page_token)
+        self.assertEqual(pages[1].page_token, pages[0].next_page_token)
+
+    def test_iter_export_file_pages_parses_csv_records_across_chunks(self):
+        rows = []
+        for i in range(100):
+            row = [""] * 27
+            row[0], row[1], row[2] = f"user{i}", f"user{i}@test.com", "true"
+            row[26] = "true" if i % 3 == 0 else "false"
+            rows.append(row)
+        # Quoted fields may span lines, and contain quotes and commas
+        rows[10][5] = 'Line one\nline "two", and three'
+        rows[50][5] = "\n\n\n" * 200
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.csv")
+            with open(path, "w", newline="") as file:
+                csv.writer(file).writerows(rows)
+
+            pages = list(iter_export_file_pages(path, chunk_size=256, workers=2))
+            resumed = list(
+                iter_export_file_pages(path, start_offset=int(pages[3].next_page_token), workers=1)
+            )
+
+        parsed = [user for page in pages for user in page.users]
+        self.assertGreater(len(pages), 1)
+        self.assertEqual([user.uid for user in parsed], [f"user{i}" for i in range(100)])
+        self.assertEqual(parsed[10].display_name, 'Line one\nline "two", and three')
+        self.assertEqual(parsed[50].display_name, "\n\n\n" * 200)
+        self.assertEqual(
+            [user.uid for user in parsed if user.disabled],
+            [f"user{i}" for i in range(0, 100, 3)],
+        )
+        self.assertTrue(all(user.email_verified for user in parsed))
+        self.assertEqual(resumed[0].users[0], parsed[sum(len(page.users) for page in pages[:4])])
+
+    @patch("src.migration_utils.DescopeClient")
+    def test_migration_context_creates_clients_lazily(self, mock_descope_client):
+        context = MigrationContext(
+            descope_project_id="P2test",
+            descope_management_key="key",
+            descope_base_url="http://localhost:8080/",
+        )
+        mock_descope_client.assert_not_called()
+        self.assertEqual(context.descope_api_url, "http://localhost:8080")
+        self.assertEqual(
+            context.management_headers["Authorization"], "Bearer P2test:key"
+        )
+        # Patching the module's client doesn't create one either
+        with patch("src.migration_utils.context", context), patch(
+            "src.migration_utils.descope_client"
+        ):
+            pass
+        mock_descope_client.assert_not_called()
+
+        self.assertIs(context.descope_client, context.descope_client)
+        mock_descope_client.assert_called_once_with(
+            project_id="P2test", management_key="key", base_url="http://localhost:8080/"
+        )
+
+        # A forked process creates its own client
+        context.pid = -1
+        context.descope_client
+        self.assertEqual(mock_descope_client.call_count, 2)
+
+    def test_anon_password_pool_hashes_ahead_of_demand(self):
+        pool = AnonPasswordPool(rounds=4, workers=1)
+        try:
+            hashes = [pool.take() for _ in range(3)]
+            # The pool keeps hashing in the background after the first request
+            self.assertEqual(len(pool.pending), 2)
+        finally:
+            pool.close()
+
+        self.assertEqual(len(set(hashes)), 3)
+        self.assertTrue(all(h.startswith("$2b$04$") for h in hashes))
+        self.assertTrue(AnonPasswordPool(rounds=4, workers=0).take().startswith("$2b$04$"))
+        with self.assertRaises(ValueError):
+            AnonPasswordPool(rounds=3)
+
+    def test_migration_user_keeps_only_migrated_fields(self):
+        user_data = {
+            "localId": "u1",
+            "email": "a@test.com",
+            "emailVerified": True,
+            "passwordHash": "aGFzaA==",
+            "salt": "c2FsdA==",
+            "providerUserInfo": [{"providerId": "password"}],
+        }
+        user = MigrationUser.from_firebase_data(user_data)
+        self.assertFalse(hasattr(user, "__dict__"))
+        self.assertEqual(user["_data"], {k: v for k, v in user_data.items() if k != "providerUserInfo"})
+        self.assertEqual(pickle.loads(pickle.dumps(user)), user)
+
+        hash_params = {"salt_separator": "Bw==", "signer_key": "a2V5", "mem_cost": 14, "rounds": 8}
+        with patch("src.migration_utils.attribute_source", None):
+            (user_object,), login_id, is_disabled = map_firebase_user(user, hash_params)
+        self.assertEqual(login_id, "a@test.com")
+        self.assertFalse(is_disabled)
+        self.assertTrue(user_object.verified_email)
+        self.assertEqual(user_object.password.hashed.hash, "aGFzaA==")
+        self.assertEqual(user_object.custom_attributes["UUID"], "u1")
+
+    def test_migration_metrics_report_stages_and_requests(self):
+        metrics = MigrationMetrics()
+        metrics.start(expected_users=10)
+        with metrics.stage("invite_batch"):
+            pass
+        metrics.count_request("invite_batch")
+        metrics.count_request("invite_batch")
+        metrics.count_retry("invite_batch", rate_limited=True)
+        time.sleep(0.01)
+        metrics.count_users(migrated=4, failed=1)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["stages"]["invite_batch"]["calls"], 1)
+        self.assertEqual(snapshot["requests"], {"invite_batch": 2})
+        self.assertEqual(snapshot["rateLimited"], {"invite_batch": 1})
+        self.assertEqual(snapshot["users"], {"migrated": 4, "failed": 1, "skipped": 0})
+        self.assertGreater(snapshot["usersPerSecond"], 0)
+        self.assertIsNotNone(snapshot["etaSeconds"])
+        self.assertIn("most time in invite_batch", metrics.progress_line())
+
+        prometheus = metrics.to_prometheus()
+        self.assertIn('firebase_migration_users_total{outcome="migrated"} 4', prometheus)
+        self.assertIn('firebase_migration_requests_total{endpoint="invite_batch"} 2', prometheus)
+
+    def test_metrics_reporter_writes_the_metrics_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.json")
+            reporter = MetricsReporter(metrics_file=path, interval=60, show_progress=False)
+            reporter.start()
+            reporter.stop()
+            with open(path) as file:
+                self.assertIn("stages", json.load(file))
+
+    def test_result_sink_streams_outcomes_and_keeps_counters(self):
+        results = [
+            UserResult("u1", "a@test.com", True, None, stage="invite_batch"),
+            UserResult(
+                "u2",
+                "b@test.com",
+                False,
+                '{"errorCode": "E062107", "errorMessage": "Invalid email"}',
+                stage="invite_batch",
+            ),
+            ("u3", "c@test.com", None, "Unchanged since last migrated"),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl_path = os.path.join(directory, "results.jsonl")
+            sink = ResultSink(jsonl_path)
+            sink.write(results)
+            sink.close()
+            with open(jsonl_path) as file:
+                rows = [json.loads(line) for line in file]
+
+            csv_path = os.path.join(directory, "results.csv")
+            sink = ResultSink(csv_path)
+            sink.write(results)
+            sink.close()
+            with open(csv_path) as file:
+                csv_lines = file.read().splitlines()
+
+        self.assertEqual([row["outcome"] for row in rows], ["migrated", "failed", "skipped"])
+        self.assertEqual(rows[1]["error_code"], "E062107")
+        self.assertEqual(rows[1]["stage"], "invite_batch")
+        self.assertEqual(csv_lines[0], "uid,login_id,outcome,stage,error_code,reason")
+        self.assertEqual(len(csv_lines), 4)
+        self.assertEqual(sink.outcomes, {"migrated": 1, "merged": 0, "failed": 1, "skipped": 1})
+        self.assertEqual(sink.failures_by_error_code, {"E062107": 1})
+
+        sample = ResultSample(limit=2)
+        for i in range(5):
+            sample.append(i)
+        self.assertEqual((sample, sample.total), ([0, 1], 5))
+
+    @patch("src.migration_utils.attribute_schema")
+    @patch("src.migration_utils.descope_client")
+    def test_merge_plan_sends_colliding_users_once(
+        self, mock_descope_client, mock_attribute_schema
+    ):
+        mock_descope_client.mgmt.user.invite_batch.side_effect = lambda users, **kwargs: {
+            "createdUsers": [{"loginIds": [u.login_id]} for u in users]
+        }
+        users = [
+            MigrationUser(uid="a", email="Ann@Test.com", password_hash="aGFzaA==", salt="c2FsdA=="),
+            MigrationUser(uid="b", email="ann@test.com ", phone="+1 (555) 0100", disabled=True),
+            MigrationUser(uid="c", phone="+15550100", email_verified=True, display_name="Ann"),
+            MigrationUser(uid="d", email="bob@test.com"),
+        ]
+
+        plan = build_merge_plan(users)
+        self.assertEqual(plan.groups, [["a", "b", "c"]])
+
+        merged = list(plan.apply(iter(users)))
+        # The group is sent as soon as its last user was listed
+        self.assertEqual([user.uid for user in merged], ["a", "d"])
+        self.assertEqual(merged[0].merged_user_ids, ["b", "c"])
+        self.assertEqual(merged[0].display_name, "Ann")
+        self.assertTrue(merged[0].disabled)
+
+        hash_params = {"salt_separator": "Bw==", "signer_key": "a2V5", "mem_cost": 14, "rounds": 8}
+        failed, migrated, merged_users, mismatched = process_users(
+            plan.apply(iter(users)), hash_params, False, batch_size=10
+        )
+        self.assertEqual(mock_descope_client.mgmt.user.invite_batch.call_count, 1)
+        sent = mock_descope_client.mgmt.user.invite_batch.call_args.kwargs["users"]
+        self.assertEqual([user.login_id for user in sent], ["Ann@Test.com", "bob@test.com"])
+        self.assertEqual(sent[0].status, "disabled")
+        self.assertEqual((failed, migrated, merged_users), ([], 4, 2))
+        self.assertEqual(mismatched, ["Ann@Test.com"])
+
+    @patch("src.migration_utils.attribute_schema", new_callable=CustomAttributeSchema)
+    @patch("src.migration_utils.load_custom_attributes_from_descope")
+    @patch("src.migration_utils.create_custom_attributes_in_descope")
+    @patch("src.migration_utils.descope_client")
+    def test_dry_run_plans_the_migration_without_descope(
+        self, mock_descope_client, mock_create_attributes, mock_load_attributes, mock_attribute_schema
+    ):
+        mock_load_attributes.return_value = {"plan": "String"}
+        users = [
+            MigrationUser(uid="u1", email="a@test.com", password_hash="aGFzaA==", salt="c2FsdA=="),
+            MigrationUser(uid="u2", email="b@test.com", disabled=True),
+            MigrationUser(uid="u3"),
+        ]
+        attributes = {"u1": {"plan": "pro", "seats": 3}, "u2": {"plan": 2}}
+        hash_params = {"salt_separator": "Bw==", "signer_key": "a2V5", "mem_cost": 14, "rounds": 8}
+        plan = DryRunPlan(batch_size=2)
+
+        with patch("src.migration_utils.attribute_source", "firestore"), patch(
+            "src.migration_utils.prefetch_custom_attributes",
+            side_effect=lambda user_ids: {uid: attributes.get(uid) for uid in user_ids},
+        ), patch("src.migration_utils.anon_passwords", AnonPasswordPool(rounds=4, workers=0)), patch(
+            "src.migration_utils.context",
+            MigrationContext(descope_project_id="P2test", descope_management_key="key"),
+        ):
+            process_users(iter(users), hash_params, True, batch_size=2, plan=plan)
+
+        mock_descope_client.mgmt.user.invite_batch.assert_not_called()
+        mock_create_attributes.assert_not_called()
+        # The existing attributes are read once, and aren't planned to be created again
+        mock_load_attributes.assert_called_once()
+        summary = plan.to_dict(rate_limit=2)
+        self.assertEqual(summary["requests"]["customattributes"], 1)
+        self.assertFalse(summary["attributeRequestsUpperBound"])
+        self.assertEqual(summary["usersByKind"], {"password": 1, "anonymous": 1, "passwordless": 1})
+        self.assertEqual(summary["disabledUsers"], 1)
+        self.assertEqual(summary["requests"]["invite_batch"], 2)
+        self.assertEqual(summary["attributeSchema"]["seats"], "Number")
+        self.assertEqual(summary["attributeTypeConflicts"], {"plan": ["Number", "String"]})
+        self.assertEqual(summary["largestAttributePayloads"][0]["uid"], "u1")
+        self.assertGreaterEqual(
+            summary["projectedSeconds"], sum(summary["requests"].values()) / 2
+        )
+        self.assertFalse(mock_attribute_schema.dry_run)
+
+    def test_snapshot_replays_users_and_attributes_without_firebase(self):
+        users = [
+            MigrationUser(uid="u1", email="a@test.com", password_hash="aGFzaA==", created_at="1"),
+            MigrationUser(uid="u2", phone="+15550100", email_verified=True, disabled=True),
+            MigrationUser(uid="u3"),
+        ]
+        pages = [FirebaseUserPage(users[:2], None, "t2"), FirebaseUserPage(users[2:], "t2", None)]
+        attributes = {"u1": {"plan": "pro"}, "u3": {"seats": 3}}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.db")
+            with patch("src.migration_utils.attribute_source", "firestore"), patch(
+                "src.migration_utils.prefetch_custom_attributes",
+                side_effect=lambda user_ids: {uid: attributes[uid] for uid in user_ids if uid in attributes},
+            ):
+                snapshot = FirebaseSnapshot(path)
+                self.assertEqual(snapshot.capture(iter(pages), "firestore"), 3)
+                snapshot.close()
+
+            snapshot = FirebaseSnapshot(path)
+            self.assertEqual(snapshot.attribute_source, "firestore")
+            replayed = list(snapshot.iter_pages(page_size=2))
+            self.assertEqual([page.users for page in replayed], [users[:2], users[2:]])
+            self.assertEqual([page.next_page_token for page in replayed], ["2", None])
+            resumed = list(snapshot.iter_pages(start_offset=2, page_size=2))
+            self.assertEqual(resumed[0].users, users[2:])
+
+            set_custom_attribute_source("snapshot", snapshot)
+            try:
+                self.assertEqual(prefetch_custom_attributes(["u1", "u2", "u3"]), attributes)
+                self.assertEqual(fetch_custom_attributes("u3"), {"seats": 3})
+            finally:
+                set_custom_attribute_source(None)
+                snapshot.close()
+
+    def test_snapshot_keeps_the_types_of_firestore_values(self):
+        from google.cloud.firestore import GeoPoint
+        from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+
+        reference = MagicMock(path="companies/acme", parent="companies")
+        document = {
+            "location": GeoPoint(48.8, 2.3),
+            "signedUpAt": DatetimeWithNanoseconds(2024, 5, 1, 12, 30, tzinfo=timezone.utc),
+            "avatar": b"\x00\x01",
+            "company": reference,
+            "history": [{"at": datetime(2024, 1, 1, tzinfo=timezone.utc), "where": GeoPoint(1, 2)}],
+            "profile": {"seats": 3, "tags": ["a", "b"]},
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = FirebaseSnapshot(os.path.join(directory, "snapshot.db"))
+            with patch(
+                "src.migration_utils.prefetch_custom_attributes", return_value={"u1": document}
+            ):
+                pages = [FirebaseUserPage([MigrationUser(uid="u1")], None, None)]
+                snapshot.capture(iter(pages), "firestore")
+            replayed = snapshot.get_attributes(["u1"])["u1"]
+            snapshot.close()
+
+        self.assertEqual(flatten_attributes(replayed), flatten_attributes(document))
+        self.assertEqual(list(replayed), list(document))
+
+    def test_pipeline_runs_stages_with_bounded_queues(self):
+        release = threading.Event()
+        fed = []
+        fed_while_blocked = []
+
+        def items():
+            for item in range(10):
+                fed.append(item)
+                yield item
+
+        def write(item):
+            release.wait(5)
+            return item * 10
+
+        def check_and_release():
+            fed_while_blocked.append(len(fed))
+            release.set()
+
+        pipeline = (
+            MigrationPipeline(queue_size=1)
+            .add_stage("map", lambda item: item + 1, workers=2)
+            .add_stage("write", write)
+        )
+        threading.Timer(0.5, check_and_release).start()
+        self.assertEqual(sorted(pipeline.run(items())), list(range(10, 110, 10)))
+        # While the write stage was stuck, the full queues held back the input
+        self.assertLess(fed_while_blocked[0], 10)
+        self.assertEqual(pipeline.queue_depths(), {"map": 0, "write": 0})
+
+    def test_pipeline_raises_the_first_stage_error(self):
+        def map_item(item):
+            if item == 3:
+                raise ValueError("bad user")
+            return item
+
+        pipeline = MigrationPipeline().add_stage("map", map_item).add_stage("write", lambda item: item)
+        with self.assertRaises(ValueError):
+            list(pipeline.run(iter(range(100))))
+
+    @patch("src.migration_utils.api_request_with_retry")
+    def test_verify_reports_missing_extra_and_mismatched_users(self, mock_api_request):
+        def descope_user(uid, login_id, **fields):
+            return {
+                "loginIds": [login_id],
+                "email": login_id,
+                "status": "enabled",
+                "verifiedEmail": True,
+                "customAttributes": {"UUID": uid} if uid else {},
+                **fields,
+            }
+
+        descope_users = [
+            descope_user("u1", "a@test.com", name="Ann"),
+            descope_user("u2", "b@test.com", name="Bob", status="disabled"),
+            descope_user("u4", "d@test.com"),
+            descope_user(None, "admin@test.com"),
+        ]
+        pages = [descope_users[:2], descope_users[2:], []]
+        mock_api_request.side_effect = [
+            MagicMock(ok=True, json=lambda page=page: {"users": page}) for page in pages
+        ]
+        firebase_users = [
+            MigrationUser(uid="u1", email="a@test.com", display_name="Ann", email_verified=True),
+            MigrationUser(uid="u2", email="b@test.com", display_name="Robert", email_verified=True),
+            MigrationUser(uid="u3", email="c@test.com"),
+        ]
+
+        index = DescopeUserIndex(":memory:").add(iter_descope_users(page_size=2))
+        missing_file = io.StringIO()
+        report = verify_migration(iter(firebase_users), index, missing_file, chunk_size=2)
+        summary = report.to_dict(index)
+        index.close()
+
+        self.assertEqual(mock_api_request.call_count, 3)
+        self.assertEqual(json.loads(mock_api_request.call_args.kwargs["data"])["page"], 2)
+        self.assertEqual(summary["descopeUsers"], 4)
+        self.assertEqual(summary["unlinkedDescopeUsers"], 1)
+        self.assertEqual(summary["matchedUsers"], 1)
+        self.assertEqual(summary["missingSample"], ["u3"])
+        self.assertEqual(missing_file.getvalue(), "u3\n")
+        self.assertEqual(summary["extraSample"], [{"uid": "u4", "loginId": "d@test.com"}])
+        self.assertEqual(summary["mismatchedFields"], {"name": 1, "disabled": 1})
+
+    def test_flatten_attributes_converts_values_in_one_pass(self):
+        document = {"plan": "pro", "seats": 3, "active": True, "address": {"city": "Paris", "zip": {"code": 75}}}
+        flattened, attribute_types = flatten_attributes(document)
+        self.assertEqual(flattened, flatten_dict(document))
+        self.assertEqual(attribute_types, infer_custom_attribute_types(flattened))
+
+        class GeoPoint:
+            latitude, longitude = 48.85, 2.35
+
+        class DocumentReference:
+            path, parent = "teams/t1", None
+
+        signed_up = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+        flattened, attribute_types = flatten_attributes(
+            {
+                "signedUp": signed_up,
+                "home": GeoPoint(),
+                "team": DocumentReference(),
+                "tags": ["a", signed_up],
+                "avatar": b"\x00\x01",
+            }
+        )
+        self.assertEqual(
+            flattened,
+            {
+                "signedUp": "2024-05-01T12:30:00+00:00",
+                "home_latitude": 48.85,
+                "home_longitude": 2.35,
+                "team": "teams/t1",
+                "tags": '["a", "2024-05-01T12:30:00+00:00"]',
+                "avatar": "AAE=",
+            },
+        )
+        self.assertEqual(attribute_types["home_latitude"], "Number")
+        self.assertEqual(attribute_types["tags"], "String")
+
+    def test_flatten_attributes_applies_limits_without_recursion(self):
+        deep = value = {}
+        for _ in range(5000):
+            value["next"] = {}
+            value = value["next"]
+        value["leaf"] = 1
+        flattened, _ = flatten_attributes(deep)
+        self.assertEqual(list(flattened.values()), [1])
+
+        limits = AttributeLimits(max_depth=2, max_keys=2)
+        flattened, attribute_types = flatten_attributes(
+            {"a": {"b": {"c": 1}}, "name": "Émilie", "dropped": 1}, limits=limits
+        )
+        self.assertEqual(flattened, {"a_b": '{"c": 1}', "name": "Émilie"})
+        self.assertEqual(attribute_types, {"a_b": "String", "name": "String"})
+        # A character is never cut in half
+        flattened, _ = flatten_attributes({"name": "Émilie"}, limits=AttributeLimits(max_value_bytes=4))
+        self.assertEqual(flattened, {"name": "Émi"})
+        flattened, _ = flatten_attributes({"name": "Émilie"}, limits=AttributeLimits(max_value_bytes=1))
+        self.assertEqual(flattened, {"name": ""})
+        with self.assertRaises(ValueError):
+            AttributeLimits(max_keys=0)
+
+    def test_shared_rate_limiter_is_shared_between_processes(self):
+        limiter = SharedRateLimiter(rate=4)
+        process = multiprocessing.get_context("spawn").Process(
+            target=take_rate_limit_tokens, args=(limiter, 4)
+        )
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+
+        # The other process used up the bucket, so this one waits for a new token
+        self.assertLess(limiter.tokens, 1)
+        started = time.monotonic()
+        limiter.acquire()
+        self.assertGreater(time.monotonic() - started, 0.05)
+
+
+    def test_benchmark_migrates_synthetic_users_into_fake_descope(self):
+        args = benchmark.build_parser().parse_args(
+            "--users 30 --batch-size 10 --latency-ms 0 --anon-password-rounds 4 "
+            "--anon-password-workers 0".split()
+        )
+        benchmark_utils = benchmark.migration_utils
+        originals = {
+            name: getattr(benchmark_utils, name)
+            for name in (
+                "context",
+                "prefetch_custom_attributes",
+                "write_user_chunk",
+                "rate_limiter",
+                "anon_passwords",
+                "http_session",
+            )
+        }
+
+        report = benchmark.run_benchmark(args)
+
+        self.assertEqual(report["migratedUsers"], 30)
+        self.assertEqual(report["failedUsers"], 0)
+        self.assertEqual(report["requestsByEndpoint"]["/v1/mgmt/user/create/batch"], 3)
+        self.assertEqual(report["requestsByEndpoint"]["/v1/mgmt/user/customattributes"], 1)
+        self.assertGreater(report["usersPerSecond"], 0)
+        self.assertLessEqual(report["latencyP50Ms"], report["latencyP99Ms"])
+        self.assertIn("invite_batch", report["stageSeconds"])
+        # The migration is left as it was found
+        for name, original in originals.items():
+            self.assertIs(getattr(benchmark_utils, name), original, name)
+
+    def test_orchestrator_validates_the_manifest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "manifest.json")
+
+            def load(manifest):
+                with open(path, "w") as file:
+                    json.dump(manifest, file)
+                return orchestrate.load_manifest(path)
+
+            project = {
+                "name": "app",
+                "passwordHash": "app-hash.txt",
+                "descopeProjectId": "P2app",
+                "descopeManagementKey": "K2app",
+            }
+            projects = load({"defaults": {"workers": 2, "delta": True}, "projects": [project]})
+            self.assertEqual(len(projects), 1)
+            self.assertEqual(projects[0]["workers"], 2)
+            self.assertTrue(projects[0]["delta"])
+            self.assertEqual(projects[0]["batchSize"], orchestrate.PROJECT_DEFAULTS["batchSize"])
+            self.assertEqual(
+                projects[0]["firebaseCredentials"],
+                os.path.join("creds", "app", "firebase-certs.json"),
+            )
+
+            with patch.dict(os.environ, {"APP_MANAGEMENT_KEY": "K2app"}):
+                projects = load(
+                    {
+                        "projects": [
+                            {
+                                **project,
+                                "descopeManagementKey": None,
+                                "descopeManagementKeyEnv": "APP_MANAGEMENT_KEY",
+                            }
+                        ]
+                    }
+                )
+            self.assertEqual(projects[0]["descopeManagementKeyEnv"], "APP_MANAGEMENT_KEY")
+
+            without_key = {**project, "descopeManagementKey": None}
+            for manifest, error in (
+                ({"projects": []}, "doesn't list any projects"),
+                ({"projects": [{**project, "passwordHash": ""}]}, "missing passwordHash"),
+                ({"projects": [project, {**project}]}, "used twice"),
+                # A project never falls back to DESCOPE_MANAGEMENT_KEY
+                ({"projects": [without_key]}, "needs either"),
+                (
+                    {"projects": [{**project, "descopeManagementKeyEnv": "APP_MANAGEMENT_KEY"}]},
+                    "needs either",
+                ),
+                (
+                    {"projects": [{**without_key, "descopeManagementKeyEnv": "UNSET_MANAGEMENT_KEY"}]},
+                    "isn't set",
+                ),
+                ({"projects": [{**project, "attributeSource": "mongo"}]}, "unknown attributeSource"),
+            ):
+                with patch.dict(os.environ, {"DESCOPE_MANAGEMENT_KEY": "K2default"}):
+                    with self.assertRaisesRegex(ValueError, error):
+                        load(manifest)
+
+    def test_orchestrator_aggregates_project_summaries(self):
+        def summary(name, migrated, failed, failures_by_error_code):
+            return {
+                "name": name,
+                "descopeProjectId": f"P2{name}",
+                "firebaseUsers": migrated + failed,
+                "outcomes": {"migrated": migrated, "merged": 0, "failed": failed, "skipped": 0},
+                "failuresByStage": {"create": failed},
+                "failuresByErrorCode": failures_by_error_code,
+            }
+
+        report = orchestrate.aggregate_report(
+            [
+                summary("b", 5, 3, {"E062107": 2, "E011002": 1}),
+                {"name": "c", "error": "FileNotFoundError: c-hash.txt"},
+                summary("a", 10, 2, {"E062107": 2}),
+            ]
+        )
+
+        self.assertEqual(report["projects"], 3)
+        self.assertEqual(report["failedProjects"], ["c"])
+        self.assertEqual(report["firebaseUsers"], 20)
+        self.assertEqual(
+            report["outcomes"], {"migrated": 15, "merged": 0, "failed": 5, "skipped": 0}
+        )
+        self.assertEqual(list(report["failuresByErrorCode"].items()), [("E062107", 4), ("E011002", 1)])
+        self.assertEqual([summary["name"] for summary in report["projectSummaries"]], ["a", "b", "c"])
+
+    def test_orchestrator_migrates_projects_when_one_of_them_fails(self):
+        with tempfile.TemporaryDirectory() as directory, benchmark.FakeDescope() as fake_descope:
+            hash_params_path = os.path.join(directory, "password-hash.txt")
+            with open(hash_params_path, "w") as file:
+                file.write(PASSWORD_HASH_PARAMS)
+            import_file = os.path.join(directory, "users.json")
+            with open(import_file, "w") as file:
+                json.dump(
+                    {"users": [{"localId": f"user{i}", "email": f"user{i}@test.com"} for i in range(5)]},
+                    file,
+                )
+            defaults = {
+                "descopeProjectId": "P2orchestrated",
+                "descopeBaseUrl": fake_descope.url,
+                "importFile": import_file,
+                "anonPasswordRounds": 4,
+                "anonPasswordWorkers": 0,
+            }
+            manifest_path = os.path.join(directory, "manifest.json")
+            with open(manifest_path, "w") as file:
+                json.dump(
+                    {
+                        "defaults": defaults,
+                        "projects": [
+                            {
+                                "name": "app",
+                                "passwordHash": hash_params_path,
+                                "descopeManagementKeyEnv": "APP_MANAGEMENT_KEY",
+                            },
+                            {
+                                "name": "missing-hash",
+                                "passwordHash": os.path.join(directory, "missing.txt"),
+                                "descopeManagementKey": "K2missing",
+                            },
+                        ],
+                    },
+                    file,
+                )
+
+            with patch.dict(os.environ, {"APP_MANAGEMENT_KEY": "K2app"}):
+                projects = orchestrate.load_manifest(manifest_path)
+                summaries = orchestrate.run_projects(
+                    projects, parallel=2, log_directory=os.path.join(directory, "logs")
+                )
+            report = orchestrate.aggregate_report(summaries)
+
+            self.assertEqual(report["failedProjects"], ["missing-hash"])
+            failed = next(summary for summary in summaries if summary["name"] == "missing-hash")
+            self.assertIn("FileNotFoundError", failed["error"])
+            self.assertEqual(report["firebaseUsers"], 5)
+            self.assertEqual(report["outcomes"]["migrated"], 5)
+            self.assertEqual(report["outcomes"]["failed"], 0)
+            migrated = next(summary for summary in summaries if summary["name"] == "app")
+            self.assertTrue(os.path.isfile(migrated["resultsFile"]))
 
 if __name__ == "__main__":
     unittest.main()